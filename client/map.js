@@ -1,17 +1,34 @@
 require(["esri/Map", "esri/views/MapView", "esri/widgets/BasemapToggle",
-        "esri/layers/GeoJSONLayer", "esri/widgets/LayerList"],
+        "esri/layers/GeoJSONLayer", "esri/widgets/LayerList", "esri/layers/FeatureLayer", "esri/Graphic"],
     function (
         Map,
         MapView,
         BasemapToggle,
         GeoJSONLayer,
-        LayerList
+        LayerList,
+        FeatureLayer,
+        Graphic
     ) {
         // Create templates for the layers
         // Tweets template
+        // labels of DamageTweetFM, the damage of a tweet is set only when the cascade filter runs
+        const damage_descriptions = {
+            pos: "segnalati danni",
+            neg: "nessun danno segnalato"
+        };
         const template_tweets = {
             title: "Tweet di {author} da {place}, {time_posted}",
-            content: "'{text}'",
+            content: function (feature) {
+                var attributes = feature.graphic.attributes;
+                var content = document.createElement("div");
+                content.appendChild(document.createTextNode("'" + attributes.text + "'"));
+                var damage = damage_descriptions[attributes.damage];
+                if (damage) {
+                    content.appendChild(document.createElement("br"));
+                    content.appendChild(document.createTextNode("Danni: " + damage));
+                }
+                return content;
+            },
             fieldInfos: [
                 {
                     fieldName: "time_posted",
@@ -185,7 +202,160 @@ require(["esri/Map", "esri/views/MapView", "esri/widgets/BasemapToggle",
             }
         }
 
-        refreshLayers();
+        // Live layers, updated in place with the deltas pushed by the server on /live
+        // Layers are listed from the bottom one to the top one
+        const live_layers_settings = {
+            faults: {
+                geometryType: "polygon",
+                fields: ["probability"],
+                properties: {title: 'Probabili faglie attivate', popupTemplate: template_faults,
+                             renderer: renderer_faults, opacity: 0.5}
+            },
+            area_at_risk: {
+                geometryType: "polygon",
+                fields: ["centroid", "municipalities", "population"],
+                properties: {title: 'Area a rischio', popupTemplate: template_risking_area,
+                             renderer: renderer_risking_area, blendMode: "multiply", opacity: 0.9}
+            },
+            municipalities: {
+                geometryType: "point",
+                fields: ["name", "population", "province", "state"],
+                properties: {title: 'Zone a rischio', popupTemplate: template_municipalities,
+                             renderer: renderer_municipalities}
+            },
+            tweets: {
+                geometryType: "point",
+                fields: ["author", "damage", "place", "text", "time_posted"],
+                properties: {title: 'Tweet', popupTemplate: template_tweets, renderer: renderer_tweets}
+            }
+        };
+        const live_layers_order = ["faults", "area_at_risk", "municipalities", "tweets"];
+        // name -> {layer, fields, objectIds, edits}
+        var live_layers = {};
+        var last_sequence = 0;
+
+        function toEsriGeometry(geometry) {
+            if (geometry.type === "Point") {
+                return {type: "point", longitude: geometry.coordinates[0], latitude: geometry.coordinates[1]};
+            }
+            var rings = geometry.coordinates;
+            if (geometry.type === "MultiPolygon") {
+                rings = [].concat.apply([], geometry.coordinates);
+            }
+            return {type: "polygon", rings: rings, spatialReference: {wkid: 4326}};
+        }
+
+        function toGraphics(features, fields) {
+            return features.map(function (feature) {
+                var attributes = {};
+                fields.forEach(function (field) {
+                    attributes[field] = feature.properties[field];
+                });
+                return new Graphic({geometry: toEsriGeometry(feature.geometry), attributes: attributes});
+            });
+        }
+
+        function createLiveLayer(name, features) {
+            var settings = live_layers_settings[name];
+            var fields = settings.fields.slice();
+            features.forEach(function (feature) {
+                Object.keys(feature.properties).forEach(function (field) {
+                    if (fields.indexOf(field) < 0) {
+                        fields.push(field);
+                    }
+                });
+            });
+            var layer = new FeatureLayer(Object.assign({
+                source: toGraphics(features, fields),
+                fields: [{name: "ObjectID", type: "oid"}].concat(fields.map(function (field) {
+                    return {name: field, type: "string"};
+                })),
+                objectIdField: "ObjectID",
+                geometryType: settings.geometryType,
+                spatialReference: {wkid: 4326}
+            }, settings.properties));
+            var live_layer = {layer: layer, fields: fields, objectIds: []};
+            live_layer.edits = layer.queryObjectIds().then(function (objectIds) {
+                live_layer.objectIds = objectIds || [];
+            });
+            map.add(layer, live_layers_order.indexOf(name));
+            live_layers[name] = live_layer;
+        }
+
+        function applyDelta(delta) {
+            var live_layer = live_layers[delta.layer];
+            if (!live_layer) {
+                createLiveLayer(delta.layer, delta.features);
+                return;
+            }
+            // edits of the same layer are applied one after the other
+            live_layer.edits = live_layer.edits.then(function () {
+                var edits = {addFeatures: toGraphics(delta.features, live_layer.fields)};
+                if (delta.op === "replace") {
+                    edits.deleteFeatures = live_layer.objectIds.map(function (objectId) {
+                        return {objectId: objectId};
+                    });
+                    live_layer.objectIds = [];
+                }
+                return live_layer.layer.applyEdits(edits).then(function (result) {
+                    result.addFeatureResults.forEach(function (added) {
+                        live_layer.objectIds.push(added.objectId);
+                    });
+                });
+            });
+        }
+
+        function resync(message) {
+            Object.keys(live_layers).forEach(function (name) {
+                map.remove(live_layers[name].layer);
+                live_layers[name].layer.destroy();
+            });
+            live_layers = {};
+            live_layers_order.forEach(function (name) {
+                var collection = message.layers[name];
+                createLiveLayer(name, collection ? collection.features : []);
+            });
+        }
+
+        function connectLiveFeed(attempt) {
+            var protocol = window.location.protocol === "https:" ? "wss://" : "ws://";
+            var socket = new WebSocket(protocol + window.location.host + "/live");
+            var opened = false;
+            socket.onopen = function () {
+                opened = true;
+                // the server sends only what happened after the last applied sequence
+                socket.send(JSON.stringify({since: last_sequence}));
+            };
+            socket.onmessage = function (event) {
+                var message = JSON.parse(event.data);
+                if (message.op === "ping" || message.seq <= last_sequence && message.op !== "resync") {
+                    return;
+                }
+                if (message.op === "resync") {
+                    resync(message);
+                } else {
+                    applyDelta(message);
+                }
+                last_sequence = message.seq;
+            };
+            socket.onclose = function () {
+                var next_attempt = opened ? 0 : attempt + 1;
+                if (!opened && last_sequence === 0 && next_attempt >= 3) {
+                    // the live feed is not available, layers are downloaded periodically
+                    refreshLayers();
+                    return;
+                }
+                setTimeout(function () {
+                    connectLiveFeed(next_attempt);
+                }, Math.min(30, Math.pow(2, next_attempt)) * 1000);
+            };
+        }
+
+        if (window.WebSocket) {
+            connectLiveFeed(0);
+        } else {
+            refreshLayers();
+        }
     }
 );
 
@@ -1,11 +1,110 @@
+import atexit
+import json
 import os
 import threading
+import time
 from queue import Queue
 
-from bottle import route, run, static_file
+import gevent
+from bottle import route, run, static_file, request, HTTPResponse
+from bottle.ext.websocket import GeventWebSocketServer, websocket
+from geventwebsocket import WebSocketError
 
 from multithreading_processes import put_tweets_in_queue, filter_tweets_from_queue, \
-    analyze_filtered_tweets
+    analyze_filtered_tweets, TWEETS_QUEUE_SIZE, FILTERED_TWEETS_QUEUE_SIZE
+from multiprocess_pipeline import PipelineSupervisor
+from server.geoJSON_creation import geojson_publishing
+from server.geoJSON_creation.geojson_creation import GEOJSON_DATA_DIRECTORY
+from server.monitoring import pipeline_metrics
+
+
+def serve_layer(name):
+    '''
+    answers with the last snapshot of the layer published by the pipeline:
+    304 if the client already has it (ETag / If-None-Match), gzipped if the client accepts it
+    '''
+    snapshot = geojson_publishing.get_layer_snapshot(name)
+    if snapshot is None:
+        return static_file(name + '.geojson', root="./server/geoJSON_creation/geojson_data")
+    headers = {'ETag': snapshot.get_etag(), 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+    if_none_match = request.get_header('If-None-Match', '')
+    client_etags = [etag.strip().replace('W/', '', 1) for etag in if_none_match.split(',')]
+    if '*' in client_etags or snapshot.get_etag() in client_etags:
+        return HTTPResponse(status=304, headers=headers)
+    headers['Content-Type'] = 'application/json'
+    if 'gzip' in request.get_header('Accept-Encoding', ''):
+        headers['Content-Encoding'] = 'gzip'
+        body = snapshot.get_gzipped_data()
+    else:
+        body = snapshot.get_data()
+    return HTTPResponse(body=body, status=200, headers=headers)
+
+
+@route('/live', apply=[websocket])
+def live_feed(ws, poll_interval=0.25, ping_interval=15):
+    '''
+    pushes to the map the changes of the layers, with their sequence number.
+    The client first sends {"since": <last sequence it applied>}, 0 if it has no data:
+    it gets the missing deltas or, if they are not available anymore, a resync message
+    with the whole layers
+    '''
+    try:
+        message = ws.receive()
+        sequence = int(json.loads(message).get('since', 0)) if message else 0
+        if sequence == 0:
+            sequence = -1
+        last_sent = time.monotonic()
+        while True:
+            deltas = geojson_publishing.snapshots.get_deltas_since(sequence)
+            if deltas is None:
+                sequence, resync = geojson_publishing.snapshots.get_resync()
+                ws.send(resync)
+                last_sent = time.monotonic()
+            elif deltas:
+                for sequence, delta in deltas:
+                    ws.send(delta)
+                last_sent = time.monotonic()
+            elif time.monotonic() - last_sent > ping_interval:
+                # lets a closed connection be noticed
+                ws.send('{"op": "ping"}')
+                last_sent = time.monotonic()
+            gevent.sleep(poll_interval)
+    except WebSocketError:
+        pass
+
+
+@route('/corrections', method='POST')
+def post_corrections():
+    '''
+    labelled tweets learned by the online filtering method:
+    {"text": ..., "label": "pos" | "neg"} or a list of them
+    '''
+    if pipeline_mode == 'processes':
+        # the filter runs in other processes, nobody would learn the corrections
+        return HTTPResponse(body='corrections are not learned when the pipeline runs as processes', status=503)
+    data = request.json
+    if isinstance(data, dict):
+        data = [data]
+    if not isinstance(data, list) or \
+            not all(isinstance(item, dict) and item.get('label') in ('pos', 'neg') and item.get('text')
+                    for item in data):
+        return HTTPResponse(body='expected {"text": ..., "label": "pos" | "neg"} or a list of them', status=400)
+    for item in data:
+        corrections.put((item['text'], item['label']))
+    return HTTPResponse(body=json.dumps({'queued': len(data)}), status=202,
+                        headers={'Content-Type': 'application/json'})
+
+
+@route('/metrics')
+def get_metrics():
+    # the metrics are formatted only here, when they are scraped
+    if supervisor is not None:
+        # the stages run in other processes, their metrics are requested and labelled by stage
+        body = supervisor.render_metrics()
+    else:
+        body = pipeline_metrics.render_metrics()
+    return HTTPResponse(body=body, status=200,
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
 
 
 @route('/')
@@ -20,42 +119,60 @@ def get_map_js():
 
 @route('/area_at_risk.geojson')
 def get_area_at_risk():
-    return static_file('area_at_risk.geojson', root="./server/geoJSON_creation/geojson_data")
+    return serve_layer('area_at_risk')
 
 
 @route('/faults.geojson')
 def get_faults():
-    return static_file('faults.geojson', root="./server/geoJSON_creation/geojson_data")
+    return serve_layer('faults')
 
 
 @route('/municipalities.geojson')
 def get_municipalities():
-    return static_file('municipalities.geojson', root="./server/geoJSON_creation/geojson_data")
+    return serve_layer('municipalities')
 
 
 @route('/tweets.geojson')
 def get_tweets():
-    return static_file('tweets.geojson', root="./server/geoJSON_creation/geojson_data")
-
-
-tweets = Queue()
-filtered_tweets = Queue()
-
-put_tweets_thread = threading.Thread(target=put_tweets_in_queue, args=(tweets,))
-filter_tweets_thread = threading.Thread(target=filter_tweets_from_queue, args=(tweets, filtered_tweets,))
-analyzer_thread = threading.Thread(target=analyze_filtered_tweets, args=(filtered_tweets,))
-
-if os.environ.get('APP_LOCATION') == 'heroku':
-    run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
-else:
-    run(host='localhost', port=8080, debug=True)
-
-
-put_tweets_thread.start()
-filter_tweets_thread.start()
-analyzer_thread.start()
-
-
-put_tweets_thread.join()
-filter_tweets_thread.join()
-analyzer_thread.join()
+    return serve_layer('tweets')
+
+
+tweets = Queue(TWEETS_QUEUE_SIZE)
+filtered_tweets = Queue(FILTERED_TWEETS_QUEUE_SIZE)
+corrections = Queue()
+# 'online' lets the filter learn the labels posted to /corrections
+classifier_type = os.environ.get('CLASSIFIER_TYPE', 'svc')
+# 'processes' runs the stages of the pipeline as processes (see multiprocess_pipeline), threads otherwise
+pipeline_mode = os.environ.get('PIPELINE_MODE', 'threads')
+# the PipelineSupervisor of the stages when pipeline_mode is 'processes'
+supervisor = None
+
+# guarded because the pipeline processes import this module again when PIPELINE_MODE is 'processes'
+if __name__ == '__main__':
+    # the layers on disk are served until the pipeline publishes new ones
+    geojson_publishing.publish_layer_files(GEOJSON_DATA_DIRECTORY)
+
+    # the pipeline must be running before the server, run blocks until the server stops
+    if pipeline_mode == 'processes':
+        # ingestion, PIPELINE_FILTERS filter replicas and the analyzer run as processes,
+        # the layers they publish are served from here. Corrections are not learned in this mode
+        supervisor = PipelineSupervisor(int(os.environ.get('PIPELINE_FILTERS', 2)), classifier_type)
+        supervisor.start()
+        atexit.register(supervisor.shutdown)
+        # when a stage exits the pipeline is started again, so the layers do not go stale
+        threading.Thread(target=supervisor.supervise, daemon=True).start()
+    else:
+        put_tweets_thread = threading.Thread(target=put_tweets_in_queue, args=(tweets,), daemon=True)
+        filter_tweets_thread = threading.Thread(target=filter_tweets_from_queue,
+                                                args=(tweets, filtered_tweets, classifier_type),
+                                                kwargs={'corrections': corrections}, daemon=True)
+        analyzer_thread = threading.Thread(target=analyze_filtered_tweets, args=(filtered_tweets,), daemon=True)
+        put_tweets_thread.start()
+        filter_tweets_thread.start()
+        analyzer_thread.start()
+
+    # the gevent server keeps the live feed connections open without blocking the other requests
+    if os.environ.get('APP_LOCATION') == 'heroku':
+        run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)), server=GeventWebSocketServer)
+    else:
+        run(host='localhost', port=8080, debug=True, server=GeventWebSocketServer)
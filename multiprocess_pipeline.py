@@ -0,0 +1,481 @@
+import argparse
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing.connection import Client, Listener, wait
+from queue import Queue, Empty
+
+import multithreading_processes
+from server.geoJSON_creation import geojson_creation, geojson_publishing
+from server.monitoring import pipeline_metrics
+
+# records sent together in a message between two stages
+BATCH_SIZE = 256
+CONNECT_TIMEOUT = 60.0
+# seconds the supervisor waits for the metrics of a stage when they are scraped
+METRICS_TIMEOUT = 2.0
+
+
+def parse_address(address: str):
+    '''
+    @param address: 'host:port'
+    @return: (host, port)
+    '''
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def connect(address, authkey, timeout=CONNECT_TIMEOUT):
+    '''
+    connects to the listener of a stage, waiting for it to start
+    '''
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return Client(tuple(address), authkey=authkey)
+        except (ConnectionRefusedError, FileNotFoundError):
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def connect_or_exit(address, authkey):
+    '''
+    connects to a stage, or ends this process if the stage cannot be reached:
+    the supervisor sees the exit and stops the pipeline, instead of the stages before this one
+    staying blocked on a full queue that nobody sends
+    '''
+    try:
+        return connect(address, authkey)
+    except (ConnectionError, OSError, multiprocessing.AuthenticationError) as e:
+        print('cannot connect to {}, exiting: {!r}'.format(address, e))
+        os._exit(1)
+
+
+def send_records(queue: Queue, address, authkey, batch_size=BATCH_SIZE):
+    '''
+    sends the records put in the queue to the stage listening at address, in batches:
+    a batch is whatever is in the queue (at most batch_size records) when the previous one was sent.
+    When the stage does not read, send blocks, the queue fills and the stage putting records in it waits.
+    A batch is sent again until it gets through, reconnecting after every error
+    '''
+    connection = connect_or_exit(address, authkey)
+    while True:
+        batch = [queue.get()]
+        try:
+            while len(batch) < batch_size:
+                batch.append(queue.get_nowait())
+        except Empty:
+            pass
+        while True:
+            try:
+                connection.send(batch)
+                break
+            except (ConnectionError, OSError):
+                print('connection to {} lost, reconnecting'.format(address))
+                connection.close()
+                connection = connect_or_exit(address, authkey)
+
+
+def receive_records(connection, queue: Queue):
+    '''
+    puts the records received from a stage in the queue, until the stage disconnects
+    '''
+    try:
+        while True:
+            for record in connection.recv():
+                queue.put(record)
+    except (EOFError, ConnectionError, OSError):
+        pass
+    finally:
+        connection.close()
+
+
+def accept_records(listener: Listener, queue: Queue):
+    '''
+    accepts the connections of the stages before this one (e.g. the filter replicas),
+    every connection is read by its own thread
+    '''
+    while True:
+        connection = listener.accept()
+        threading.Thread(target=receive_records, args=(connection, queue), daemon=True).start()
+
+
+def start_thread(target, *args):
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+def serve_metrics(metrics_address, authkey):
+    '''
+    answers every request of the supervisor with the metrics of this stage, rendered when requested
+    '''
+    connection = connect(metrics_address, authkey)
+    try:
+        connection.send(multiprocessing.current_process().name)
+        while True:
+            request = connection.recv()
+            connection.send((request, pipeline_metrics.render_metrics()))
+    except (EOFError, ConnectionError, OSError):
+        pass
+    finally:
+        connection.close()
+
+
+def accept_metrics(listener: Listener, connections: dict, lock: threading.Lock):
+    '''
+    accepts the metrics connections of the stages, they are kept by stage name
+    '''
+    try:
+        # the listener is closed when the pipeline is stopped
+        while True:
+            connection = listener.accept()
+            try:
+                stage = connection.recv()
+            except (EOFError, ConnectionError, OSError):
+                connection.close()
+                continue
+            with lock:
+                connections[stage] = connection
+    except (ConnectionError, OSError):
+        pass
+
+
+def listen(address_sender, listen_address, authkey, queue: Queue):
+    '''
+    opens the listener of a stage and reports its address to the supervisor
+    '''
+    listener = Listener(tuple(listen_address), authkey=authkey)
+    if address_sender is not None:
+        address_sender.send(listener.address)
+        address_sender.close()
+    print('{} listening on {}:{}'.format(multiprocessing.current_process().name, *listener.address))
+    start_thread(accept_records, listener, queue)
+    return listener
+
+
+def run_ingestion_stage(address_sender, downstream_addresses, authkey, stream_url=None,
+                        queue_size=multithreading_processes.TWEETS_QUEUE_SIZE, metrics_address=None):
+    '''
+    reads the stream and sends the tweets to the filter replicas;
+    a sender thread for each replica takes the tweets from the same queue, so the replicas that
+    classify faster get more of them
+    @param metrics_address: address of the supervisor the metrics of the stage are sent to when scraped
+    '''
+    if address_sender is not None:
+        address_sender.send(None)
+        address_sender.close()
+    if metrics_address is not None:
+        start_thread(serve_metrics, metrics_address, authkey)
+    tweets = Queue(queue_size)
+    for address in downstream_addresses:
+        start_thread(send_records, tweets, address, authkey)
+    multithreading_processes.put_tweets_in_queue(tweets, stream_url)
+
+
+def run_filter_stage(address_sender, listen_address, downstream_address, authkey, classifier_type='svc',
+                     cascade=False, queue_size=multithreading_processes.TWEETS_QUEUE_SIZE, metrics_address=None):
+    if metrics_address is not None:
+        start_thread(serve_metrics, metrics_address, authkey)
+    tweets = Queue(queue_size)
+    filtered_tweets = Queue(multithreading_processes.FILTERED_TWEETS_QUEUE_SIZE)
+    listen(address_sender, listen_address, authkey, tweets)
+    start_thread(send_records, filtered_tweets, downstream_address, authkey)
+    multithreading_processes.filter_tweets_from_queue(tweets, filtered_tweets, classifier_type, cascade=cascade)
+
+
+def run_analyzer_stage(address_sender, listen_address, authkey, layers_address=None, geojson_directory=None,
+                       metrics_address=None):
+    '''
+    @param layers_address: address of the supervisor the published layers are forwarded to,
+    so the web server running there serves them
+    '''
+    if metrics_address is not None:
+        start_thread(serve_metrics, metrics_address, authkey)
+    if geojson_directory is not None:
+        geojson_creation.set_geojson_data_directory(geojson_directory)
+    if layers_address is not None:
+        layers_connection = connect(layers_address, authkey)
+        lock = threading.Lock()
+
+        def forward_layer(name, features, replace):
+            if features is not None:
+                with lock:
+                    layers_connection.send((name, features, replace))
+
+        geojson_publishing.add_publish_listener(forward_layer)
+    filtered_tweets = Queue(multithreading_processes.FILTERED_TWEETS_QUEUE_SIZE)
+    listen(address_sender, listen_address, authkey, filtered_tweets)
+    multithreading_processes.analyze_filtered_tweets(filtered_tweets)
+
+
+def relay_layers(listener: Listener):
+    '''
+    publishes in this process the layers published by the analyzer process:
+    only the new features cross the connection, the content of the layers is built again here
+    '''
+    layers = {}
+    try:
+        # the listener is closed when the pipeline is stopped
+        connection = listener.accept()
+        while True:
+            name, features, replace = connection.recv()
+            content = layers.get(name)
+            if content is None:
+                content = geojson_creation.LayerContent(name)
+                layers[name] = content
+            if replace:
+                content.replace(features)
+            else:
+                content.extend(features)
+            geojson_publishing.publish_layer(name, content.get_data(), features, replace)
+    except (EOFError, ConnectionError, OSError):
+        pass
+
+
+class PipelineSupervisor:
+    """
+    Runs the stages of the pipeline as processes: the ingestion, filter_replicas filter
+    processes and the analyzer, so GDAL, sklearn and JSON parsing do not share a GIL.
+    Stages exchange batches of TweetUsefulInfos (pickled as compact tuples) over
+    multiprocessing.connection sockets authenticated with a random key; every stage keeps its
+    bounded queues, so a slow stage stops reading its socket and the ones before it wait.
+    The layers published by the analyzer are published again in the supervisor process,
+    where the web server runs, and render_metrics collects the metrics of every stage there.
+    If a stage exits, all the others are stopped, and supervise starts the pipeline again.
+    Stages listen on host, so with a host reachable from other nodes the same stage functions
+    can be started by hand on different machines (see the command line options).
+    """
+
+    def __init__(self, filter_replicas=2, classifier_type='svc', cascade=False, stream_url=None, host='127.0.0.1',
+                 relay_layers=True, geojson_directory=None, start_method='spawn', relay_metrics=True):
+        self.__filter_replicas = filter_replicas
+        self.__classifier_type = classifier_type
+        self.__cascade = cascade
+        self.__stream_url = stream_url
+        self.__host = host
+        self.__relay_layers = relay_layers
+        self.__geojson_directory = geojson_directory
+        self.__context = multiprocessing.get_context(start_method)
+        self.__authkey = os.urandom(16)
+        self.__processes = []
+        self.__layers_listener = None
+        self.__relay_metrics = relay_metrics
+        self.__metrics_listener = None
+        # stage name -> connection its metrics are requested on
+        self.__metrics_connections = {}
+        # not the lock of the stages, so a scrape does not wait for a restart
+        self.__metrics_lock = threading.Lock()
+        self.__metrics_requests = 0
+        # held while the stages are started or stopped, shutdown and supervise can run in different threads
+        self.__lock = threading.RLock()
+        self.__shutdown = threading.Event()
+
+    def get_processes(self):
+        return self.__processes
+
+    def __start_stage(self, name, target, *args):
+        '''
+        @return: the address the stage listens on, None if it does not listen
+        '''
+        address_receiver, address_sender = self.__context.Pipe(duplex=False)
+        process = self.__context.Process(target=target, name=name, args=(address_sender,) + args)
+        process.start()
+        address_sender.close()
+        self.__processes.append(process)
+        # the stage answers when it is listening, or the pipe is closed if it dies before
+        try:
+            return address_receiver.recv()
+        except EOFError:
+            raise RuntimeError('stage {} exited with code {} while starting'.format(name, process.exitcode))
+        finally:
+            address_receiver.close()
+
+    def start(self):
+        '''
+        starts the stages, each one after the stage it sends its records to
+        '''
+        with self.__lock:
+            self.__start()
+
+    def __start(self):
+        layers_address = None
+        if self.__relay_layers:
+            self.__layers_listener = Listener((self.__host, 0), authkey=self.__authkey)
+            layers_address = self.__layers_listener.address
+            start_thread(relay_layers, self.__layers_listener)
+        metrics_address = None
+        if self.__relay_metrics:
+            self.__metrics_listener = Listener((self.__host, 0), authkey=self.__authkey)
+            metrics_address = self.__metrics_listener.address
+            start_thread(accept_metrics, self.__metrics_listener, self.__metrics_connections, self.__metrics_lock)
+        try:
+            analyzer_address = self.__start_stage('analyzer', run_analyzer_stage, (self.__host, 0), self.__authkey,
+                                                  layers_address, self.__geojson_directory, metrics_address)
+            filter_addresses = [self.__start_stage('filter-{}'.format(i), run_filter_stage, (self.__host, 0),
+                                                   analyzer_address, self.__authkey, self.__classifier_type,
+                                                   self.__cascade, multithreading_processes.TWEETS_QUEUE_SIZE,
+                                                   metrics_address)
+                                for i in range(self.__filter_replicas)]
+            self.__start_stage('ingestion', run_ingestion_stage, filter_addresses, self.__authkey,
+                               self.__stream_url, multithreading_processes.TWEETS_QUEUE_SIZE, metrics_address)
+        except BaseException:
+            self.__stop()
+            raise
+
+    def wait(self, timeout=None):
+        '''
+        blocks until a stage exits
+        @return: the exited process, None after timeout or if no stage is running
+        '''
+        sentinels = {process.sentinel: process for process in self.__processes}
+        if not sentinels:
+            return None
+        ready = wait(list(sentinels), timeout)
+        return sentinels[ready[0]] if ready else None
+
+    def stop(self, timeout=5.0):
+        '''
+        stops the stages, from the first to the last
+        '''
+        with self.__lock:
+            self.__stop(timeout)
+
+    def __stop(self, timeout=5.0):
+        for process in reversed(self.__processes):
+            if process.is_alive():
+                process.terminate()
+        for process in reversed(self.__processes):
+            process.join(timeout)
+            if process.is_alive():
+                process.kill()
+                process.join()
+        self.__processes = []
+        if self.__layers_listener is not None:
+            self.__layers_listener.close()
+            self.__layers_listener = None
+        if self.__metrics_listener is not None:
+            self.__metrics_listener.close()
+            self.__metrics_listener = None
+        with self.__metrics_lock:
+            for connection in self.__metrics_connections.values():
+                connection.close()
+            self.__metrics_connections.clear()
+
+    def render_metrics(self):
+        '''
+        requests the metrics of every stage and merges them with the ones of this process,
+        told apart by the stage label (stage="supervisor" for this process); a stage that does not
+        answer within METRICS_TIMEOUT is left out
+        @return: the metrics in the Prometheus text format
+        '''
+        rendered = [('supervisor', pipeline_metrics.render_metrics())]
+        with self.__metrics_lock:
+            self.__metrics_requests += 1
+            request = self.__metrics_requests
+            for stage, connection in sorted(self.__metrics_connections.items()):
+                try:
+                    connection.send(request)
+                    while connection.poll(METRICS_TIMEOUT):
+                        answered_request, text = connection.recv()
+                        # late answers to the requests that timed out before are skipped
+                        if answered_request == request:
+                            rendered.append((stage, text))
+                            break
+                except (EOFError, ConnectionError, OSError):
+                    connection.close()
+                    del self.__metrics_connections[stage]
+        return pipeline_metrics.merge_rendered_metrics(rendered)
+
+    def shutdown(self):
+        '''
+        stops the stages for good, supervise returns without starting them again
+        '''
+        self.__shutdown.set()
+        self.stop()
+
+    def supervise(self, max_restarts=5, restart_delay=1.0, max_restart_delay=60.0):
+        '''
+        waits for a stage to exit, then stops the pipeline and starts it again,
+        after a delay that doubles up to max_restart_delay. Blocks until shutdown is called
+        or the stages exited max_restarts times (None to always restart): then they are left stopped
+        @return: the number of restarts
+        '''
+        restarts = 0
+        delay = restart_delay
+        while not self.__shutdown.is_set():
+            process = self.wait()
+            if self.__shutdown.is_set():
+                break
+            if process is None:
+                # no stage is running, e.g. a restart failed
+                process_description = 'no stage running'
+            else:
+                process_description = 'stage {} exited with code {}'.format(process.name, process.exitcode)
+            self.stop()
+            if max_restarts is not None and restarts >= max_restarts:
+                print('{}, pipeline stopped after {} restarts'.format(process_description, restarts))
+                break
+            print('{}, restarting the pipeline in {:.1f} s'.format(process_description, delay))
+            if self.__shutdown.wait(delay):
+                break
+            delay = min(delay * 2, max_restart_delay)
+            restarts += 1
+            try:
+                with self.__lock:
+                    if not self.__shutdown.is_set():
+                        self.__start()
+            except Exception as e:
+                print('the pipeline did not start again:', repr(e))
+        return restarts
+
+    def run(self):
+        '''
+        starts the stages and supervises them until one of them exits or the process is interrupted
+        '''
+        self.start()
+        try:
+            process = self.wait()
+            print('stage {} exited with code {}, stopping the pipeline'.format(process.name, process.exitcode))
+        except KeyboardInterrupt:
+            print('stopping the pipeline')
+        finally:
+            self.stop()
+
+
+if __name__ == '__main__':
+    '''
+        runs the whole pipeline as processes on this machine, e.g.
+        python multiprocess_pipeline.py --filters 3
+        or a single stage, to spread them on more machines (PIPELINE_AUTHKEY must be the same), e.g.
+        python multiprocess_pipeline.py --stage analyzer --listen 0.0.0.0:7001
+        python multiprocess_pipeline.py --stage filter --listen 0.0.0.0:7002 --downstream analyzer-host:7001
+        python multiprocess_pipeline.py --stage ingestion --downstream filter-host:7002
+    '''
+    parser = argparse.ArgumentParser(description='runs the pipeline stages as processes')
+    parser.add_argument('--stage', choices=['ingestion', 'filter', 'analyzer'],
+                        help='runs only this stage, all of them under a supervisor if not given')
+    parser.add_argument('--filters', type=int, default=2, help='filter replicas started by the supervisor')
+    parser.add_argument('--classifier', choices=['svc', 'linear', 'online'], default='svc')
+    parser.add_argument('--cascade', action='store_true')
+    parser.add_argument('--stream-url', help='stand-in stream read instead of Twitter')
+    parser.add_argument('--listen', default='127.0.0.1:0', help='host:port the stage listens on')
+    parser.add_argument('--downstream', nargs='+', default=[], help='host:port of the next stages')
+    args = parser.parse_args()
+
+    if args.stage is None:
+        PipelineSupervisor(args.filters, args.classifier, args.cascade, args.stream_url).run()
+    else:
+        key = os.environ.get('PIPELINE_AUTHKEY')
+        if not key:
+            raise SystemExit('PIPELINE_AUTHKEY must be set to run a single stage')
+        key = key.encode('utf-8')
+        downstream = [parse_address(address) for address in args.downstream]
+        if args.stage == 'ingestion':
+            run_ingestion_stage(None, downstream, key, args.stream_url)
+        elif args.stage == 'filter':
+            run_filter_stage(None, parse_address(args.listen), downstream[0], key, args.classifier, args.cascade)
+        else:
+            run_analyzer_stage(None, parse_address(args.listen), key)
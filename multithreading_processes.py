@@ -1,35 +1,101 @@
 import os
 import shutil
 import threading
+import time
 from datetime import datetime, timedelta
-from queue import Queue
+from math import ceil
+from queue import Queue, Empty
 from typing import List
 
-from server.earthquake_information import earthquake_faults_finder, risking_area_finder
+from server.earthquake_information import risking_area_finder, faults_catalogue, gazetteer, geoparsing, \
+    incremental_analysis, fault_exposure
+from server.earthquake_information.earthquake_faults_finder import StreamingPointClusterizer
 from server.geoJSON_creation import geojson_creation
+from server.monitoring import pipeline_metrics
+from server.tweet_handling.DamageTweetFM.DamageTweetFM import DamageTweetFM
 from server.tweet_handling.EarthquakeTweetFM.EarthquakeTweetFM import EarthquakeTweetFM
-from server.tweet_handling.tweet_filtering import TweetFilter
-from server.tweet_handling.tweet_retriever import put_tweets_in_queue_rt
+from server.tweet_handling.OnlineTweetFM.OnlineTweetFM import OnlineTweetFM
+from server.tweet_handling.cascade_filtering import create_cascade_fm
+from server.tweet_handling.tweet_batching import TweetBatcher
+from server.tweet_handling.tweet_filtering import TweetFilter, ParallelTweetFilter
+from server.tweet_handling.tweet_retriever import put_tweets_in_queue_async, HTTPStreamSource, TwitterStreamSource
+
+# bounds of the queues between the stages: when a stage falls behind, the ones before it wait
+TWEETS_QUEUE_SIZE = 10000
+FILTERED_TWEETS_QUEUE_SIZE = 10000
 
 
 class EarthquakeDetection:
-    def __init__(self, number_of_earthquakes: int, time_window: timedelta):
+    """
+    Counts the tweets posted in the last time_window using a ring of
+    per-bucket counters (one bucket per bucket_width, one second by default),
+    so memory is constant and adding a tweet or checking the window is O(1) amortized.
+    """
+
+    def __init__(self, number_of_earthquakes: int, time_window: timedelta,
+                 bucket_width: timedelta = timedelta(seconds=1)):
         self.earthquakes = number_of_earthquakes
         self.time_window = time_window
-        self.tweets_in_time_window = []
+        self.bucket_width = bucket_width.total_seconds()
         self.last_tweet_time_added = None
+        self.__buckets_number = max(1, int(ceil(time_window.total_seconds() / self.bucket_width)))
+        self.__counts = [0] * self.__buckets_number
+        # absolute id of the bucket currently stored in every slot of the ring
+        self.__bucket_ids = [None] * self.__buckets_number
+        self.__tweets_in_time_window = 0
+        self.__newest_bucket = None
+        self.__oldest_bucket = None
+
+    def __bucket_of(self, tweet_datetime: datetime):
+        return int(tweet_datetime.timestamp() // self.bucket_width)
+
+    def __expire_buckets(self):
+        # empties the buckets that left the window since the last call;
+        # every bucket is emptied once, at most a full ring per call
+        first_valid_bucket = self.__newest_bucket - self.__buckets_number + 1
+        if first_valid_bucket - self.__oldest_bucket >= self.__buckets_number:
+            # the whole window has been left behind
+            self.__counts = [0] * self.__buckets_number
+            self.__bucket_ids = [None] * self.__buckets_number
+            self.__tweets_in_time_window = 0
+        else:
+            for bucket in range(self.__oldest_bucket, first_valid_bucket):
+                slot = bucket % self.__buckets_number
+                if self.__bucket_ids[slot] == bucket:
+                    self.__tweets_in_time_window -= self.__counts[slot]
+                    self.__counts[slot] = 0
+                    self.__bucket_ids[slot] = None
+        self.__oldest_bucket = max(self.__oldest_bucket, first_valid_bucket)
 
     def put_tweets_datetimes(self, tweets_datetimes: List[datetime]):
         self.last_tweet_time_added = tweets_datetimes[-1]
-        self.tweets_in_time_window += tweets_datetimes
+        for tweet_datetime in tweets_datetimes:
+            if tweet_datetime is None:
+                continue
+            bucket = self.__bucket_of(tweet_datetime)
+            if self.__newest_bucket is None:
+                self.__newest_bucket = bucket
+                self.__oldest_bucket = bucket - self.__buckets_number + 1
+            elif bucket > self.__newest_bucket:
+                self.__newest_bucket = bucket
+                self.__expire_buckets()
+            elif bucket < self.__oldest_bucket:
+                # already out of the time window
+                continue
+            slot = bucket % self.__buckets_number
+            if self.__bucket_ids[slot] != bucket:
+                self.__tweets_in_time_window -= self.__counts[slot]
+                self.__bucket_ids[slot] = bucket
+                self.__counts[slot] = 0
+            self.__counts[slot] += 1
+            self.__tweets_in_time_window += 1
 
-    def is_detected(self):
-        # removes elements not in timewindow
-        while self.last_tweet_time_added - self.time_window > self.tweets_in_time_window[0]:
-            self.tweets_in_time_window.pop(0)
+    def get_tweets_in_time_window(self):
+        return self.__tweets_in_time_window
 
+    def is_detected(self):
         # checks if elements in timewindow are enough to say that an earthquake is detected
-        if len(self.tweets_in_time_window) >= self.earthquakes:
+        if self.__tweets_in_time_window >= self.earthquakes:
             is_detected = True
         else:
             is_detected = False
@@ -50,80 +116,223 @@ def __pop_tweets_and_datetimes(filtered_tweets, tweets_2_analyze, tweets_2_analy
             tweets_2_analyze_datetimes.append(filtered_tweet.get_time_posted())
 
 
-def __create_geojsons(tweet_list):
-    geojson_creation.object_list_to_geojson_file('tweets', tweet_list)
-    faults_finder = earthquake_faults_finder.EarthquakeFaultsFinder()
-    gdal_points = []
-    for tweet in tweet_list:
-        geom = tweet.get_geometry()
-        if geom is not None:
-            gdal_points.append(geom)
-    if len(gdal_points) != 0:
-        faults = faults_finder.find_candidate_faults(gdal_points)
+def __write_new_tweets(tweet_list, tweets_written):
+    '''
+    writes the tweets layer: only the tweets added after the last call are appended
+    @param tweets_written: number of tweets of the list already in the file, 0 to rewrite it
+    @return: number of tweets of the list now in the file
+    '''
+    if tweets_written == 0:
+        geojson_creation.object_list_to_geojson_file('tweets', tweet_list)
+    elif len(tweet_list) > tweets_written:
+        geojson_creation.append_objects_to_geojson_file('tweets', tweet_list[tweets_written:])
+    return len(tweet_list)
+
+
+def __create_geojsons(ranking: incremental_analysis.IncrementalFaultsRanking):
+    start = time.perf_counter()
+    faults = ranking.get_faults()
+    if len(faults) != 0:
         geojson_creation.object_list_to_geojson_file('faults', faults)
 
         riskfinder = risking_area_finder.RiskingAreaFinder()
         area = riskfinder.find_risking_area(faults)
         geojson_creation.object_list_to_geojson_file('area_at_risk', [area])
         geojson_creation.object_list_to_geojson_file('municipalities', area.get_municipalities())
+    ranking.mark_published()
+    pipeline_metrics.create_geojsons_seconds.observe(time.perf_counter() - start)
 
 
-def put_tweets_in_queue(tweets: Queue):
-    put_tweets_in_queue_rt(tweets, words_to_track=['terremoto'])
+def __retain_new_tweets(new_tweets, retention, ranking, tweets_written):
+    '''
+    moves the new tweets in the retention and in the faults ranking and drops the expired ones,
+    the tweets layer is rewritten only if some tweets were dropped
+    @return: number of retained tweets now in the tweets layer
+    '''
+    retention.add(new_tweets)
+    ranking.add_tweets(new_tweets)
+    new_tweets.clear()
+    expired = retention.expire()
+    if expired:
+        ranking.remove_oldest(sum(1 for tweet in expired if tweet.has_location()))
+        pipeline_metrics.tweets_expired.inc(len(expired))
+        tweets_written = 0
+    pipeline_metrics.tweets_retained.set(len(retention))
+    return __write_new_tweets(retention.get_tweets(), tweets_written)
 
 
-def filter_tweets_from_queue(tweets: Queue, filtered_tweets: Queue):
-    tweet_filter = TweetFilter(EarthquakeTweetFM())
+def put_tweets_in_queue(tweets: Queue, stream_url=None):
+    '''
+    @param stream_url: url of a stand-in stream (see stream_server) read instead of Twitter,
+    TWEET_STREAM_URL if None
+    '''
+    stream_url = stream_url or os.environ.get('TWEET_STREAM_URL')
+    if stream_url:
+        source = HTTPStreamSource(stream_url)
+    else:
+        source = TwitterStreamSource(words_to_track=['terremoto'])
+    put_tweets_in_queue_async(tweets, source)
+
+
+def __learn_corrections(corrections: Queue, tweet_filter: TweetFilter):
+    '''
+    gives the (text, label) couples waiting in the queue to the filtering method
+    '''
+    texts = []
+    labels = []
     while True:
-        tweet_array = []
-        # blocks until the queue is not empty
-        tweet = tweets.get()
-        tweet_array.append(tweet)
-        # checks if queue has more than 1 tweet
-        while not tweets.empty():
-            tweet = tweets.get()
-            tweet_array.append(tweet)
-        positives = tweet_filter.get_all_positives(tweet_array)
-        for positive in positives:
-            print(positive)
-            filtered_tweets.put(positive)
-
-
-def analyze_filtered_tweets(filtered_tweets: Queue):
+        try:
+            text, label = corrections.get_nowait()
+        except Empty:
+            break
+        texts.append(text)
+        labels.append(label)
+    if not texts:
+        return
+    if tweet_filter.filtering_method.partial_fit(texts, labels):
+        # the cached labels may have been changed by what has been learned
+        if tweet_filter.label_cache is not None:
+            tweet_filter.label_cache.clear()
+    else:
+        print('{} corrections ignored: the filtering method cannot learn online'.format(len(texts)))
+
+
+def __put_positives(tweet_array, get_positives, start, filtered_tweets: Queue, geoparser):
+    '''
+    waits for the labels of a batch and puts its positive tweets in the queue
+    @param start: time the classification of the batch started
+    '''
+    positives = get_positives()
+    pipeline_metrics.classifier_batch_seconds.observe(time.perf_counter() - start)
+    pipeline_metrics.classifier_batch_size.observe(len(tweet_array))
+    pipeline_metrics.tweets_classified.inc(len(tweet_array))
+    pipeline_metrics.tweets_positive.inc(len(positives))
+    if geoparser is not None:
+        pipeline_metrics.tweets_geoparsed.inc(geoparser.locate_tweets(positives))
+    for positive in positives:
+        print(positive)
+        filtered_tweets.put(positive)
+
+
+def filter_tweets_from_queue(tweets: Queue, filtered_tweets: Queue, classifier_type='svc',
+                             max_batch_size=256, max_wait=0.05, workers=0, cascade=False,
+                             corrections: Queue = None, geoparse=True):
+    # with cascade, a keyword prefilter runs before EarthquakeTweetFM and DamageTweetFM labels the positives.
+    # with classifier_type 'online' OnlineTweetFM is used, and it learns the (text, label) put in corrections.
+    # with geoparse, positive tweets without a place are located by the place names in their text
+    if cascade:
+        filtering_method_factory = create_cascade_fm
+    elif classifier_type == 'online':
+        filtering_method_factory = OnlineTweetFM
+    else:
+        filtering_method_factory = EarthquakeTweetFM
+    damage_method = DamageTweetFM() if cascade else None
+    if workers:
+        # every worker process loads its own model, labels come back in order
+        tweet_filter = ParallelTweetFilter(filtering_method_factory, workers=workers,
+                                           factory_kwargs={'classifier_type': classifier_type},
+                                           damage_method=damage_method)
+    else:
+        filtering_method = filtering_method_factory(classifier_type=classifier_type)
+        filtering_method.warm_up()
+        tweet_filter = TweetFilter(filtering_method, damage_method=damage_method)
+    if damage_method is not None:
+        damage_method.warm_up()
+    if corrections is not None and workers:
+        print('corrections are not learned by the worker processes')
+        corrections = None
+    geoparser = geoparsing.get_geoparser() if geoparse else None
+    batcher = TweetBatcher(tweets, max_batch_size=max_batch_size, max_wait=max_wait)
+    pipeline_metrics.register_queue_depth('tweets', tweets)
+    pipeline_metrics.register_queue_depth('filtered_tweets', filtered_tweets)
+    # batch being classified: (tweets, callable returning the positives, start time)
+    pending = None
+    while True:
+        if pending is not None and tweets.empty():
+            # nothing to collect meanwhile, the batch being classified is not kept waiting
+            __put_positives(*pending, filtered_tweets, geoparser)
+            pending = None
+        # blocks until the queue is not empty, then waits at most max_wait for a full batch
+        tweet_array = batcher.next_batch()
+        if corrections is not None:
+            __learn_corrections(corrections, tweet_filter)
+        # with worker processes this batch is classified while the previous one is put in filtered_tweets
+        submitted = (tweet_array, tweet_filter.start_filtering(tweet_array), time.perf_counter())
+        if pending is not None:
+            __put_positives(*pending, filtered_tweets, geoparser)
+        pending = submitted
+        if batcher.get_batches_number() % 100 == 0:
+            print(batcher)
+            if tweet_filter.label_cache is not None:
+                print(tweet_filter.label_cache)
+            if cascade and not workers:
+                print(tweet_filter.filtering_method)
+
+
+def analyze_filtered_tweets(filtered_tweets: Queue, retention_time=timedelta(hours=2), max_tweets=20000,
+                            tolerance=0.05, cluster_km=10.0):
+    '''
+    @param retention_time: tweets posted before are dropped from the analysis and from the tweets layer
+    @param max_tweets: maximum number of tweets kept, the oldest are dropped
+    @param tolerance: faults, area at risk and municipalities are computed again only if the most probable
+    faults change or one of their probabilities moves more than this
+    @param cluster_km: tweets closer than this are in the same cluster
+    '''
     # we detect an earthquake if 5 tweets are posted in the last 5 minutes
     detection = EarthquakeDetection(number_of_earthquakes=5, time_window=timedelta(seconds=5 * 60))
+    # the fault catalogue, the gazetteer and the exposure of the faults are read now,
+    # not when the first earthquake is detected
+    faults_catalogue.load_faults_catalogues()
+    gazetteer.get_gazetteer()
+    fault_exposure.get_fault_exposure()
+    geojson_creation.add_write_listener(pipeline_metrics.record_layer_write)
+    retention = incremental_analysis.TweetRetention(ttl=retention_time, max_tweets=max_tweets)
+    # faults are scored against the clusters of the tweets, updated with the new tweets only
+    ranking = incremental_analysis.IncrementalFaultsRanking(tolerance=tolerance,
+                                                            clusterizer=StreamingPointClusterizer(eps_km=cluster_km))
     tweets_2_analyze = []
     tweets_2_analyze_datetimes = []
+    tweets_written = 0
     detected_previously = False
     while True:
         # this is made in order to block this thread
         __pop_tweets_and_datetimes(filtered_tweets, tweets_2_analyze, tweets_2_analyze_datetimes)
         if tweets_2_analyze_datetimes:
             detection.put_tweets_datetimes(tweets_datetimes=tweets_2_analyze_datetimes)
+            pipeline_metrics.tweets_in_time_window.set(detection.get_tweets_in_time_window())
             tweets_2_analyze_datetimes = []
-        if tweets_2_analyze:
-            geojson_creation.object_list_to_geojson_file('tweets', tweets_2_analyze)
+        tweets_written = __retain_new_tweets(tweets_2_analyze, retention, ranking, tweets_written)
         while detection.is_detected():
             print("detected")
+            if not detected_previously:
+                pipeline_metrics.detections.inc()
+                # the first layers of the detection are always written
+                __create_geojsons(ranking)
             detected_previously = True
             # this is made in order to block this thread
             __pop_tweets_and_datetimes(filtered_tweets, tweets_2_analyze, tweets_2_analyze_datetimes)
-            if tweets_2_analyze:
-                __create_geojsons(tweets_2_analyze)
+            tweets_written = __retain_new_tweets(tweets_2_analyze, retention, ranking, tweets_written)
+            if ranking.is_update_needed():
+                __create_geojsons(ranking)
+            else:
+                pipeline_metrics.faults_updates_skipped.inc()
             if tweets_2_analyze_datetimes:
                 detection.put_tweets_datetimes(tweets_datetimes=tweets_2_analyze_datetimes)
+                pipeline_metrics.tweets_in_time_window.set(detection.get_tweets_in_time_window())
                 tweets_2_analyze_datetimes = []
         print("not detected")
         if detected_previously:
             save_geoJSON_in_folder()
-            tweets_2_analyze = []
+            retention.clear()
+            ranking.clear()
             tweets_2_analyze_datetimes = []
+            tweets_written = 0
             detected_previously = False
 
 def save_geoJSON_in_folder():
     # make dir with datatime as name
     directory = str(datetime.now())
-    parent_dir = "server/geoJSON_creation/geojson_data/"
+    parent_dir = geojson_creation.GEOJSON_DATA_DIRECTORY
     path = os.path.join(parent_dir, directory)
     os.mkdir(path)
 
@@ -136,8 +345,8 @@ def save_geoJSON_in_folder():
 
 
 if __name__ == "__main__":
-    tweets = Queue()
-    filtered_tweets = Queue()
+    tweets = Queue(TWEETS_QUEUE_SIZE)
+    filtered_tweets = Queue(FILTERED_TWEETS_QUEUE_SIZE)
 
     put_tweets_thread = threading.Thread(target=put_tweets_in_queue, args=(tweets,))
     filter_tweets_thread = threading.Thread(target=filter_tweets_from_queue, args=(tweets, filtered_tweets,))
@@ -0,0 +1,175 @@
+import argparse
+import tempfile
+import threading
+import time
+from queue import Queue
+
+import numpy as np
+
+import multithreading_processes
+from server.geoJSON_creation import geojson_creation
+from server.tweet_handling.tweet_replay import TweetReplayer, read_jsonl_corpus, read_labelled_csv_corpus, \
+    EARTHQUAKE_DATASET
+
+
+class StageQueue(Queue):
+    """
+    Queue that records how many items were taken from it and when the first
+    and the last one were taken, to measure the throughput of the stage reading it.
+    """
+
+    def __init__(self, maxsize=0):
+        super().__init__(maxsize)
+        self.gets = 0
+        self.first_get_time = None
+        self.last_get_time = None
+
+    def _get(self):
+        item = super()._get()
+        now = time.perf_counter()
+        if self.first_get_time is None:
+            self.first_get_time = now
+        self.last_get_time = now
+        self.gets += 1
+        return item
+
+    def get_throughput(self):
+        if self.gets < 2 or self.last_get_time <= self.first_get_time:
+            return 0.0
+        return self.gets / (self.last_get_time - self.first_get_time)
+
+
+class LayerWritesRecorder:
+    """
+    Listens to the GeoJSON writes: for every tweet written in the tweets layer
+    it records the latency from the moment it was replayed, and it keeps
+    the time of the first faults layer (the first detection).
+    """
+
+    def __init__(self, replayer: TweetReplayer):
+        self.replayer = replayer
+        self.latencies = []
+        self.written_tweets = set()
+        self.first_write_time = None
+        self.last_write_time = None
+        self.detection_time = None
+        self.lock = threading.Lock()
+
+    def __call__(self, filename, object_list, replace):
+        now = time.perf_counter()
+        with self.lock:
+            self.last_write_time = now
+            if filename == 'faults' and self.detection_time is None and object_list:
+                self.detection_time = now
+            if filename != 'tweets':
+                return
+            if self.first_write_time is None:
+                self.first_write_time = now
+            for tweet in object_list:
+                put_time = self.replayer.get_put_time(tweet)
+                # a rewrite contains tweets already written
+                if put_time is not None and id(tweet) not in self.written_tweets:
+                    self.written_tweets.add(id(tweet))
+                    self.latencies.append(now - put_time)
+
+    def get_throughput(self):
+        if len(self.latencies) < 2 or self.last_write_time <= self.first_write_time:
+            return 0.0
+        return len(self.latencies) / (self.last_write_time - self.first_write_time)
+
+
+def wait_for_pipeline(replayer, tweets, filtered_tweets, recorder, settle=2.0, timeout=None):
+    '''
+    waits until the whole corpus has been replayed, the queues are empty
+    and nothing has been written for settle seconds
+    '''
+    deadline = None if timeout is None else time.perf_counter() + timeout
+    replayer.wait(timeout)
+    while deadline is None or time.perf_counter() < deadline:
+        time.sleep(0.1)
+        if not tweets.empty() or not filtered_tweets.empty():
+            continue
+        last_activity = max(recorder.last_write_time or 0.0, tweets.last_get_time or 0.0,
+                            filtered_tweets.last_get_time or 0.0, replayer.get_end_time())
+        if time.perf_counter() - last_activity >= settle:
+            return True
+    return False
+
+
+def print_report(replayer, tweets, filtered_tweets, recorder):
+    print('replayed {} tweets at {} speed'.format(len(replayer.get_replayed()),
+                                                  '{}x'.format(replayer.get_speed()) if replayer.get_speed()
+                                                  else 'maximum'))
+    print('{:<12} {:>10} {:>14}'.format('stage', 'tweets', 'tweets/sec'))
+    for stage, number, throughput in [('replay', len(replayer.get_replayed()), replayer.get_throughput()),
+                                      ('filter', tweets.gets, tweets.get_throughput()),
+                                      ('analyzer', filtered_tweets.gets, filtered_tweets.get_throughput()),
+                                      ('geojson', len(recorder.latencies), recorder.get_throughput())]:
+        print('{:<12} {:>10} {:>14.1f}'.format(stage, number, throughput))
+    if recorder.detection_time is None:
+        print('no earthquake detected')
+    else:
+        print('time to detection: {:.2f} s from the replay start (corpus time {})'.format(
+            recorder.detection_time - replayer.get_start_time(),
+            replayer.get_corpus_time(recorder.detection_time)))
+    if recorder.latencies:
+        latencies = np.array(recorder.latencies) * 1000
+        print('end to end latency (ms): mean {:.1f}, p50 {:.1f}, p90 {:.1f}, p99 {:.1f}, max {:.1f}'.format(
+            latencies.mean(), *np.percentile(latencies, [50, 90, 99]), latencies.max()))
+
+
+def run_replay(corpus, speed=1.0, classifier_type='svc', workers=0, cascade=False, output_directory=None,
+               settle=2.0, timeout=None):
+    '''
+    runs the filtering and the analysis threads of multithreading_processes
+    on a replayed corpus and prints the throughput of every stage,
+    the time to the first detection and the end to end latencies.
+    Layers are written in output_directory (a temporary one if None), not in the served one
+    '''
+    geojson_creation.set_geojson_data_directory(output_directory or tempfile.mkdtemp(prefix='replay_geojson_'))
+    tweets = StageQueue()
+    filtered_tweets = StageQueue()
+    replayer = TweetReplayer(corpus, tweets, speed)
+    recorder = LayerWritesRecorder(replayer)
+    geojson_creation.add_write_listener(recorder)
+
+    filter_tweets_thread = threading.Thread(target=multithreading_processes.filter_tweets_from_queue,
+                                            args=(tweets, filtered_tweets, classifier_type),
+                                            kwargs={'workers': workers, 'cascade': cascade}, daemon=True)
+    analyzer_thread = threading.Thread(target=multithreading_processes.analyze_filtered_tweets,
+                                       args=(filtered_tweets,), daemon=True)
+    filter_tweets_thread.start()
+    analyzer_thread.start()
+    replayer.run()
+    if not wait_for_pipeline(replayer, tweets, filtered_tweets, recorder, settle, timeout):
+        print('the pipeline did not finish in {} s'.format(timeout))
+    geojson_creation.remove_write_listener(recorder)
+    print_report(replayer, tweets, filtered_tweets, recorder)
+    return replayer, recorder
+
+
+if __name__ == '__main__':
+    '''
+        replays a corpus through the pipeline without the network, e.g.
+        python replay_benchmark.py --speed 10
+        python replay_benchmark.py --jsonl tweets.jsonl --speed 0
+    '''
+    parser = argparse.ArgumentParser(description='replays a tweet corpus through the detection pipeline')
+    parser.add_argument('--jsonl', help='file with a tweet JSON on every line')
+    parser.add_argument('--csv', nargs='+', default=[EARTHQUAKE_DATASET],
+                        help='labelled datasets used when --jsonl is not given')
+    parser.add_argument('--rate', type=float, default=2.0, help='tweets per second of the synthetic corpus')
+    parser.add_argument('--speed', type=float, default=1.0, help='1 is real time, 0 the maximum speed')
+    parser.add_argument('--classifier', choices=['svc', 'linear', 'online'], default='svc')
+    parser.add_argument('--workers', type=int, default=0)
+    parser.add_argument('--cascade', action='store_true')
+    parser.add_argument('--output', help='directory of the GeoJSON layers, a temporary one by default')
+    parser.add_argument('--timeout', type=float)
+    args = parser.parse_args()
+
+    if args.jsonl:
+        replay_corpus = read_jsonl_corpus(args.jsonl)
+    else:
+        replay_corpus = read_labelled_csv_corpus(args.csv, tweets_per_second=args.rate)
+    run_replay(replay_corpus, speed=args.speed, classifier_type=args.classifier, workers=args.workers,
+               cascade=args.cascade, output_directory=args.output, timeout=args.timeout)
@@ -0,0 +1,41 @@
+import os
+
+from server.earthquake_information.cities500.cities2shapefile import cityStr2Dict
+from server.earthquake_information.gazetteer import GAZETTEER_DIRECTORY, build_gazetteer, \
+    load_gazetteer_from_shapefile, write_gazetteer
+
+CITIES_TEXT = 'server/earthquake_information/cities500/cities500.txt'
+
+
+def load_gazetteer_from_text(path=CITIES_TEXT, country_code='IT'):
+    '''
+    @param path: GeoNames cities500.txt dump
+    @param country_code: only the places of this country are kept
+    '''
+    lon, lat, population, names, provinces, countries = [], [], [], [], [], []
+    with open(path, 'r', encoding='utf') as f:
+        for line in f:
+            city = cityStr2Dict(line)
+            if city['country code'] == country_code:
+                lon.append(float(city['longitude']))
+                lat.append(float(city['latitude']))
+                population.append(int(city['population'] or 0))
+                names.append(city['name'])
+                provinces.append(city['admin2 code'])
+                countries.append(city['country code'])
+    return build_gazetteer(lon, lat, population, names, provinces, countries)
+
+
+if __name__ == '__main__':
+    '''
+    builds the compact gazetteer used by RiskingAreaFinder, from cities500.txt
+    if it has been downloaded, otherwise from cities500_IT.shp.
+    Run it from the repository root.
+    '''
+    if os.path.isfile(CITIES_TEXT):
+        gazetteer = load_gazetteer_from_text()
+    else:
+        gazetteer = load_gazetteer_from_shapefile()
+    # the gazetteer built before, if any, is replaced
+    write_gazetteer(gazetteer, replace=True)
+    print('written {} places in {}'.format(len(gazetteer), GAZETTEER_DIRECTORY))
@@ -1,9 +1,62 @@
+from math import ceil, cos, floor, radians
+
 import numpy as np
 from osgeo import ogr
 from scipy.spatial.qhull import ConvexHull
 from sklearn.cluster import DBSCAN
 from sklearn.preprocessing import StandardScaler
 
+from server.earthquake_information.faults_catalogue import get_faults_catalogue
+from server.earthquake_information.faults_scoring import VectorizedFaultsScorer, KM_PER_DEGREE, points_to_array
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_km(lon, lat, lons, lats):
+    '''
+    @return: array with the great circle distances (km) between the point and the points lons, lats
+    '''
+    lon, lat, lons, lats = np.radians(lon), np.radians(lat), np.radians(lons), np.radians(lats)
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def convex_hull(points):
+    '''
+    Andrew's monotone chain
+    @param points: numpy array (n, 2)
+    @return: numpy array with the vertices of the convex hull, counterclockwise;
+    fewer than 3 vertices if the points are less than 3 or collinear
+    '''
+    points = np.unique(points, axis=0)
+    if len(points) < 3:
+        return points
+
+    def half(sorted_points):
+        chain = []
+        for point in sorted_points:
+            while len(chain) >= 2 and (chain[-1][0] - chain[-2][0]) * (point[1] - chain[-2][1]) - \
+                    (chain[-1][1] - chain[-2][1]) * (point[0] - chain[-2][0]) <= 0:
+                chain.pop()
+            chain.append((point[0], point[1]))
+        return chain
+
+    lower = half(points)
+    upper = half(points[::-1])
+    return np.array(lower[:-1] + upper[:-1])
+
+
+def is_inside_convex_hull(vertices, point):
+    '''
+    @param vertices: vertices of a convex hull, counterclockwise, as returned by convex_hull
+    @return: True if the point is inside the hull or on its boundary
+    '''
+    if len(vertices) < 3:
+        return False
+    edges = np.roll(vertices, -1, axis=0) - vertices
+    to_point = point - vertices
+    return bool(np.all(edges[:, 0] * to_point[:, 1] - edges[:, 1] * to_point[:, 0] >= 0))
+
 
 class PointsToPolygon:
     def __init__(self):
@@ -131,6 +184,221 @@ class PointClusterizer(PointsToPolygon):
         return self.__get_cluster_hulls_as_gdal_poly()
 
 
+class StreamingPointClusterizer(PointsToPolygon):
+    """
+    DBSCAN clustering (great circle distance eps_km, min_samples) updated point by point.
+    Points are kept in a grid of eps sized cells, so the neighbours of a new point are
+    searched only in the cells around it; merging two clusters labels again the core points
+    of the smaller one, and every cluster keeps the vertices of its convex hull,
+    merged with the new points only. The cost of a batch grows with the new points,
+    not with the points already clustered.
+    As in PointClusterizer, hulls are made of core points only.
+    Removing points rebuilds the clusters from the remaining ones.
+    """
+
+    def __init__(self, eps_km=10.0, min_samples=1, hull_buffer=0.01):
+        self.__eps_km = eps_km
+        self.__min_samples = min_samples
+        self.__hull_buffer = hull_buffer
+        # cells are square in degrees of latitude, wider in km than eps along the longitude
+        self.__cell_size = eps_km / KM_PER_DEGREE
+        self.__removed = set()
+        self.__hulls = {}
+        self.clear()
+
+    def clear(self):
+        '''
+        removes all the points, their clusters are reported as removed by pop_changes
+        '''
+        self.__removed.update(self.__hulls)
+        self.__changed = set()
+        self.__size = 0
+        # (lon, lat) and number of neighbours of every point, grown by doubling
+        self.__coordinates = np.empty((64, 2))
+        self.__neighbours_number = np.zeros(64, dtype=np.int64)
+        # cluster of every point, -1 for the points that are not core
+        self.__labels = np.full(64, -1, dtype=np.int64)
+        # cluster -> its core points
+        self.__members = {}
+        self.__cells = {}
+        # cluster root -> vertices of the convex hull of its core points
+        self.__hulls = {}
+        self.__polygons = {}
+
+    def get_eps_km(self):
+        return self.__eps_km
+
+    def get_min_samples(self):
+        return self.__min_samples
+
+    def get_points_number(self):
+        return self.__size
+
+    def get_clusters(self):
+        '''
+        @return: ids of the clusters (the position of their root point)
+        '''
+        return sorted(self.__hulls)
+
+    def get_cluster_size(self, cluster):
+        '''
+        @return: number of core points of the cluster
+        '''
+        return len(self.__members[cluster])
+
+    def __cell_of(self, lon, lat):
+        return int(floor(lon / self.__cell_size)), int(floor(lat / self.__cell_size))
+
+    def __neighbours(self, lon, lat):
+        '''
+        @return: array with the points within eps_km from (lon, lat)
+        '''
+        size = self.__cell_size
+        column, row = self.__cell_of(lon, lat)
+        # a degree of longitude is shorter than a degree of latitude, more columns are needed
+        longitude_factor = max(cos(radians(min(90.0, abs(lat) + size))), 1e-6)
+        columns = int(ceil(1 / longitude_factor))
+        candidates = []
+        for c in range(column - columns, column + columns + 1):
+            for r in range(row - 1, row + 2):
+                candidates.extend(self.__cells.get((c, r), ()))
+        candidates = np.array(candidates, dtype=np.int64)
+        if len(candidates) == 0:
+            return candidates
+        coordinates = self.__coordinates[candidates]
+        return candidates[haversine_km(lon, lat, coordinates[:, 0], coordinates[:, 1]) <= self.__eps_km]
+
+    def __union(self, first, second):
+        '''
+        merges the clusters of two core points, the points of the smaller cluster are labelled again,
+        so a point is labelled again at most log2(points) times
+        '''
+        first, second = int(self.__labels[first]), int(self.__labels[second])
+        if first == second:
+            return
+        if len(self.__members[first]) < len(self.__members[second]):
+            first, second = second, first
+        members = self.__members.pop(second)
+        self.__labels[members] = first
+        self.__members[first].extend(members)
+        hull, second_hull = self.__hulls[first], self.__hulls.pop(second)
+        self.__polygons.pop(second, None)
+        self.__changed.discard(second)
+        self.__removed.add(second)
+        # most of the new points of a dense cluster fall inside its hull, that does not change
+        if not (len(second_hull) == 1 and is_inside_convex_hull(hull, second_hull[0])):
+            self.__hulls[first] = convex_hull(np.vstack([hull, second_hull]))
+            self.__polygons.pop(first, None)
+            self.__changed.add(first)
+
+    def add_points(self, point_list):
+        '''
+        @param point_list: GDAL points or (lon, lat) couples
+        '''
+        for lon, lat in points_to_array(point_list):
+            lon, lat = float(lon), float(lat)
+            point = self.__size
+            neighbours = self.__neighbours(lon, lat)
+            if point == len(self.__coordinates):
+                self.__coordinates = np.concatenate([self.__coordinates, np.empty_like(self.__coordinates)])
+                self.__neighbours_number = np.concatenate([self.__neighbours_number,
+                                                           np.zeros_like(self.__neighbours_number)])
+                self.__labels = np.concatenate([self.__labels, np.full_like(self.__labels, -1)])
+            self.__coordinates[point] = lon, lat
+            self.__size += 1
+            self.__cells.setdefault(self.__cell_of(lon, lat), []).append(point)
+            # as in sklearn, a point is a neighbour of itself
+            self.__neighbours_number[point] = len(neighbours) + 1
+            self.__neighbours_number[neighbours] += 1
+            new_cores = [point] if len(neighbours) + 1 >= self.__min_samples else []
+            new_cores.extend(int(neighbour) for neighbour in
+                             neighbours[self.__neighbours_number[neighbours] == self.__min_samples])
+            for core in new_cores:
+                self.__labels[core] = core
+                self.__members[core] = [core]
+                self.__hulls[core] = self.__coordinates[core:core + 1].copy()
+                self.__changed.add(core)
+            for core in new_cores:
+                core_neighbours = neighbours if core == point else self.__neighbours(*self.__coordinates[core])
+                # one union for each cluster around the core point
+                for cluster in np.unique(self.__labels[core_neighbours]).tolist():
+                    if cluster != -1:
+                        self.__union(core, cluster)
+
+    def remove_oldest(self, number: int):
+        '''
+        removes the first number points added, the clusters are built again from the remaining ones
+        '''
+        if number <= 0:
+            return
+        remaining = self.__coordinates[number:self.__size].copy()
+        self.clear()
+        if len(remaining):
+            self.add_points(remaining)
+
+    def pop_changes(self):
+        '''
+        @return: set of the clusters removed (merged into others) and set of the clusters created or changed
+        since the last call; a cluster id can be in both sets after a remove_oldest
+        '''
+        changes = (self.__removed, self.__changed)
+        self.__removed = set()
+        self.__changed = set()
+        return changes
+
+    def get_hull(self, cluster):
+        '''
+        @return: GDAL polygon of the convex hull of the cluster, the points (or the segment)
+        buffered by hull_buffer if they are less than 3
+        '''
+        polygon = self.__polygons.get(cluster)
+        if polygon is None:
+            vertices = self.__hulls[cluster]
+            if len(vertices) >= 3:
+                ring = ogr.Geometry(ogr.wkbLinearRing)
+                for x, y in vertices:
+                    ring.AddPoint(float(x), float(y))
+                ring.AddPoint(float(vertices[0][0]), float(vertices[0][1]))
+                polygon = ogr.Geometry(ogr.wkbPolygon)
+                polygon.AddGeometry(ring)
+            else:
+                line = ogr.Geometry(ogr.wkbLineString if len(vertices) == 2 else ogr.wkbPoint)
+                for x, y in vertices:
+                    line.AddPoint(float(x), float(y))
+                polygon = line.Buffer(self.__hull_buffer)
+            self.__polygons[cluster] = polygon
+        return polygon
+
+    def get_concentrated_areas(self, point_list):
+        '''
+        adds the points
+        @return: list of GDAL polygons, one for each cluster
+        '''
+        self.add_points(point_list)
+        return [self.get_hull(cluster) for cluster in self.get_clusters()]
+
+
+def polygon_faults_probabilities(polygon, catalogue, search_distance):
+    '''
+    @return: dictionary catalogue position -> probability that the fault generated the earthquake
+    felt in the polygon, inversely proportional to the distance; only the faults near the polygon are scored,
+    far ones would get a negligible probability
+    '''
+    near_faults = catalogue.find_faults_near(polygon, search_distance)
+    if not near_faults:
+        near_faults = range(len(catalogue))
+    distances = {}  # dictionary fault position -> inverse distance from this polygon
+    sum = 0
+    for position in near_faults:
+        inverse_distance = 1/(polygon.Distance(catalogue.get_geometry(position))+0.0000001)
+        distances[position] = inverse_distance
+        sum = sum + inverse_distance
+    faults_probabilities = {}
+    for position, inverse_distance in distances.items():
+        faults_probabilities[position] = inverse_distance/sum
+    return faults_probabilities
+
+
 class EarthquakeFaultsFinder:
     """
        This class finds the possible earthquake faults from a list
@@ -138,11 +406,14 @@ class EarthquakeFaultsFinder:
        It is possible to set a maximum number of possible faults.
        """
 
-    def __init__(self, max_faults=3, polygons_buffer=0.7, points2polygon: PointsToPolygon = PointClusterizer()):
+    def __init__(self, max_faults=3, polygons_buffer=0.7, points2polygon: PointsToPolygon = PointClusterizer(),
+                 faults_scorer: VectorizedFaultsScorer = None):
         self.__maximum_number_of_faults = max_faults
         self.__polygons_buffer = polygons_buffer
         self.__possible_faults = []
         self.__points2polygon = points2polygon
+        # if set, points are scored with NumPy instead of OGR
+        self.__faults_scorer = faults_scorer
 
     def get_maximum_number_of_faults(self):
         return self.__maximum_number_of_faults
@@ -162,14 +433,20 @@ class EarthquakeFaultsFinder:
         self.__possible_faults.append(fault)
 
     def find_candidate_faults(self, point_list):
-        polygons = point_list
-        print('polygons: '+str(polygons))
-        #polygons = self.__points2polygon.get_concentrated_areas(point_list)
+        if self.__points2polygon is not None:
+            polygons = self.__points2polygon.get_concentrated_areas(point_list)
+        else:
+            polygons = point_list
         if polygons:
-            sorted_by_probabilities, faults_geom = self.__find_all_candidate_faults(polygons)
+            if self.__faults_scorer is not None and \
+                    all(polygon.GetGeometryType() == ogr.wkbPoint for polygon in polygons):
+                sorted_by_probabilities, faults_geom = \
+                    self.__faults_scorer.find_all_candidate_faults(polygons, self.__polygons_buffer)
+            else:
+                sorted_by_probabilities, faults_geom = self.__find_all_candidate_faults(polygons)
             for i in range(0, len(sorted_by_probabilities)):
                 id_fault = sorted_by_probabilities[i][0]
-                fault = EarthquakeFault(faults_geom[id_fault], sorted_by_probabilities[i][1])
+                fault = EarthquakeFault(faults_geom[id_fault], sorted_by_probabilities[i][1], id_fault)
                 self.add_faults(fault)
             if self.__maximum_number_of_faults == 0:
                 faults = self.__possible_faults
@@ -182,65 +459,42 @@ class EarthquakeFaultsFinder:
         return faults
 
     def __find_all_candidate_faults(self, polygons):
-        # load the composite seismologic sources from the shapefile 'ISS321.shp''
-        driver = ogr.GetDriverByName("ESRI Shapefile")
-        file_seism = 'server/earthquake_information/INGV/ISS321.shp'
-        vector_seism = driver.Open(file_seism, 0)
-        layer_seism = vector_seism.GetLayer(0)
+        # the composite seismologic sources of 'ISS321.shp' are loaded once and shared
+        catalogue = get_faults_catalogue('ISS321')
         # Find probability of seismogenic faults for each polygons (e.g. with dist of 20 km)
-        polygons_probabilities = {}
+        polygons_probabilities = []
         for polygon in polygons:
-            distances = {} #dictionary fault -> distance from this polygon
-            faults_probabilities = {}
-            sum = 0
-            for fault in layer_seism:
-                fault_geom = fault.GetGeometryRef().GetGeometryRef(0)
-                fault_poly = ogr.Geometry(ogr.wkbPolygon)
-                fault_poly.AddGeometry(fault_geom)
-                inverse_distance = 1/(polygon.Distance(fault_poly)+0.0000001)
-                distances[fault.GetField(0)] = inverse_distance
-                sum = sum + inverse_distance
-            for fault in layer_seism:
-                faults_probabilities[fault.GetField(0)] = distances[fault.GetField(0)]/sum
-            polygons_probabilities[polygon] = faults_probabilities
+            polygons_probabilities.append(polygon_faults_probabilities(polygon, catalogue, self.__polygons_buffer))
         probabilities_sum = {}
+        for faults_probabilities in polygons_probabilities:
+            for position, probability in faults_probabilities.items():
+                probabilities_sum[position] = probabilities_sum.get(position, 0) + probability
+        probabilities = {}
         faults_poly = {}
-        for fault in layer_seism:
-            fault_geom = fault.GetGeometryRef().GetGeometryRef(0)
-            fault_poly = ogr.Geometry(ogr.wkbPolygon)
-            fault_poly.AddGeometry(fault_geom)
-            prob_fault = 0
-            for polygon in polygons:
-                prob_fault = prob_fault + polygons_probabilities[polygon][fault.GetField(0)]
-            prob_fault = prob_fault/len(polygons)
-            probabilities_sum[fault.GetField(0)] = prob_fault
-            faults_poly[fault.GetField(0)] = fault_poly
-
-        sorted_faults_probabilities = sorted(probabilities_sum.items(), key=lambda x: x[1], reverse=True)
-        return sorted_faults_probabilities, faults_poly
+        for position, prob_fault in probabilities_sum.items():
+            fault_id = catalogue.get_fault_id(position)
+            probabilities[fault_id] = prob_fault/len(polygons)
+            faults_poly[fault_id] = catalogue.get_geometry(position)
 
-    def __find_nearest_faults(self, polygon, layer_seism):
+        sorted_faults_probabilities = sorted(probabilities.items(), key=lambda x: x[1], reverse=True)
+        return sorted_faults_probabilities, faults_poly
 
+    def __find_nearest_faults(self, polygon):
         area = polygon.Buffer(self.__polygons_buffer)
-        print(area)
+        catalogue = get_faults_catalogue('ISS321')
         faults = []
-        for fault in layer_seism:
-            fault_geom = fault.GetGeometryRef().GetGeometryRef(0)
-            fault_poly = ogr.Geometry(ogr.wkbPolygon)
-            fault_poly.AddGeometry(fault_geom)
-
+        for position in catalogue.find_faults_near(polygon, self.__polygons_buffer):
+            fault_poly = catalogue.get_geometry(position)
             if area.Intersects(fault_poly):
-                faults.append(fault)
+                faults.append(fault_poly)
 
         return faults
 
-    def __find_distances_from_faults(self, polygon, layer_seism):
+    def __find_distances_from_faults(self, polygon):
+        catalogue = get_faults_catalogue('ISS321')
         faults_distances = {}
-        for fault in layer_seism:
-            fault_geom = fault.GetGeometryRef().GetGeometryRef(0)
-            fault_poly = ogr.Geometry(ogr.wkbPolygon)
-            fault_poly.AddGeometry(fault_geom)
-            faults_distances[fault] = polygon.Distance(fault_poly)
+        for fault_id, fault_poly in zip(catalogue.get_fault_ids(), catalogue.get_geometries()):
+            faults_distances[fault_id] = polygon.Distance(fault_poly)
         return faults_distances
 
 
@@ -251,9 +505,11 @@ class EarthquakeFault(object):
     generated the earthquake, every possible faults have a probability.
     '''
 
-    def __init__(self, gdal_geometry, probability):
+    def __init__(self, gdal_geometry, probability, fault_id=None):
         self.__geometry = gdal_geometry
         self.__probability = probability
+        # id of the fault in the INGV catalogue, if it comes from it
+        self.__fault_id = fault_id
 
     def set_probability(self, prob):
         if prob > 0:
@@ -265,6 +521,9 @@ class EarthquakeFault(object):
     def get_probability(self):
         return self.__probability
 
+    def get_fault_id(self):
+        return self.__fault_id
+
 
 if __name__ == '__main__':
     '''
@@ -0,0 +1,253 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from osgeo import ogr
+
+from server.earthquake_information.faults_catalogue import FaultsCatalogue, INGV_DIRECTORY, get_faults_catalogue
+from server.earthquake_information.gazetteer import GAZETTEER_DIRECTORY, Gazetteer, get_gazetteer, \
+    make_temporary_directory, move_directory_into_place
+
+EXPOSURE_DIRECTORY = 'server/earthquake_information/INGV/exposure/'
+EXPOSURE_FORMAT_VERSION = 1
+# unions of buffers kept, the same top faults are published many times during a detection
+UNIONS_CACHE_SIZE = 16
+
+
+def files_hash(paths):
+    digest = hashlib.blake2b(digest_size=8)
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def get_gazetteer_version(directory=GAZETTEER_DIRECTORY):
+    '''
+    @return: hash of the files of the compact gazetteer, built first if it is not on disk.
+    The exposure stores positions of this gazetteer, so it is valid only for it,
+    whatever it was built from (the shapefile or cities500.txt, see cities2gazetteer)
+    '''
+    get_gazetteer()
+    return files_hash(sorted(os.path.join(directory, name) for name in os.listdir(directory)))
+
+
+def get_catalogue_version(layer_name='ISS321'):
+    '''
+    @return: hash of the files of the INGV layer and of the compact gazetteer,
+    it changes whenever the faults or the places (and so the gazetteer positions) change
+    '''
+    paths = [INGV_DIRECTORY + layer_name + extension for extension in ('.shp', '.shx', '.dbf')]
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(files_hash(paths).encode('ascii'))
+    digest.update(get_gazetteer_version().encode('ascii'))
+    return digest.hexdigest()
+
+
+def get_exposure_directory(layer_name='ISS321', faults_buffer=0.3):
+    return os.path.join(EXPOSURE_DIRECTORY, '{}_{}_{}'.format(layer_name, faults_buffer,
+                                                              get_catalogue_version(layer_name)))
+
+
+class FaultExposure:
+    """
+    Precomputed exposure of every fault of a catalogue: its polygon buffered by
+    faults_buffer and the gazetteer positions of the municipalities inside it.
+    The area at risk of some faults is then the union of their buffers and
+    the union of their municipalities, without buffering or scanning the gazetteer.
+    Buffers are stored as WKB and turned into OGR geometries the first time they are used.
+    """
+
+    def __init__(self, fault_ids, buffers_data, buffers_offsets, municipalities_indptr, municipalities,
+                 faults_buffer):
+        self.__fault_ids = list(fault_ids)
+        self.__positions = {fault_id: position for position, fault_id in enumerate(self.__fault_ids)}
+        self.__buffers_data = buffers_data
+        self.__buffers_offsets = buffers_offsets
+        self.__municipalities_indptr = municipalities_indptr
+        self.__municipalities = municipalities
+        self.__faults_buffer = faults_buffer
+        self.__buffers = {}
+        self.__unions = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get_fault_ids(self):
+        return self.__fault_ids
+
+    def get_faults_buffer(self):
+        return self.__faults_buffer
+
+    def get_buffers_data(self):
+        return self.__buffers_data
+
+    def get_buffers_offsets(self):
+        return self.__buffers_offsets
+
+    def get_municipalities_indptr(self):
+        return self.__municipalities_indptr
+
+    def get_municipalities(self):
+        return self.__municipalities
+
+    def get_position(self, fault_id):
+        '''
+        @return: position of the fault in the table, None if the fault is not in it
+        '''
+        return self.__positions.get(fault_id)
+
+    def get_buffer(self, position: int):
+        '''
+        @return: OGR polygon of the buffered fault, shared: it must not be modified
+        '''
+        with self.__lock:
+            buffer = self.__buffers.get(position)
+            if buffer is None:
+                start, end = self.__buffers_offsets[position], self.__buffers_offsets[position + 1]
+                buffer = ogr.CreateGeometryFromWkb(self.__buffers_data[start:end].tobytes())
+                self.__buffers[position] = buffer
+        return buffer
+
+    def get_municipality_positions(self, position: int):
+        '''
+        @return: sorted array with the gazetteer positions of the municipalities inside the buffered fault
+        '''
+        return self.__municipalities[self.__municipalities_indptr[position]:self.__municipalities_indptr[position + 1]]
+
+    def find_exposure(self, positions):
+        '''
+        @param positions: positions of the faults in the table
+        @return: union of their buffers (OGR geometry, shared: it must not be modified)
+        and sorted array with the gazetteer positions of their municipalities
+        '''
+        key = tuple(sorted(set(positions)))
+        with self.__lock:
+            exposure = self.__unions.get(key)
+            if exposure is not None:
+                self.__unions.move_to_end(key)
+                return exposure
+        area = ogr.Geometry(ogr.wkbPolygon)
+        municipalities = []
+        for position in key:
+            area = area.Union(self.get_buffer(position))
+            municipalities.append(self.get_municipality_positions(position))
+        if municipalities:
+            municipalities = np.unique(np.concatenate(municipalities))
+        else:
+            municipalities = np.empty(0, dtype=np.int64)
+        exposure = (area, municipalities)
+        with self.__lock:
+            self.__unions[key] = exposure
+            if len(self.__unions) > UNIONS_CACHE_SIZE:
+                self.__unions.popitem(last=False)
+        return exposure
+
+    def __len__(self):
+        return len(self.__fault_ids)
+
+
+def build_fault_exposure(catalogue: FaultsCatalogue, faults_buffer=0.3, gazetteer: Gazetteer = None):
+    '''
+    buffers every fault of the catalogue and finds the municipalities inside the buffer
+    '''
+    if gazetteer is None:
+        gazetteer = get_gazetteer()
+    buffers = []
+    municipalities = []
+    for geometry in catalogue.get_geometries():
+        buffer = geometry.Buffer(faults_buffer)
+        buffers.append(np.frombuffer(bytes(buffer.ExportToWkb()), dtype=np.uint8))
+        municipalities.append(np.sort(gazetteer.find_within(buffer)).astype(np.int32))
+    buffers_offsets = np.zeros(len(buffers) + 1, dtype=np.int64)
+    buffers_offsets[1:] = np.cumsum([len(buffer) for buffer in buffers])
+    municipalities_indptr = np.zeros(len(municipalities) + 1, dtype=np.int64)
+    municipalities_indptr[1:] = np.cumsum([len(positions) for positions in municipalities])
+    return FaultExposure(catalogue.get_fault_ids(),
+                         np.concatenate(buffers) if buffers else np.empty(0, dtype=np.uint8), buffers_offsets,
+                         municipalities_indptr,
+                         np.concatenate(municipalities) if municipalities else np.empty(0, dtype=np.int32),
+                         faults_buffer)
+
+
+def write_fault_exposure(exposure: FaultExposure, directory):
+    '''
+    saves the table as a directory of .npy columns, written in a temporary directory
+    that is renamed at the end like the gazetteer. The directory is keyed by the version of the catalogue,
+    so if it already exists (built by another process) this copy is discarded
+    '''
+    temporary_directory = make_temporary_directory(directory)
+    columns = {'buffers_data': exposure.get_buffers_data(),
+               'buffers_offsets': exposure.get_buffers_offsets(),
+               'municipalities_indptr': exposure.get_municipalities_indptr(),
+               'municipalities': exposure.get_municipalities()}
+    for name, column in columns.items():
+        np.save(os.path.join(temporary_directory, name + '.npy'), np.ascontiguousarray(column))
+    with open(os.path.join(temporary_directory, 'metadata.json'), 'w') as f:
+        json.dump({'version': EXPOSURE_FORMAT_VERSION, 'faults_buffer': exposure.get_faults_buffer(),
+                   'fault_ids': exposure.get_fault_ids()}, f)
+    move_directory_into_place(temporary_directory, directory)
+
+
+def load_fault_exposure(directory):
+    '''
+    memory maps a table saved by write_fault_exposure
+    '''
+    with open(os.path.join(directory, 'metadata.json')) as f:
+        metadata = json.load(f)
+    if metadata['version'] != EXPOSURE_FORMAT_VERSION:
+        raise ValueError('fault exposure format version {} is not supported'.format(metadata['version']))
+
+    def column(name):
+        return np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+
+    return FaultExposure(metadata['fault_ids'], column('buffers_data'), column('buffers_offsets'),
+                         column('municipalities_indptr'), column('municipalities'), metadata['faults_buffer'])
+
+
+__exposures = {}
+__exposures_lock = threading.Lock()
+
+
+def get_fault_exposure(layer_name='ISS321', faults_buffer=0.3):
+    '''
+    @return: the FaultExposure of the layer and buffer, mapped at the first call and shared afterwards.
+    If it is not on disk for the current version of the catalogue and of the gazetteer, it is built and saved
+    '''
+    key = (layer_name, faults_buffer)
+    with __exposures_lock:
+        exposure = __exposures.get(key)
+        if exposure is None:
+            directory = get_exposure_directory(layer_name, faults_buffer)
+            if not os.path.isfile(os.path.join(directory, 'metadata.json')):
+                write_fault_exposure(build_fault_exposure(get_faults_catalogue(layer_name), faults_buffer),
+                                     directory)
+            exposure = load_fault_exposure(directory)
+            __exposures[key] = exposure
+    return exposure
+
+
+if __name__ == '__main__':
+    '''
+        builds the exposure table of ISS321 and compares the area at risk of some faults
+        computed from it with the one computed buffering the faults
+    '''
+    import time
+    from server.earthquake_information.earthquake_faults_finder import EarthquakeFault
+    from server.earthquake_information.risking_area_finder import RiskingAreaFinder
+
+    start = time.perf_counter()
+    fault_exposure = get_fault_exposure()
+    print('exposure of {} faults ready in {:.2f} s'.format(len(fault_exposure), time.perf_counter() - start))
+    faults_catalogue = get_faults_catalogue()
+    faults = [EarthquakeFault(faults_catalogue.get_geometry(position), 1 / 3, faults_catalogue.get_fault_id(position))
+              for position in (10, 11, 40)]
+    for use_exposure in [False, True]:
+        finder = RiskingAreaFinder(use_exposure=use_exposure)
+        start = time.perf_counter()
+        area = finder.find_risking_area(faults)
+        print('exposure {}: {} municipalities, population {}, {:.2f} ms'.format(
+            use_exposure, len(area.get_municipalities()), area.get_population(),
+            (time.perf_counter() - start) * 1000))
@@ -0,0 +1,109 @@
+import threading
+
+from osgeo import ogr
+
+from server.earthquake_information.spatial_index import GridIndex
+
+INGV_DIRECTORY = 'server/earthquake_information/INGV/'
+
+
+class FaultsCatalogue:
+    """
+    In memory copy of an INGV seismogenic sources layer (e.g. 'ISS321').
+    The shapefile is read once: every fault is kept as an OGR polygon
+    together with its id and envelope, and the envelopes are stored
+    in a grid index so that only the faults close to a geometry
+    have to be looked at.
+    """
+
+    def __init__(self, layer_name='ISS321', cell_size=0.5):
+        self.__layer_name = layer_name
+        self.__fault_ids = []
+        self.__geometries = []
+        self.__envelopes = []
+        self.__index = GridIndex(cell_size)
+        self.__load()
+
+    def __load(self):
+        driver = ogr.GetDriverByName("ESRI Shapefile")
+        vector_seism = driver.Open(INGV_DIRECTORY + self.__layer_name + '.shp', 0)
+        layer_seism = vector_seism.GetLayer(0)
+        for fault in layer_seism:
+            geometry = fault.GetGeometryRef()
+            if geometry.GetGeometryType() == ogr.wkbPolygon:
+                # only the external ring is used, as it has always been done for ISS321
+                fault_poly = ogr.Geometry(ogr.wkbPolygon)
+                fault_poly.AddGeometry(geometry.GetGeometryRef(0))
+            else:
+                fault_poly = geometry.Clone()
+            envelope = fault_poly.GetEnvelope()
+            self.__index.insert(len(self.__fault_ids), *envelope)
+            self.__fault_ids.append(fault.GetField(0))
+            self.__geometries.append(fault_poly)
+            self.__envelopes.append(envelope)
+        vector_seism = None
+
+    def get_layer_name(self):
+        return self.__layer_name
+
+    def get_fault_ids(self):
+        return self.__fault_ids
+
+    def get_geometries(self):
+        return self.__geometries
+
+    def get_envelopes(self):
+        return self.__envelopes
+
+    def get_fault_id(self, position: int):
+        return self.__fault_ids[position]
+
+    def get_geometry(self, position: int):
+        return self.__geometries[position]
+
+    def find_faults_near(self, geometry, distance=0.0):
+        '''
+        @param geometry: OGR geometry
+        @param distance: search distance (degrees) added around the geometry envelope
+        @return: sorted positions of the faults whose envelope is within
+        distance from the envelope of the geometry
+        '''
+        min_x, max_x, min_y, max_y = geometry.GetEnvelope()
+        min_x, max_x = min_x - distance, max_x + distance
+        min_y, max_y = min_y - distance, max_y + distance
+        near = []
+        for position in self.__index.query(min_x, max_x, min_y, max_y):
+            f_min_x, f_max_x, f_min_y, f_max_y = self.__envelopes[position]
+            if f_min_x <= max_x and f_max_x >= min_x and f_min_y <= max_y and f_max_y >= min_y:
+                near.append(position)
+        near.sort()
+        return near
+
+    def __len__(self):
+        return len(self.__fault_ids)
+
+
+__catalogues = {}
+__catalogues_lock = threading.Lock()
+
+
+def get_faults_catalogue(layer_name='ISS321'):
+    '''
+    @param layer_name: name of the INGV shapefile, without extension
+    @return: the FaultsCatalogue of the layer, loaded at the first call
+    and shared by every caller (and every thread) afterwards
+    '''
+    with __catalogues_lock:
+        catalogue = __catalogues.get(layer_name)
+        if catalogue is None:
+            catalogue = FaultsCatalogue(layer_name)
+            __catalogues[layer_name] = catalogue
+    return catalogue
+
+
+def load_faults_catalogues(layer_names=('ISS321',)):
+    '''
+    loads the given INGV layers, meant to be called at process start
+    so that the first detection does not pay for reading the shapefiles
+    '''
+    return [get_faults_catalogue(layer_name) for layer_name in layer_names]
@@ -0,0 +1,196 @@
+import numpy as np
+from osgeo import ogr
+
+from server.earthquake_information.faults_catalogue import FaultsCatalogue, get_faults_catalogue
+
+KM_PER_DEGREE = 111.32
+# same offset used by the OGR scoring to avoid dividing by zero, expressed in degrees
+DISTANCE_OFFSET = 0.0000001
+
+
+def points_to_array(point_list):
+    '''
+    @param point_list: list of GDAL points or an array-like of (x, y) couples
+    @return: numpy array with shape (n, 2)
+    '''
+    if isinstance(point_list, np.ndarray):
+        return point_list.reshape(-1, 2).astype(float)
+    coordinates = np.empty((len(point_list), 2))
+    for i, point in enumerate(point_list):
+        if isinstance(point, ogr.Geometry):
+            coordinates[i, 0] = point.GetX()
+            coordinates[i, 1] = point.GetY()
+        else:
+            coordinates[i, 0] = point[0]
+            coordinates[i, 1] = point[1]
+    return coordinates
+
+
+class VectorizedFaultsScorer:
+    """
+    Scores the faults of a catalogue against a batch of points with the
+    same inverse distance model of EarthquakeFaultsFinder, but without
+    calling OGR for every point x fault couple.
+    The external rings of the faults are packed into NumPy edge arrays,
+    so the whole points x faults distance matrix is computed at once.
+    With metric=True distances are in km (local equirectangular projection
+    around every point) instead of degrees.
+    """
+
+    def __init__(self, catalogue: FaultsCatalogue = None, metric=True, chunk_size=1024):
+        if catalogue is None:
+            catalogue = get_faults_catalogue('ISS321')
+        self.__catalogue = catalogue
+        self.__metric = metric
+        self.__chunk_size = chunk_size
+        self.__pack_edges()
+
+    def __pack_edges(self):
+        starts = []
+        ends = []
+        offsets = []
+        envelopes = []
+        edges = 0
+        for fault_poly in self.__catalogue.get_geometries():
+            ring = fault_poly.GetGeometryRef(0) if fault_poly.GetGeometryCount() else fault_poly
+            vertices = np.array([ring.GetPoint_2D(i) for i in range(ring.GetPointCount())])
+            if len(vertices) > 1 and not np.array_equal(vertices[0], vertices[-1]):
+                vertices = np.vstack([vertices, vertices[:1]])
+            offsets.append(edges)
+            edges = edges + len(vertices) - 1
+            starts.append(vertices[:-1])
+            ends.append(vertices[1:])
+            envelopes.append(fault_poly.GetEnvelope())
+        self.__edge_starts = np.concatenate(starts)
+        self.__edge_ends = np.concatenate(ends)
+        self.__offsets = np.array(offsets)
+        # min_x, max_x, min_y, max_y of every fault
+        self.__envelopes = np.array(envelopes)
+
+    def get_catalogue(self):
+        return self.__catalogue
+
+    def is_metric(self):
+        return self.__metric
+
+    def __distances(self, points):
+        '''
+        @param points: array (n, 2) of lon, lat
+        @return: array (n, faults) with the distance of every point from every fault
+        (0 when the point is inside the fault)
+        '''
+        px = points[:, 0:1]
+        py = points[:, 1:2]
+        ax, ay = self.__edge_starts[:, 0], self.__edge_starts[:, 1]
+        bx, by = self.__edge_ends[:, 0], self.__edge_ends[:, 1]
+
+        # even-odd rule on the (unprojected) edges
+        crosses = (ay > py) != (by > py)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = (bx - ax) * (py - ay) / (by - ay) + ax
+        crosses &= px < x_cross
+        inside = np.add.reduceat(crosses, self.__offsets, axis=1) % 2 == 1
+
+        if self.__metric:
+            scale_x = np.cos(np.radians(py)) * KM_PER_DEGREE
+            scale_y = KM_PER_DEGREE
+        else:
+            scale_x = scale_y = 1.0
+        ex = (bx - ax) * scale_x
+        ey = (by - ay) * scale_y
+        wx = (px - ax) * scale_x
+        wy = (py - ay) * scale_y
+        length = ex * ex + ey * ey
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.where(length > 0, (wx * ex + wy * ey) / length, 0.0)
+        np.clip(t, 0.0, 1.0, out=t)
+        dx = wx - t * ex
+        dy = wy - t * ey
+        squared = np.minimum.reduceat(dx * dx + dy * dy, self.__offsets, axis=1)
+        distances = np.sqrt(squared)
+        distances[inside] = 0.0
+        return distances
+
+    def __near_mask(self, points, search_distance):
+        envelopes = self.__envelopes
+        near = (envelopes[:, 0] <= points[:, 0:1] + search_distance) & \
+               (envelopes[:, 1] >= points[:, 0:1] - search_distance) & \
+               (envelopes[:, 2] <= points[:, 1:2] + search_distance) & \
+               (envelopes[:, 3] >= points[:, 1:2] - search_distance)
+        # isolated points are scored against every fault
+        near[~near.any(axis=1)] = True
+        return near
+
+    def get_probabilities_matrix(self, point_list, search_distance=None):
+        '''
+        @param point_list: GDAL points or (x, y) couples
+        @param search_distance: if set, faults whose envelope is farther (degrees)
+        from a point get probability 0 for that point
+        @return: array (points, faults); every row sums to 1
+        '''
+        points = points_to_array(point_list)
+        offset = DISTANCE_OFFSET * (KM_PER_DEGREE if self.__metric else 1.0)
+        probabilities = np.empty((len(points), len(self.__offsets)))
+        for first in range(0, len(points), self.__chunk_size):
+            chunk = points[first:first + self.__chunk_size]
+            inverse_distances = 1 / (self.__distances(chunk) + offset)
+            if search_distance is not None:
+                inverse_distances[~self.__near_mask(chunk, search_distance)] = 0.0
+            inverse_distances /= inverse_distances.sum(axis=1, keepdims=True)
+            probabilities[first:first + len(chunk)] = inverse_distances
+        return probabilities
+
+    def get_faults_probabilities(self, point_list, search_distance=None):
+        '''
+        @return: array with the probability of every fault, averaged over the points
+        '''
+        if len(point_list) == 0:
+            return np.zeros(len(self.__offsets))
+        return self.get_probabilities_matrix(point_list, search_distance).mean(axis=0)
+
+    def find_all_candidate_faults(self, point_list, search_distance=None):
+        '''
+        @return: the same output of EarthquakeFaultsFinder scoring:
+        a list of (fault id, probability) sorted by probability and
+        a dictionary fault id -> GDAL polygon, for the faults with probability > 0
+        '''
+        probabilities = self.get_faults_probabilities(point_list, search_distance)
+        order = np.argsort(-probabilities, kind='stable')
+        catalogue = self.__catalogue
+        sorted_faults_probabilities = []
+        faults_poly = {}
+        for position in order:
+            if probabilities[position] <= 0:
+                break
+            fault_id = catalogue.get_fault_id(position)
+            sorted_faults_probabilities.append((fault_id, float(probabilities[position])))
+            faults_poly[fault_id] = catalogue.get_geometry(position)
+        return sorted_faults_probabilities, faults_poly
+
+
+if __name__ == '__main__':
+    '''
+        compares the OGR and the vectorized scoring on random points over Italy
+    '''
+    import time
+    from server.earthquake_information.earthquake_faults_finder import EarthquakeFaultsFinder
+
+    random_state = np.random.RandomState(0)
+    points = np.column_stack([random_state.uniform(13.0, 16.5, 3000), random_state.uniform(38.0, 42.5, 3000)])
+    gdal_points = []
+    for x, y in points:
+        point = ogr.Geometry(ogr.wkbPoint)
+        point.AddPoint(x, y)
+        gdal_points.append(point)
+
+    start = time.perf_counter()
+    ogr_faults = EarthquakeFaultsFinder(max_faults=0).find_candidate_faults(gdal_points)
+    print('OGR scoring: {:.1f} ms'.format((time.perf_counter() - start) * 1000))
+
+    for metric in [False, True]:
+        scorer = VectorizedFaultsScorer(metric=metric)
+        start = time.perf_counter()
+        faults = EarthquakeFaultsFinder(max_faults=0, faults_scorer=scorer).find_candidate_faults(gdal_points)
+        print('vectorized scoring (metric={}): {:.1f} ms'.format(metric, (time.perf_counter() - start) * 1000))
+        difference = max(abs(a.get_probability() - b.get_probability()) for a, b in zip(ogr_faults, faults))
+        print('max probability difference from OGR: {}'.format(difference))
@@ -0,0 +1,327 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+from osgeo import ogr
+
+CITIES_SHAPEFILE = 'server/earthquake_information/cities500/cities500_IT.shp'
+GAZETTEER_DIRECTORY = 'server/earthquake_information/cities500/cities500_IT_gazetteer'
+GAZETTEER_FORMAT_VERSION = 1
+# cells are identified by a single integer: column * CELL_ROWS + row
+CELL_ROWS = 1 << 20
+
+
+def geometry_rings(geometry):
+    '''
+    @param geometry: GDAL polygon or multipolygon
+    @return: list of numpy arrays (n, 2), one for each (external or internal) ring
+    '''
+    rings = []
+    geometry_type = ogr.GT_Flatten(geometry.GetGeometryType())
+    if geometry_type == ogr.wkbPolygon:
+        for i in range(geometry.GetGeometryCount()):
+            ring = geometry.GetGeometryRef(i)
+            rings.append(np.array([ring.GetPoint_2D(j) for j in range(ring.GetPointCount())]))
+    elif geometry_type in (ogr.wkbMultiPolygon, ogr.wkbGeometryCollection):
+        for i in range(geometry.GetGeometryCount()):
+            rings.extend(geometry_rings(geometry.GetGeometryRef(i)))
+    return rings
+
+
+def points_in_geometry(xs, ys, geometry):
+    '''
+    even-odd point in polygon test over all the rings of the geometry,
+    so holes and multipolygons are handled as well
+    @return: boolean array, True for the points inside the geometry
+    '''
+    inside = np.zeros(len(xs), dtype=bool)
+    px = xs[:, np.newaxis]
+    py = ys[:, np.newaxis]
+    for ring in geometry_rings(geometry):
+        if len(ring) < 3:
+            continue
+        ax, ay = ring[:-1, 0], ring[:-1, 1]
+        bx, by = ring[1:, 0], ring[1:, 1]
+        crosses = (ay > py) != (by > py)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = (bx - ax) * (py - ay) / (by - ay) + ax
+        crosses &= px < x_cross
+        inside ^= (crosses.sum(axis=1) % 2 == 1)
+    return inside
+
+
+class StringTable:
+    """
+    Interned strings stored as a single UTF-8 buffer plus the offsets
+    of every string, so that it can be saved and memory mapped as two arrays.
+    """
+
+    def __init__(self, data, offsets):
+        '''
+        @param data: uint8 array with the concatenated UTF-8 strings
+        @param offsets: int64 array, string i is data[offsets[i]:offsets[i + 1]]
+        '''
+        self.__data = data
+        self.__offsets = offsets
+
+    def get_data(self):
+        return self.__data
+
+    def get_offsets(self):
+        return self.__offsets
+
+    def get(self, string_id: int):
+        start, end = self.__offsets[string_id], self.__offsets[string_id + 1]
+        return bytes(self.__data[start:end]).decode('utf-8')
+
+    def __len__(self):
+        return len(self.__offsets) - 1
+
+
+def intern_strings(*columns):
+    '''
+    @param columns: sequences of strings
+    @return: a StringTable with the distinct strings and, for each column, the int32 array of their ids
+    '''
+    ids = {}
+    columns_ids = []
+    for column in columns:
+        column_ids = np.empty(len(column), dtype=np.int32)
+        for i, string in enumerate(column):
+            column_ids[i] = ids.setdefault(string or '', len(ids))
+        columns_ids.append(column_ids)
+    encoded = [string.encode('utf-8') for string in ids]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(string) for string in encoded])
+    data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return StringTable(data, offsets), columns_ids
+
+
+class Gazetteer:
+    """
+    In memory copy of the cities500 gazetteer.
+    Places are kept in NumPy columns sorted by grid cell, so that
+    the places inside a bounding box are found with a binary search
+    for every column of cells instead of testing all of them.
+    Names, provinces and countries are ids of a StringTable.
+    The columns can be NumPy memory maps (see load_gazetteer).
+    """
+
+    def __init__(self, cells, lon, lat, population, name_ids, province_ids, country_ids,
+                 strings: StringTable, cell_size=0.1):
+        '''
+        all the columns must already be sorted by cell, use build_gazetteer to create a new one
+        '''
+        self.__cell_size = cell_size
+        self.__cells = cells
+        self.__lon = lon
+        self.__lat = lat
+        self.__population = population
+        self.__name_ids = name_ids
+        self.__province_ids = province_ids
+        self.__country_ids = country_ids
+        self.__strings = strings
+
+    def get_cell_size(self):
+        return self.__cell_size
+
+    def get_cells(self):
+        return self.__cells
+
+    def get_lon(self):
+        return self.__lon
+
+    def get_lat(self):
+        return self.__lat
+
+    def get_population(self):
+        return self.__population
+
+    def get_name_ids(self):
+        return self.__name_ids
+
+    def get_province_ids(self):
+        return self.__province_ids
+
+    def get_country_ids(self):
+        return self.__country_ids
+
+    def get_strings(self):
+        return self.__strings
+
+    def get_name(self, position: int):
+        return self.__strings.get(self.__name_ids[position])
+
+    def get_province(self, position: int):
+        return self.__strings.get(self.__province_ids[position])
+
+    def get_country(self, position: int):
+        return self.__strings.get(self.__country_ids[position])
+
+    def find_in_box(self, min_x, max_x, min_y, max_y):
+        '''
+        @return: array with the positions of the places inside the box
+        '''
+        size = self.__cell_size
+        first_column, last_column = int(np.floor(min_x / size)), int(np.floor(max_x / size))
+        first_row, last_row = int(np.floor(min_y / size)), int(np.floor(max_y / size))
+        columns = np.arange(first_column, last_column + 1, dtype=np.int64)
+        starts = np.searchsorted(self.__cells, columns * CELL_ROWS + first_row, side='left')
+        ends = np.searchsorted(self.__cells, columns * CELL_ROWS + last_row, side='right')
+        if len(columns) == 0 or not (ends - starts).any():
+            return np.empty(0, dtype=np.int64)
+        positions = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends) if end > start])
+        lon = self.__lon[positions]
+        lat = self.__lat[positions]
+        in_box = (lon >= min_x) & (lon <= max_x) & (lat >= min_y) & (lat <= max_y)
+        return positions[in_box]
+
+    def find_within(self, area):
+        '''
+        @param area: GDAL polygon or multipolygon
+        @return: array with the positions of the places inside the area
+        '''
+        if area is None or area.IsEmpty():
+            return np.empty(0, dtype=np.int64)
+        candidates = self.find_in_box(*area.GetEnvelope())
+        if len(candidates) == 0:
+            return candidates
+        inside = points_in_geometry(self.__lon[candidates], self.__lat[candidates], area)
+        return candidates[inside]
+
+    def __len__(self):
+        return len(self.__lon)
+
+
+def build_gazetteer(lon, lat, population, names, provinces, countries, cell_size=0.1):
+    '''
+    @param lon, lat, population: sequences with a value for each place
+    @param names, provinces, countries: sequences of strings with a value for each place
+    @return: a Gazetteer with the places sorted by cell and the strings interned
+    '''
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    columns = np.floor(lon / cell_size).astype(np.int64)
+    rows = np.floor(lat / cell_size).astype(np.int64)
+    cells = columns * CELL_ROWS + rows
+    order = np.argsort(cells, kind='stable')
+    strings, (name_ids, province_ids, country_ids) = intern_strings(names, provinces, countries)
+    return Gazetteer(cells[order], lon[order], lat[order], np.asarray(population, dtype=np.int64)[order],
+                     name_ids[order], province_ids[order], country_ids[order], strings, cell_size)
+
+
+def load_gazetteer_from_shapefile(path=CITIES_SHAPEFILE):
+    driver = ogr.GetDriverByName("ESRI Shapefile")
+    vector_italy = driver.Open(path, 0)
+    layer_italy = vector_italy.GetLayer(0)
+    lon, lat, population, names, provinces, countries = [], [], [], [], [], []
+    for feature in layer_italy:
+        geom = feature.GetGeometryRef()
+        lon.append(geom.GetX())
+        lat.append(geom.GetY())
+        population.append(int(feature.GetField("population") or 0))
+        names.append(feature.GetField("name"))
+        provinces.append(feature.GetField("province"))
+        countries.append(feature.GetField("country"))
+    vector_italy = None
+    return build_gazetteer(lon, lat, population, names, provinces, countries)
+
+
+def make_temporary_directory(directory):
+    '''
+    @return: a new directory next to directory, with a unique name:
+    processes building the same directory at the same time never write in the same place
+    '''
+    directory = directory.rstrip('/')
+    parent = os.path.dirname(directory) or '.'
+    os.makedirs(parent, exist_ok=True)
+    return tempfile.mkdtemp(prefix=os.path.basename(directory) + '.', suffix='.tmp', dir=parent)
+
+
+def move_directory_into_place(temporary_directory, directory, replace=False):
+    '''
+    renames a directory written in make_temporary_directory to directory.
+    If directory exists (e.g. another process built it first) the copy is discarded, unless replace is True:
+    then the old directory is renamed away before being deleted, so a process never maps a half deleted
+    directory and the ones that already mapped its files keep reading them
+    '''
+    directory = directory.rstrip('/')
+    old_directory = None
+    if replace and os.path.isdir(directory):
+        old_directory = make_temporary_directory(directory)
+        os.rename(directory, os.path.join(old_directory, 'old'))
+    try:
+        os.rename(temporary_directory, directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+        # renaming over a directory that is not empty fails: it has been built by another process
+        shutil.rmtree(temporary_directory)
+    if old_directory is not None:
+        shutil.rmtree(old_directory)
+
+
+def write_gazetteer(gazetteer: Gazetteer, directory=GAZETTEER_DIRECTORY, replace=False):
+    '''
+    saves the gazetteer as a directory of .npy columns.
+    Files are written in a temporary directory that is renamed at the end,
+    so a process never maps a half written gazetteer
+    @param replace: False to keep the gazetteer already in directory, if any (see move_directory_into_place)
+    '''
+    temporary_directory = make_temporary_directory(directory)
+    strings = gazetteer.get_strings()
+    columns = {'cells': gazetteer.get_cells(),
+               'lon': gazetteer.get_lon(),
+               'lat': gazetteer.get_lat(),
+               'population': gazetteer.get_population(),
+               'name_ids': gazetteer.get_name_ids(),
+               'province_ids': gazetteer.get_province_ids(),
+               'country_ids': gazetteer.get_country_ids(),
+               'strings_data': strings.get_data(),
+               'strings_offsets': strings.get_offsets()}
+    for name, column in columns.items():
+        np.save(os.path.join(temporary_directory, name + '.npy'), np.ascontiguousarray(column))
+    with open(os.path.join(temporary_directory, 'metadata.json'), 'w') as f:
+        json.dump({'version': GAZETTEER_FORMAT_VERSION, 'cell_size': gazetteer.get_cell_size(),
+                   'places': len(gazetteer)}, f)
+    move_directory_into_place(temporary_directory, directory, replace)
+
+
+def load_gazetteer(directory=GAZETTEER_DIRECTORY):
+    '''
+    memory maps a gazetteer saved by write_gazetteer: nothing is parsed or copied,
+    pages are read on demand and shared by all the processes mapping the same files
+    '''
+    with open(os.path.join(directory, 'metadata.json')) as f:
+        metadata = json.load(f)
+    if metadata['version'] != GAZETTEER_FORMAT_VERSION:
+        raise ValueError('gazetteer format version {} is not supported'.format(metadata['version']))
+
+    def column(name):
+        return np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+
+    strings = StringTable(column('strings_data'), column('strings_offsets'))
+    return Gazetteer(column('cells'), column('lon'), column('lat'), column('population'),
+                     column('name_ids'), column('province_ids'), column('country_ids'),
+                     strings, metadata['cell_size'])
+
+
+__gazetteer = None
+__gazetteer_lock = threading.Lock()
+
+
+def get_gazetteer():
+    '''
+    @return: the Gazetteer of Italy, mapped at the first call and shared afterwards.
+    If the compact gazetteer has not been built yet it is built from the shapefile
+    '''
+    global __gazetteer
+    with __gazetteer_lock:
+        if __gazetteer is None:
+            if not os.path.isfile(os.path.join(GAZETTEER_DIRECTORY, 'metadata.json')):
+                write_gazetteer(load_gazetteer_from_shapefile())
+            __gazetteer = load_gazetteer()
+    return __gazetteer
@@ -0,0 +1,350 @@
+import csv
+import re
+import threading
+import unicodedata
+from collections import Counter, deque
+from math import log10
+
+from server.earthquake_information.gazetteer import Gazetteer, get_gazetteer
+
+# names of places that are also common Italian words, matched only when capitalised after a locative preposition
+COMMON_WORDS = {
+    'acqua', 'alto', 'bagni', 'bagno', 'bar', 'bella', 'borgo', 'bosco', 'botta', 'campo', 'casa', 'case',
+    'castello', 'cava', 'cave', 'centrale', 'cento', 'centro', 'chiesa', 'citta', 'colle', 'croce', 'fermo',
+    'fiume', 'fontana', 'forte', 'giorno', 'grazie', 'grotte', 'ieri', 'isola', 'lago', 'lido', 'madonna', 'mare',
+    'marina', 'molino', 'monte', 'mulino', 'notte', 'oggi', 'ora', 'paese', 'palazzo', 'parco', 'paura', 'pace',
+    'pero', 'piano', 'pianura', 'piazza', 'poggio', 'ponte', 'porto', 'rio', 'santo', 'scala', 'scossa', 'sera',
+    'sesto', 'sole', 'stella', 'strada', 'terme', 'torre', 'troia', 'tutti', 'vado', 'valle', 'via', 'villa',
+    'vita', 'zone',
+    # months, capitalised in many tweets
+    'gennaio', 'febbraio', 'marzo', 'aprile', 'maggio', 'giugno', 'luglio', 'agosto', 'settembre', 'ottobre',
+    'novembre', 'dicembre',
+}
+# Italian names of the places that the gazetteer has in English (or in another form)
+ALIASES = {
+    'roma': 'rome', 'milano': 'milan', 'napoli': 'naples', 'firenze': 'florence', 'torino': 'turin',
+    'venezia': 'venice', 'genova': 'genoa', 'reggio emilia': 'reggio nell emilia',
+}
+# words before a name that make it more likely to be a place
+PREPOSITIONS = {'a', 'ad', 'da', 'di', 'in', 'su', 'sopra', 'vicino', 'presso', 'zona', 'verso', 'tra', 'fra'}
+# prepositions that put a place name in a locative position ('a Cento', 'in Pianura')
+LOCATIVE_PREPOSITIONS = {'a', 'ad', 'da', 'in'}
+# a place with fewer inhabitants must be capitalised or after a locative preposition to be matched
+LOW_POPULATION = 5000
+# labelled tweets, the words of the positives written in lowercase at least as often as capitalised are common words
+LABELLED_DATASETS = ['server/tweet_handling/EarthquakeTweetFM/EarthquakeTweetFM_dataset.csv',
+                     'server/tweet_handling/DamageTweetFM/DamageTweetFM_dataset.csv']
+NON_ALPHANUMERIC = re.compile(r'[^0-9A-Za-z]+')
+SENTENCE_END = re.compile(r'[.!?:;\n]+')
+# words, not the ones of hashtags and mentions that are often lowercased names
+WORD = re.compile(r'(?<![#@\w])[^\W\d_]+')
+
+
+def normalize_place_text(text: str, keep_case=False):
+    '''
+    @param keep_case: if True the text is not lowercased, it has the same length as the lowercased one
+    so the positions of the matches can be looked up in it
+    @return: the text lowercased, without accents and with a single space
+    between words and at both ends, so that names are matched only as whole words
+    '''
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    text = ' ' + ' '.join(NON_ALPHANUMERIC.sub(' ', text).split()) + ' '
+    return text if keep_case else text.lower()
+
+
+def common_words_from_datasets(paths=LABELLED_DATASETS):
+    '''
+    counts how many times every word of the positive labelled tweets is written in lowercase and capitalised,
+    the first word of a sentence is skipped since it is capitalised anyway, hashtags and mentions too
+    @return: set of the normalized words written in lowercase at least as often as capitalised
+    '''
+    lowercase = Counter()
+    capitalised = Counter()
+    for path in paths:
+        with open(path, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                # the tweets in other languages (the negatives) and the ones written all in lowercase
+                # would make names look like common words
+                if row['Label'] != 'pos':
+                    continue
+                words = [word for sentence in SENTENCE_END.split(row['Content'])
+                         for word in WORD.findall(sentence)[1:] if not word.isupper()]
+                if all(word.islower() for word in words):
+                    continue
+                for word in words:
+                    if word.islower():
+                        lowercase[normalize_place_text(word).strip()] += 1
+                    elif word[0].isupper():
+                        capitalised[normalize_place_text(word).strip()] += 1
+    return {word for word, count in lowercase.items() if count >= capitalised[word]}
+
+
+class AhoCorasickAutomaton:
+    """
+    Multi-pattern string matcher: all the patterns are compiled in a single
+    trie with failure links, so a text is scanned once, in time linear in its
+    length plus the number of matches, whatever the number of patterns.
+    """
+
+    def __init__(self, patterns):
+        '''
+        @param patterns: list of strings, a match reports the position of the pattern in this list
+        '''
+        self.__patterns = list(patterns)
+        # state -> {char: next state}
+        self.__goto = [{}]
+        self.__fail = [0]
+        # state -> ids of the patterns ending in the state, also through the failure links
+        self.__outputs = [()]
+        for pattern_id, pattern in enumerate(self.__patterns):
+            state = 0
+            for char in pattern:
+                next_state = self.__goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.__goto)
+                    self.__goto[state][char] = next_state
+                    self.__goto.append({})
+                    self.__fail.append(0)
+                    self.__outputs.append(())
+                state = next_state
+            self.__outputs[state] = self.__outputs[state] + (pattern_id,)
+        self.__link()
+
+    def __link(self):
+        # breadth first, so the failure state of a state is always computed before it
+        queue = deque(self.__goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.__goto[state].items():
+                queue.append(next_state)
+                fail = self.__fail[state]
+                while fail and char not in self.__goto[fail]:
+                    fail = self.__fail[fail]
+                fail = self.__goto[fail].get(char, 0)
+                self.__fail[next_state] = fail if fail != next_state else 0
+                self.__outputs[next_state] = self.__outputs[next_state] + self.__outputs[self.__fail[next_state]]
+
+    def get_patterns(self):
+        return self.__patterns
+
+    def get_states_number(self):
+        return len(self.__goto)
+
+    def find_all(self, text: str):
+        '''
+        @return: list of (end position, pattern id) of all the occurrences, overlapping ones too
+        '''
+        goto = self.__goto
+        fail = self.__fail
+        outputs = self.__outputs
+        matches = []
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if outputs[state]:
+                for pattern_id in outputs[state]:
+                    matches.append((position + 1, pattern_id))
+        return matches
+
+
+class GeoparsedPlace:
+    """
+    place of the gazetteer found in a text, with the confidence that the text refers to it
+    """
+
+    def __init__(self, name, lon, lat, population, confidence):
+        self.__name = name
+        self.__lon = lon
+        self.__lat = lat
+        self.__population = population
+        self.__confidence = confidence
+
+    def get_name(self):
+        return self.__name
+
+    def get_lon(self):
+        return self.__lon
+
+    def get_lat(self):
+        return self.__lat
+
+    def get_population(self):
+        return self.__population
+
+    def get_confidence(self):
+        return self.__confidence
+
+    def __str__(self):
+        return '{} ({:.4f}, {:.4f}), confidence {:.2f}'.format(self.__name, self.__lon, self.__lat,
+                                                                self.__confidence)
+
+
+class Geoparser:
+    """
+    Finds the names of the gazetteer places in the text of the tweets.
+    Homonymous places are resolved to the most populated one, and the confidence
+    of a match grows with its population, with its share of the population of the
+    homonyms and with the length of the name; a preceding preposition ('a', 'in', 'vicino'...)
+    raises it. Names shorter than min_name_length are ignored.
+    Names that are also common words (COMMON_WORDS and the ones found by common_words_from_datasets)
+    are matched only when capitalised and after a locative preposition ('a', 'in', 'da'),
+    the names of places with less than LOW_POPULATION inhabitants when capitalised or after one.
+    """
+
+    def __init__(self, gazetteer: Gazetteer = None, min_name_length=4, min_confidence=0.3, common_words=None):
+        '''
+        @param common_words: set of normalized words, common_words_from_datasets() if None
+        '''
+        if gazetteer is None:
+            gazetteer = get_gazetteer()
+        if common_words is None:
+            common_words = common_words_from_datasets()
+        common_words = common_words | COMMON_WORDS
+        self.__min_confidence = min_confidence
+        population = gazetteer.get_population()
+        # normalized name -> [best position, its population, total population of the homonyms]
+        places = {}
+        strings = gazetteer.get_strings()
+        names = {}
+        for position, name_id in enumerate(gazetteer.get_name_ids()):
+            name = names.get(name_id)
+            if name is None:
+                name = normalize_place_text(strings.get(name_id)).strip()
+                names[name_id] = name
+            if len(name) < min_name_length:
+                continue
+            place_population = int(population[position])
+            place = places.get(name)
+            if place is None:
+                places[name] = [position, place_population, place_population]
+            else:
+                place[2] += place_population
+                if place_population > place[1]:
+                    place[0] = position
+                    place[1] = place_population
+        for alias, name in ALIASES.items():
+            if name in places:
+                places[alias] = places[name]
+        self.__names = sorted(places)
+        self.__places = []
+        # for every name: 2 if it must be capitalised and after a locative preposition, 1 if either, 0 if neither
+        self.__requirements = []
+        lon = gazetteer.get_lon()
+        lat = gazetteer.get_lat()
+        for name in self.__names:
+            position, place_population, total_population = places[name]
+            share = (place_population + 1) / (total_population + 1)
+            population_score = min(1.0, log10(place_population + 10) / 5)
+            length_score = min(1.0, len(name) / 8)
+            confidence = share * (0.5 + 0.5 * population_score) * (0.5 + 0.5 * length_score)
+            self.__places.append(GeoparsedPlace(gazetteer.get_name(position), float(lon[position]),
+                                                float(lat[position]), place_population, confidence))
+            if name in common_words:
+                self.__requirements.append(2)
+            else:
+                self.__requirements.append(1 if place_population < LOW_POPULATION else 0)
+        self.__automaton = AhoCorasickAutomaton([' ' + name + ' ' for name in self.__names])
+
+    def get_names_number(self):
+        return len(self.__names)
+
+    def get_automaton(self):
+        return self.__automaton
+
+    def find_places(self, text: str):
+        '''
+        @return: list of (GeoparsedPlace, confidence of the match) of all the places named in the text
+        '''
+        cased_text = normalize_place_text(text, keep_case=True)
+        text = cased_text.lower()
+        found = []
+        for end, pattern_id in self.__automaton.find_all(text):
+            place = self.__places[pattern_id]
+            confidence = place.get_confidence()
+            start = end - len(self.__names[pattern_id]) - 2
+            previous_word = text[:start + 1].rsplit(' ', 2)[-2] if start > 0 else ''
+            requirement = self.__requirements[pattern_id]
+            if requirement:
+                # capitalised but not at the start of the text nor written all in uppercase
+                capitalised = start > 0 and cased_text[start + 1].isupper() and cased_text[start + 2].islower()
+                evidence = capitalised + (previous_word in LOCATIVE_PREPOSITIONS)
+                if evidence < requirement:
+                    continue
+            if previous_word in PREPOSITIONS:
+                confidence = min(1.0, confidence * 1.5)
+            found.append((place, confidence))
+        return found
+
+    def locate(self, text: str):
+        '''
+        @return: the most likely place named in the text, as a GeoparsedPlace with the confidence
+        of the match, or None if no place reaches min_confidence
+        '''
+        best = None
+        best_confidence = self.__min_confidence
+        for place, confidence in self.find_places(text):
+            if confidence >= best_confidence:
+                best = place
+                best_confidence = confidence
+        if best is None:
+            return None
+        return GeoparsedPlace(best.get_name(), best.get_lon(), best.get_lat(), best.get_population(),
+                              best_confidence)
+
+    def locate_tweets(self, tweets):
+        '''
+        sets the location of the tweets without a geometry to the place named in their text
+        @return: number of tweets located
+        '''
+        located = 0
+        for tweet in tweets:
+            if tweet.has_location():
+                continue
+            place = self.locate(tweet.get_text())
+            if place is not None:
+                tweet.set_geoparsed_location(place.get_lon(), place.get_lat(), place.get_name(),
+                                             place.get_confidence())
+                located += 1
+        return located
+
+
+__geoparser = None
+__geoparser_lock = threading.Lock()
+
+
+def get_geoparser():
+    '''
+    @return: the Geoparser of the Italian gazetteer, compiled at the first call and shared afterwards
+    '''
+    global __geoparser
+    with __geoparser_lock:
+        if __geoparser is None:
+            __geoparser = Geoparser()
+    return __geoparser
+
+
+if __name__ == '__main__':
+    '''
+        measures how many tweets of the earthquake dataset are located and how fast
+    '''
+    import time
+    import pandas as pd
+
+    start = time.perf_counter()
+    geoparser = get_geoparser()
+    print('compiled {} names in {} states in {:.2f} s'.format(geoparser.get_names_number(),
+                                                               geoparser.get_automaton().get_states_number(),
+                                                               time.perf_counter() - start))
+    data = pd.read_csv('server/tweet_handling/EarthquakeTweetFM/EarthquakeTweetFM_dataset.csv')
+    texts = list(data[data['Label'] == 'pos']['Content'])
+    start = time.perf_counter()
+    places = [geoparser.locate(text) for text in texts]
+    elapsed = time.perf_counter() - start
+    located = [(text, place) for text, place in zip(texts, places) if place is not None]
+    print('located {} of {} positive tweets, {:.0f} tweets/s'.format(len(located), len(texts),
+                                                                     len(texts) / elapsed))
+    for text, place in located[:10]:
+        print(place, '<-', text)
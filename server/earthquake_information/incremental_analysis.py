@@ -0,0 +1,261 @@
+from collections import deque
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from server.earthquake_information.earthquake_faults_finder import EarthquakeFault, StreamingPointClusterizer, \
+    polygon_faults_probabilities
+from server.earthquake_information.faults_scoring import VectorizedFaultsScorer
+
+
+class TweetRetention:
+    """
+    Tweets kept for the analysis, in arrival order: the ones older than ttl
+    (by the time they were posted) and the oldest ones over max_tweets are dropped.
+    Tweets are dropped only when the limits are exceeded by a slack fraction,
+    so the layers written from the retained tweets are rebuilt seldom.
+    Ages are measured on the clock of the stream, the newest time posted of the retained tweets,
+    so a replayed corpus of old tweets is retained as a live one.
+    """
+
+    def __init__(self, ttl: timedelta = timedelta(hours=2), max_tweets=20000, slack=0.1):
+        self.__ttl = ttl
+        self.__max_tweets = max_tweets
+        self.__slack = slack
+        self.__tweets = []
+        # newest time posted of the retained tweets
+        self.__clock = None
+
+    def get_ttl(self):
+        return self.__ttl
+
+    def get_max_tweets(self):
+        return self.__max_tweets
+
+    def get_tweets(self):
+        return self.__tweets
+
+    def get_clock(self):
+        '''
+        @return: the newest time posted of the retained tweets, None if none of them has it
+        '''
+        return self.__clock
+
+    def add(self, tweets):
+        self.__tweets.extend(tweets)
+        for tweet in tweets:
+            time_posted = tweet.get_time_posted()
+            if time_posted is not None and (self.__clock is None or time_posted > self.__clock):
+                self.__clock = time_posted
+
+    def clear(self):
+        self.__tweets = []
+        self.__clock = None
+
+    def expire(self, now: datetime = None):
+        '''
+        @param now: naive UTC datetime, the clock of the stream (see get_clock) if None
+        @return: list of the dropped tweets, the oldest first
+        '''
+        if not self.__tweets:
+            return []
+        if now is None:
+            now = self.__clock
+        if now is None:
+            now = datetime.utcnow()
+        oldest_allowed = now - self.__ttl
+        slack_limit = oldest_allowed - self.__ttl * self.__slack
+        oldest = self.__tweets[0].get_time_posted()
+        too_many = len(self.__tweets) > self.__max_tweets * (1 + self.__slack)
+        too_old = oldest is not None and oldest < slack_limit
+        if not too_many and not too_old:
+            return []
+        dropped = max(0, len(self.__tweets) - self.__max_tweets)
+        while dropped < len(self.__tweets):
+            time_posted = self.__tweets[dropped].get_time_posted()
+            if time_posted is None or time_posted >= oldest_allowed:
+                break
+            dropped += 1
+        expired = self.__tweets[:dropped]
+        del self.__tweets[:dropped]
+        return expired
+
+    def __len__(self):
+        return len(self.__tweets)
+
+
+class IncrementalFaultsRanking:
+    """
+    Keeps the sum of the fault probabilities of every located tweet, so adding
+    or removing a tweet updates the ranking of the faults in O(faults)
+    instead of scoring all the retained tweets again.
+    The ranking is published (faults, area at risk and municipalities are computed again)
+    only when the top max_faults change or one of their probabilities moves more than tolerance.
+    With the default scorer (degrees, not km) the probabilities are the ones of EarthquakeFaultsFinder.
+    With a clusterizer, faults are scored against the hull of every cluster of tweets instead of every tweet,
+    like EarthquakeFaultsFinder with a PointsToPolygon: only the clusters changed by the new tweets are scored again.
+    The probabilities of a cluster are weighted by its number of (core) points, so a stray tweet
+    does not weigh as much as a cluster of hundreds.
+    """
+
+    def __init__(self, scorer: VectorizedFaultsScorer = None, max_faults=3, search_distance=0.7, tolerance=0.05,
+                 clusterizer: StreamingPointClusterizer = None):
+        if scorer is None:
+            scorer = VectorizedFaultsScorer(metric=False)
+        self.__scorer = scorer
+        self.__clusterizer = clusterizer
+        # cluster -> probabilities of the faults for its hull
+        self.__cluster_rows = {}
+        self.__max_faults = max_faults
+        self.__search_distance = search_distance
+        self.__tolerance = tolerance
+        self.__rows = deque()
+        self.__sum = np.zeros(len(scorer.get_catalogue()))
+        # top fault position -> probability, when the faults were last published
+        self.__published = None
+
+    def get_tolerance(self):
+        return self.__tolerance
+
+    def get_points_number(self):
+        if self.__clusterizer is not None:
+            return self.__clusterizer.get_points_number()
+        return len(self.__rows)
+
+    def get_clusterizer(self):
+        return self.__clusterizer
+
+    def __update_clusters(self):
+        removed, changed = self.__clusterizer.pop_changes()
+        for cluster in removed:
+            self.__cluster_rows.pop(cluster, None)
+        catalogue = self.__scorer.get_catalogue()
+        for cluster in changed:
+            row = np.zeros(len(catalogue))
+            probabilities = polygon_faults_probabilities(self.__clusterizer.get_hull(cluster), catalogue,
+                                                         self.__search_distance)
+            for position, probability in probabilities.items():
+                row[position] = probability
+            self.__cluster_rows[cluster] = row
+
+    def add_tweets(self, tweets):
+        '''
+        scores the located tweets (or the clusters they change) and adds them to the ranking
+        '''
+        coordinates = [(tweet.lon, tweet.lat) for tweet in tweets if tweet.has_location()]
+        if not coordinates:
+            return
+        if self.__clusterizer is not None:
+            self.__clusterizer.add_points(coordinates)
+            self.__update_clusters()
+            return
+        rows = self.__scorer.get_probabilities_matrix(np.array(coordinates), self.__search_distance)
+        self.__sum += rows.sum(axis=0)
+        self.__rows.extend(rows.astype(np.float32))
+
+    def remove_oldest(self, number: int):
+        '''
+        removes the oldest number located tweets, e.g. the ones dropped by a TweetRetention
+        '''
+        if number <= 0:
+            return
+        if self.__clusterizer is not None:
+            self.__clusterizer.remove_oldest(number)
+            self.__update_clusters()
+            return
+        for i in range(min(number, len(self.__rows))):
+            self.__rows.popleft()
+        # computed again instead of subtracted, so rounding errors do not pile up
+        if self.__rows:
+            self.__sum = np.sum(np.array(self.__rows, dtype=np.float64), axis=0)
+        else:
+            self.__sum = np.zeros_like(self.__sum)
+
+    def clear(self):
+        if self.__clusterizer is not None:
+            self.__clusterizer.clear()
+            self.__clusterizer.pop_changes()
+        self.__cluster_rows = {}
+        self.__rows.clear()
+        self.__sum = np.zeros_like(self.__sum)
+        self.__published = None
+
+    def get_probabilities(self):
+        '''
+        @return: array with the mean probability of every fault over the retained points
+        (or over the clusters, weighted by their points)
+        '''
+        if self.__clusterizer is not None:
+            if not self.__cluster_rows:
+                return np.zeros_like(self.__sum)
+            # read at every call: a cluster grows without being changed when its hull does not
+            clusters = list(self.__cluster_rows)
+            weights = np.array([self.__clusterizer.get_cluster_size(cluster) for cluster in clusters],
+                               dtype=np.float64)
+            rows = np.array([self.__cluster_rows[cluster] for cluster in clusters])
+            return weights @ rows / weights.sum()
+        if not self.__rows:
+            return np.zeros_like(self.__sum)
+        return self.__sum / len(self.__rows)
+
+    def get_top_positions(self):
+        '''
+        @return: catalogue positions of the most probable faults (probability > 0), the most probable first
+        '''
+        probabilities = self.get_probabilities()
+        order = np.argsort(-probabilities, kind='stable')
+        if self.__max_faults:
+            order = order[:self.__max_faults]
+        return [int(position) for position in order if probabilities[position] > 0]
+
+    def is_update_needed(self):
+        '''
+        @return: True if the top faults changed since the last mark_published,
+        or if the probability of one of them moved more than the tolerance.
+        A swap in the order of the same faults is not a change: the area at risk is the same
+        '''
+        positions = self.get_top_positions()
+        if not positions:
+            return False
+        if self.__published is None or set(positions) != set(self.__published):
+            return True
+        probabilities = self.get_probabilities()
+        return any(abs(probabilities[position] - published_probability) > self.__tolerance
+                   for position, published_probability in self.__published.items())
+
+    def mark_published(self):
+        probabilities = self.get_probabilities()
+        self.__published = {position: float(probabilities[position]) for position in self.get_top_positions()}
+
+    def get_faults(self):
+        '''
+        @return: list of EarthquakeFault of the top faults, the most probable first
+        '''
+        catalogue = self.__scorer.get_catalogue()
+        probabilities = self.get_probabilities()
+        return [EarthquakeFault(catalogue.get_geometry(position), float(probabilities[position]),
+                                catalogue.get_fault_id(position))
+                for position in self.get_top_positions()]
+
+
+if __name__ == '__main__':
+    '''
+        replays three hours of tweets posted years ago, one a minute:
+        the retention keeps the last two hours of them, measured on the clock of the stream
+    '''
+    from server.tweet_handling.tweet_filtering import TweetUsefulInfos, datetime_to_timestamp
+
+    start_time = datetime(2016, 8, 24, 1, 36)
+    tweet_retention = TweetRetention(ttl=timedelta(hours=2), slack=0.1)
+    for minute in range(180):
+        replayed_tweet = TweetUsefulInfos()
+        replayed_tweet.__setstate__((minute, 'terremoto', 'replay', None, 13.2, 42.7,
+                                     datetime_to_timestamp(start_time + timedelta(minutes=minute)), None, 1.0))
+        tweet_retention.add([replayed_tweet])
+        tweet_retention.expire()
+        assert len(tweet_retention) > 0
+    oldest_retained = tweet_retention.get_tweets()[0].get_time_posted()
+    print('{} tweets retained, from {} to {}'.format(len(tweet_retention), oldest_retained,
+                                                     tweet_retention.get_clock()))
+    assert tweet_retention.get_clock() - oldest_retained <= timedelta(hours=2, minutes=12)
+    assert len(tweet_retention) >= 120
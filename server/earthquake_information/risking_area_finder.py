@@ -1,14 +1,26 @@
-from copy import deepcopy
+from osgeo import ogr
 
-from osgeo import osr, ogr
+from server.earthquake_information.fault_exposure import get_fault_exposure
+from server.earthquake_information.gazetteer import get_gazetteer
 
 
 class RiskingAreaFinder:
-    def __init__(self, faults_buffer=0.3):
+    def __init__(self, faults_buffer=0.3, layer_name='ISS321', use_exposure=True):
         self.faultsBuffer = faults_buffer
+        # if set, the buffers and the municipalities of the catalogue faults are read from the exposure table
+        self.__layer_name = layer_name
+        self.__use_exposure = use_exposure
 
     # todo use class EarthquakeFaults
     def find_risking_area(self, faults: []):
+        if self.__use_exposure:
+            exposure = get_fault_exposure(self.__layer_name, self.faultsBuffer)
+            positions = [exposure.get_position(fault.get_fault_id()) for fault in faults]
+            if None not in positions:
+                risking_area_geom, municipality_positions = exposure.find_exposure(positions)
+                municipalities, population = self.__municipalities_at(municipality_positions)
+                return RiskingArea(risking_area_geom, municipalities, population)
+
         risking_area_geom = ogr.Geometry(ogr.wkbPolygon)
 
         # find a 15km buffer for each candidate and do the union of them
@@ -21,34 +33,24 @@ class RiskingAreaFinder:
 
     @staticmethod
     def __find_cities_at_risk(area):
-        drvName = "ESRI Shapefile"
-        driver = ogr.GetDriverByName(drvName)
-        italy_shp = 'server/earthquake_information/cities500/cities500_IT.shp'
-        vector_italy = driver.Open(italy_shp, 0)
-        layer_italy = vector_italy.GetLayer(0)
-        earthquake_municipalities = []
+        # the gazetteer is loaded once and only the places in the area envelope are tested
+        return RiskingAreaFinder.__municipalities_at(get_gazetteer().find_within(area))
 
-        srs_italy = layer_italy.GetSpatialRef()
-        target_osr = osr.SpatialReference()
-        target_osr.ImportFromEPSG(4326)  # SRS of UTM 32N
-        transform = osr.CoordinateTransformation(srs_italy, target_osr)
-
-        earthquake_population = 0
-        for feature in layer_italy:
-            geom = feature.GetGeometryRef()
-            # geom.Transform(transform)
-            if geom.Within(area):
-                name_id = feature.GetFieldIndex("name")
-                population_id = feature.GetFieldIndex("population")
-                country_code_id = feature.GetFieldIndex("country")
-                province_id = feature.GetFieldIndex("province")
-                name = feature.GetField(name_id)
-                population = feature.GetField(population_id)
-                country = feature.GetField(country_code_id)
-                province = feature.GetField(province_id)
-                earthquake_municipalities.append(Municipality(name, province, country,
-                                                              population, deepcopy(geom)))
-                earthquake_population += int(population)
+    @staticmethod
+    def __municipalities_at(positions):
+        gazetteer = get_gazetteer()
+        earthquake_municipalities = []
+        lon = gazetteer.get_lon()
+        lat = gazetteer.get_lat()
+        population = gazetteer.get_population()
+        for position in positions:
+            geom = ogr.Geometry(ogr.wkbPoint)
+            geom.AddPoint(float(lon[position]), float(lat[position]))
+            earthquake_municipalities.append(Municipality(gazetteer.get_name(position),
+                                                          gazetteer.get_province(position),
+                                                          gazetteer.get_country(position),
+                                                          int(population[position]), geom))
+        earthquake_population = int(population[positions].sum())
 
         return earthquake_municipalities, earthquake_population
 
@@ -0,0 +1,55 @@
+from collections import defaultdict
+from math import floor
+
+
+class GridIndex:
+    """
+    Uniform grid index over bounding boxes.
+    Every item is registered in all the cells its bounding box
+    overlaps, so a query only looks at the items stored in the
+    cells covered by the query box instead of scanning all of them.
+    """
+
+    def __init__(self, cell_size=0.5):
+        """
+        @param cell_size: side of a grid cell, in the same units of the indexed boxes
+        """
+        self.__cell_size = cell_size
+        self.__cells = defaultdict(list)
+        self.__size = 0
+
+    def __cell_range(self, min_x, max_x, min_y, max_y):
+        size = self.__cell_size
+        return (int(floor(min_x / size)), int(floor(max_x / size)),
+                int(floor(min_y / size)), int(floor(max_y / size)))
+
+    def get_cell_size(self):
+        return self.__cell_size
+
+    def insert(self, item, min_x, max_x, min_y, max_y):
+        '''
+        registers an item with its bounding box (same order as OGR GetEnvelope)
+        @param item: any hashable value, usually an index in an external array
+        '''
+        first_i, last_i, first_j, last_j = self.__cell_range(min_x, max_x, min_y, max_y)
+        for i in range(first_i, last_i + 1):
+            for j in range(first_j, last_j + 1):
+                self.__cells[(i, j)].append(item)
+        self.__size = self.__size + 1
+
+    def query(self, min_x, max_x, min_y, max_y):
+        '''
+        @return: set of the items whose cells overlap the given box.
+        It is a superset of the items whose boxes really intersect it
+        '''
+        first_i, last_i, first_j, last_j = self.__cell_range(min_x, max_x, min_y, max_y)
+        items = set()
+        for i in range(first_i, last_i + 1):
+            for j in range(first_j, last_j + 1):
+                cell = self.__cells.get((i, j))
+                if cell:
+                    items.update(cell)
+        return items
+
+    def __len__(self):
+        return self.__size
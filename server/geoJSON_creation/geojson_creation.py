@@ -1,61 +1,241 @@
-from osgeo import ogr
+"""
+Writes the GeoJSON layers of the map (tweets, faults, area at risk, municipalities).
 
+Every write, appends included, replaces the layer file atomically: the content is written to a
+temporary file that is renamed over the layer, so the web server, save_geoJSON_in_folder and
+any other reader never see a truncated layer, and a crash never corrupts it.
+The cost is that appending k features to a layer of n serializes only the k new objects
+(the encoded features are kept by LayerContent) but writes O(n) bytes. Layers are bounded by the
+tweet retention (a few MB at most), and the same bytes are published as the in memory snapshot
+served to the clients, so writing them once more is cheaper than keeping readers and writers in sync
+on a file modified in place.
+"""
+import json
+import os
+import threading
 
-def object_list_to_geojson_file(filename, object_list):
-    file_path = 'server/geoJSON_creation/geojson_data/' + str(filename) + '.geojson'
-    # Create the output Driver
-    outDriver = ogr.GetDriverByName('GeoJSON')
-    outDataSource = outDriver.CreateDataSource(file_path)
-    if object_list:
-        found_geometry = False
-        i = 0
-        while not found_geometry and i < len(object_list):
-            if object_list[i].get_geometry():
-                geometry_type = object_list[i].get_geometry().GetGeometryType()
-                found_geometry = True
-            i = i + 1
-
-        if found_geometry:
-            outLayer = outDataSource.CreateLayer(filename.replace("_", " ").title(),
-                                                 geom_type=geometry_type)
-
-            # Get the output Layer's Feature Definition
-            featureDefn = outLayer.GetLayerDefn()
-
-            # create fields
-            for attribute in dir(object_list[0]):
-                if attribute[0:3] == 'get' and attribute[4:len(
-                        attribute)] != 'geometry':  # take all the attributes (different from the geometry) by using the methods starting with "get"
-                    outLayer.CreateField(ogr.FieldDefn(attribute[4:len(attribute)], ogr.OFTString))
-
-            for object in object_list:
-                if object.get_geometry():
-                    # create a new feature
-                    outFeature = ogr.Feature(featureDefn)
-
-                    # set geometry
-                    outFeature.SetGeometry(object.get_geometry())
-
-                    # set fields
-                    for attribute in dir(object):
-                        if attribute[0:3] == 'get' and attribute[4:len(
-                                attribute)] != 'geometry':  # take all the attributes (different from the geometry) by using the methods starting with "get"
-                            result = getattr(object, attribute)()
-                            attr_value = ''
-                            if type(result) == list:
-                                attr_value = attr_value + '['
-                                list_to_string = ', '.join([str(elem) for elem in result])
-                                attr_value = attr_value + list_to_string + ']'
-                            else:
-                                attr_value = str(result)
-                            outFeature.SetField(attribute[4:len(attribute)], attr_value)
-                    outLayer.CreateFeature(outFeature)
-            outFeature = None
-            outDataSource = None
-        else:
-            outDataSource.CreateLayer(filename.replace("_", " ").title(), geom_type=0)
-            print(
-                'created empty geojson file <' + filename + '>: there are only element without geometry in the list')
+from server.geoJSON_creation.geojson_publishing import publish_layer
+
+GEOJSON_DATA_DIRECTORY = 'server/geoJSON_creation/geojson_data/'
+FEATURES_SEPARATOR = ',\n'
+FOOTER = '\n]\n}\n'
+FOOTER_BYTES = FOOTER.encode('utf-8')
+
+
+def layer_name(filename):
+    return filename.replace("_", " ").title()
+
+
+def layer_header(filename):
+    return '{\n"type": "FeatureCollection",\n"name": "' + layer_name(filename) + '",\n"features": [\n'
+
+
+class LayerContent:
+    """
+    Content of the GeoJSON file of a layer, kept encoded: the features added
+    are appended to it, so the features written before are not joined again at every append.
+    """
+
+    def __init__(self, filename):
+        self.__header = layer_header(filename).encode('utf-8')
+        self.__body = bytearray()
+        self.__features_number = 0
+
+    def get_features_number(self):
+        return self.__features_number
+
+    def replace(self, features):
+        '''
+        @param features: GeoJSON features, as strings
+        '''
+        self.__body = bytearray(FEATURES_SEPARATOR.join(features).encode('utf-8'))
+        self.__features_number = len(features)
+
+    def extend(self, features):
+        if not features:
+            return
+        text = FEATURES_SEPARATOR.join(features)
+        if self.__features_number:
+            text = FEATURES_SEPARATOR + text
+        self.__body += text.encode('utf-8')
+        self.__features_number += len(features)
+
+    def get_data(self):
+        '''
+        @return: the whole content of the file, as bytes
+        '''
+        return self.__header + self.__body + FOOTER_BYTES
+
+
+def value_to_string(result):
+    attr_value = ''
+    if type(result) == list:
+        attr_value = attr_value + '['
+        list_to_string = ', '.join([str(elem) for elem in result])
+        attr_value = attr_value + list_to_string + ']'
     else:
-        outDataSource.CreateLayer(filename.replace("_", " ").title(), geom_type=0)
-        print('created empty geojson file <' + filename + '>: there are no element in the list')
+        attr_value = str(result)
+    return attr_value
+
+
+__schemas = {}
+
+
+def get_schema(object_class):
+    '''
+    @return: list of (field name, getter name) of the class, sorted by name.
+    Fields are all the attributes (different from the geometry) exposed by a method starting with "get".
+    The list is computed once for each class
+    '''
+    schema = __schemas.get(object_class)
+    if schema is None:
+        schema = []
+        for attribute in dir(object_class):
+            if attribute[0:3] == 'get' and attribute[4:len(attribute)] != 'geometry':
+                schema.append((attribute[4:len(attribute)], attribute))
+        __schemas[object_class] = schema
+    return schema
+
+
+def object_to_feature(object):
+    '''
+    @return: the GeoJSON feature of the object as a string, None if it has no geometry
+    '''
+    geometry = object.get_geometry()
+    if not geometry:
+        return None
+    properties = {}
+    for field, getter in get_schema(type(object)):
+        value = getattr(object, getter)()
+        # unset values (e.g. the damage of a tweet when the cascade filter does not run) are not written
+        if value is not None:
+            properties[field] = value_to_string(value)
+    return '{ "type": "Feature", "properties": ' + json.dumps(properties, ensure_ascii=False) + \
+           ', "geometry": ' + geometry.ExportToJson() + ' }'
+
+
+class GeoJSONWriter:
+    """
+    Writes a list of objects in a GeoJSON file, one feature for each object with a geometry.
+    Features are serialized directly, with the fields of each class found only once.
+    The file is always replaced atomically (temporary file + rename), see the module documentation
+    for the cost of append: only the new objects are serialized, but the whole layer is written.
+    If publish is True every new content is also published as an in memory snapshot
+    for the web server (see geojson_publishing).
+    """
+
+    def __init__(self, filename, directory=GEOJSON_DATA_DIRECTORY, publish=True):
+        self.__filename = filename
+        self.__file_path = os.path.join(directory, str(filename) + '.geojson')
+        self.__publish = publish
+        self.__content = LayerContent(filename)
+        # True when the file has been written by this writer and can be appended to
+        self.__appendable = False
+        self.__lock = threading.Lock()
+
+    def get_file_path(self):
+        return self.__file_path
+
+    def get_features_number(self):
+        return self.__content.get_features_number()
+
+    def __replace_file(self, features, replace):
+        '''
+        writes the content to a temporary file renamed over the layer, and publishes it
+        '''
+        data = self.__content.get_data()
+        temporary_path = self.__file_path + '.tmp'
+        with open(temporary_path, 'wb') as f:
+            f.write(data)
+        os.replace(temporary_path, self.__file_path)
+        if self.__publish:
+            publish_layer(self.__filename, data, features, replace)
+
+    def write(self, object_list):
+        '''
+        replaces the file with the features of the objects
+        @return: list of the features written, as strings
+        '''
+        features = [feature for feature in map(object_to_feature, object_list or []) if feature is not None]
+        if not object_list:
+            print('created empty geojson file <' + self.__filename + '>: there are no element in the list')
+        elif not features:
+            print('created empty geojson file <' + self.__filename +
+                  '>: there are only element without geometry in the list')
+        with self.__lock:
+            self.__content.replace(features)
+            self.__replace_file(features, replace=True)
+            self.__appendable = True
+        notify_write_listeners(self.__filename, object_list or [], True)
+        return features
+
+    def append(self, object_list):
+        '''
+        adds the features of the objects at the end of the file.
+        If the file was not written by this writer it is written from scratch with the objects
+        @return: list of the features added, as strings
+        '''
+        with self.__lock:
+            appendable = self.__appendable and os.path.isfile(self.__file_path)
+        if not appendable:
+            return self.write(object_list)
+        features = [feature for feature in map(object_to_feature, object_list) if feature is not None]
+        if not features:
+            return features
+        with self.__lock:
+            self.__content.extend(features)
+            self.__replace_file(features, replace=False)
+        notify_write_listeners(self.__filename, object_list, False)
+        return features
+
+
+__writers = {}
+__writers_lock = threading.Lock()
+__write_listeners = []
+
+
+def add_write_listener(listener):
+    '''
+    @param listener: callable(filename, object_list, replace) called after a layer
+    has been written (replace=True) or appended to (replace=False)
+    '''
+    __write_listeners.append(listener)
+
+
+def remove_write_listener(listener):
+    __write_listeners.remove(listener)
+
+
+def notify_write_listeners(filename, object_list, replace):
+    for listener in __write_listeners:
+        listener(filename, object_list, replace)
+
+
+def set_geojson_data_directory(directory):
+    '''
+    changes the directory of the layers written from now on (e.g. for benchmarks)
+    '''
+    global GEOJSON_DATA_DIRECTORY
+    with __writers_lock:
+        GEOJSON_DATA_DIRECTORY = directory
+        __writers.clear()
+
+
+def get_writer(filename):
+    '''
+    @return: the GeoJSONWriter of the file, the same for every caller
+    '''
+    with __writers_lock:
+        writer = __writers.get(filename)
+        if writer is None:
+            writer = GeoJSONWriter(filename, GEOJSON_DATA_DIRECTORY)
+            __writers[filename] = writer
+    return writer
+
+
+def object_list_to_geojson_file(filename, object_list):
+    get_writer(filename).write(object_list)
+
+
+def append_objects_to_geojson_file(filename, object_list):
+    get_writer(filename).append(object_list)
@@ -0,0 +1,165 @@
+import gzip
+import hashlib
+import os
+import threading
+import time
+from collections import deque
+
+LAYERS = ['tweets', 'faults', 'area_at_risk', 'municipalities']
+
+
+class LayerSnapshot:
+    """
+    Immutable copy of the content of a GeoJSON layer, as served to the clients.
+    The ETag is the hash of the content only, so a client that has the same content gets a 304
+    whatever the version. The gzipped content is computed the first time a client asks for it,
+    once for each snapshot.
+    """
+
+    def __init__(self, name, version: int, data: bytes):
+        self.__name = name
+        self.__version = version
+        self.__data = data
+        self.__etag = '"{}"'.format(hashlib.blake2b(data, digest_size=16).hexdigest())
+        self.__published_at = time.time()
+        self.__gzipped = None
+        self.__lock = threading.Lock()
+
+    def get_name(self):
+        return self.__name
+
+    def get_version(self):
+        return self.__version
+
+    def get_data(self):
+        return self.__data
+
+    def get_etag(self):
+        return self.__etag
+
+    def get_published_at(self):
+        return self.__published_at
+
+    def get_gzipped_data(self):
+        with self.__lock:
+            if self.__gzipped is None:
+                self.__gzipped = gzip.compress(self.__data, compresslevel=6)
+        return self.__gzipped
+
+
+class LayerSnapshots:
+    """
+    Latest published snapshot of every layer.
+    The pipeline publishes a new snapshot after writing a layer,
+    the web server reads them without touching the files.
+    Every publication also gets a global sequence number and a delta
+    (the features added to the layer, or all its features if it was replaced);
+    the last max_deltas deltas are kept for the clients of the live feed.
+    """
+
+    def __init__(self, max_deltas=1000):
+        self.__snapshots = {}
+        self.__versions = {}
+        self.__sequence = 0
+        self.__deltas = deque(maxlen=max_deltas)
+        self.__lock = threading.Lock()
+
+    def publish(self, name, data: bytes, features=None, replace=True):
+        '''
+        @param data: the whole content of the layer
+        @param features: GeoJSON features (strings) of the delta, None if unknown
+        @param replace: True if the features replace the layer, False if they are added to it
+        @return: the new LayerSnapshot of the layer, or the current one if the content did not change:
+        then nothing is published, so the clients see neither a new ETag nor a delta
+        '''
+        with self.__lock:
+            current = self.__snapshots.get(name)
+            if current is not None and current.get_data() == data:
+                return current
+            version = self.__versions.get(name, 0) + 1
+            self.__versions[name] = version
+            self.__sequence += 1
+            snapshot = LayerSnapshot(name, version, data)
+            self.__snapshots[name] = snapshot
+            if features is None:
+                # without a delta the clients behind this point have to resync
+                self.__deltas.clear()
+            else:
+                delta = '{"seq": ' + str(self.__sequence) + ', "layer": "' + name + '", "op": "' + \
+                        ('replace' if replace else 'add') + '", "features": [' + ', '.join(features) + ']}'
+                self.__deltas.append((self.__sequence, delta))
+        return snapshot
+
+    def get(self, name):
+        '''
+        @return: the latest LayerSnapshot of the layer, None if it was never published
+        '''
+        return self.__snapshots.get(name)
+
+    def get_sequence(self):
+        return self.__sequence
+
+    def get_deltas_since(self, sequence: int):
+        '''
+        @return: list of (sequence, JSON delta) published after the given sequence,
+        None if some of them are not available anymore and the client must resync
+        '''
+        with self.__lock:
+            if sequence == self.__sequence:
+                return []
+            if sequence > self.__sequence or not self.__deltas or self.__deltas[0][0] > sequence + 1:
+                return None
+            return [(delta_sequence, delta) for delta_sequence, delta in self.__deltas if delta_sequence > sequence]
+
+    def get_resync(self):
+        '''
+        @return: sequence and JSON message with the whole content of every layer
+        '''
+        with self.__lock:
+            sequence = self.__sequence
+            layers = [(name, snapshot.get_data()) for name, snapshot in self.__snapshots.items()]
+        message = '{"seq": ' + str(sequence) + ', "op": "resync", "layers": {' + \
+                  ', '.join('"' + name + '": ' + data.decode('utf-8') for name, data in layers) + '}}'
+        return sequence, message
+
+
+snapshots = LayerSnapshots()
+__publish_listeners = []
+
+
+def add_publish_listener(listener):
+    '''
+    @param listener: callable(name, features, replace) called after every publication,
+    e.g. to forward the layers to the web server when the pipeline runs in another process
+    '''
+    __publish_listeners.append(listener)
+
+
+def remove_publish_listener(listener):
+    __publish_listeners.remove(listener)
+
+
+def publish_layer(name, data: bytes, features=None, replace=True):
+    previous = snapshots.get(name)
+    snapshot = snapshots.publish(name, data, features, replace)
+    if snapshot is previous:
+        return snapshot
+    for listener in __publish_listeners:
+        listener(name, features, replace)
+    return snapshot
+
+
+def get_layer_snapshot(name):
+    return snapshots.get(name)
+
+
+def publish_layer_files(directory, names=LAYERS):
+    '''
+    publishes the layers already on disk, used at start up
+    before the pipeline writes them again
+    '''
+    for name in names:
+        path = os.path.join(directory, name + '.geojson')
+        if snapshots.get(name) is None and os.path.isfile(path):
+            with open(path, 'rb') as f:
+                publish_layer(name, f.read())
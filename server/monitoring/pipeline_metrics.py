@@ -0,0 +1,314 @@
+import threading
+from bisect import bisect_left
+from datetime import datetime
+
+# seconds, for the classifier batches and the layers creation
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# seconds, for the delay between the post of a tweet and its publication on the map
+DELAY_BUCKETS = (0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+# tweets in a classifier batch
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+
+def format_labels(label_names, label_values):
+    if not label_names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in zip(label_names, label_values)) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """
+    Base class of the metrics: a name, a help text and optional label names.
+    Values are stored per tuple of label values and are only
+    formatted when the metrics are scraped.
+    """
+    type_name = 'untyped'
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    def samples(self):
+        '''
+        @return: list of (name suffix, label names, label values, value)
+        '''
+        return []
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.type_name)]
+        for suffix, label_names, label_values, value in self.samples():
+            lines.append('{}{}{} {}'.format(self.name, suffix, format_labels(label_names, label_values),
+                                            format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def __init__(self, name, documentation, label_names=()):
+        super().__init__(name, documentation, label_names)
+        self.__values = {} if label_names else {(): 0}
+
+    def inc(self, amount=1, label_values=()):
+        with self._lock:
+            self.__values[label_values] = self.__values.get(label_values, 0) + amount
+
+    def get(self, label_values=()):
+        return self.__values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            return [('', self.label_names, label_values, value) for label_values, value in self.__values.items()]
+
+
+class Gauge(Metric):
+    """
+    Gauge set by the pipeline or, if a function is given, read only when scraped
+    (e.g. the size of a queue), so it costs nothing while nobody looks at it.
+    """
+    type_name = 'gauge'
+
+    def __init__(self, name, documentation, function=None):
+        super().__init__(name, documentation)
+        self.__value = 0
+        self.__function = function
+
+    def set(self, value):
+        self.__value = value
+
+    def set_function(self, function):
+        self.__function = function
+
+    def get(self):
+        if self.__function is not None:
+            return self.__function()
+        return self.__value
+
+    def samples(self):
+        return [('', (), (), self.get())]
+
+
+class Histogram(Metric):
+    """
+    Fixed buckets histogram: an observation is a binary search and an increment.
+    Cumulative counts are computed only when scraped.
+    """
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS, label_names=()):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+        # label values -> [counts per bucket (last one is +Inf), sum]
+        self.__values = {}
+        if not label_names:
+            self.__values[()] = [[0] * (len(self.buckets) + 1), 0.0]
+
+    def observe(self, value, label_values=()):
+        position = bisect_left(self.buckets, value)
+        with self._lock:
+            counts_and_sum = self.__values.get(label_values)
+            if counts_and_sum is None:
+                counts_and_sum = [[0] * (len(self.buckets) + 1), 0.0]
+                self.__values[label_values] = counts_and_sum
+            counts_and_sum[0][position] += 1
+            counts_and_sum[1] += value
+
+    def get_count(self, label_values=()):
+        counts_and_sum = self.__values.get(label_values)
+        return sum(counts_and_sum[0]) if counts_and_sum else 0
+
+    def get_sum(self, label_values=()):
+        counts_and_sum = self.__values.get(label_values)
+        return counts_and_sum[1] if counts_and_sum else 0.0
+
+    def samples(self):
+        samples = []
+        bucket_label_names = self.label_names + ('le',)
+        with self._lock:
+            values = [(label_values, list(counts), total) for label_values, (counts, total) in self.__values.items()]
+        for label_values, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append(('_bucket', bucket_label_names, label_values + (format_value(bound),), cumulative))
+            samples.append(('_sum', self.label_names, label_values, total))
+            samples.append(('_count', self.label_names, label_values, cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    Named metrics of the process, rendered in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.__metrics = {}
+        self.__lock = threading.Lock()
+
+    def __register(self, metric):
+        with self.__lock:
+            existing = self.__metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self.__metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, label_names=()):
+        return self.__register(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, function=None):
+        gauge = self.__register(Gauge(name, documentation, function))
+        if function is not None:
+            gauge.set_function(function)
+        return gauge
+
+    def histogram(self, name, documentation, buckets=LATENCY_BUCKETS, label_names=()):
+        return self.__register(Histogram(name, documentation, buckets, label_names))
+
+    def get(self, name):
+        return self.__metrics.get(name)
+
+    def render(self):
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+registry = MetricsRegistry()
+
+tweets_received = registry.counter('tweetquake_tweets_received_total', 'Tweets put in the tweets queue')
+stream_reconnections = registry.counter('tweetquake_stream_reconnections_total',
+                                       'Connections to the tweet stream opened again after being lost')
+stream_records_dropped = registry.counter('tweetquake_stream_records_dropped_total',
+                                         'Records of the tweet stream that are not tweets (delete, limit, '
+                                         'disconnect... notices) or could not be parsed', ('reason',))
+ingestion_blocked_seconds = registry.counter('tweetquake_ingestion_blocked_seconds_total',
+                                             'Time the ingestion waited for room in the full tweets queue')
+tweets_classified = registry.counter('tweetquake_tweets_classified_total', 'Tweets labelled by the filter')
+tweets_positive = registry.counter('tweetquake_tweets_positive_total',
+                                   'Tweets labelled as earthquake reports and put in the filtered queue')
+classifier_batch_seconds = registry.histogram('tweetquake_classifier_batch_seconds',
+                                              'Time to label a batch of tweets')
+classifier_batch_size = registry.histogram('tweetquake_classifier_batch_size', 'Tweets in a classifier batch',
+                                           BATCH_SIZE_BUCKETS)
+tweets_geoparsed = registry.counter('tweetquake_tweets_geoparsed_total',
+                                    'Positive tweets without a place located from the names in their text')
+tweets_in_time_window = registry.gauge('tweetquake_tweets_in_time_window',
+                                       'Filtered tweets in the detection time window')
+detections = registry.counter('tweetquake_detections_total', 'Earthquakes detected')
+create_geojsons_seconds = registry.histogram('tweetquake_create_geojsons_seconds',
+                                             'Time to find the faults and the area at risk and write their layers',
+                                             LATENCY_BUCKETS)
+faults_updates_skipped = registry.counter('tweetquake_faults_updates_skipped_total',
+                                          'Analyses where the ranking of the faults did not change enough '
+                                          'to compute the area at risk again')
+tweets_retained = registry.gauge('tweetquake_tweets_retained', 'Tweets kept by the analyzer')
+tweets_expired = registry.counter('tweetquake_tweets_expired_total',
+                                  'Tweets dropped by the analyzer because too old or over its size cap')
+layer_writes = registry.counter('tweetquake_layer_writes_total', 'Writes of the GeoJSON layers', ('layer',))
+publish_delay_seconds = registry.histogram('tweetquake_publish_delay_seconds',
+                                           'Delay between the post of a tweet and its publication on the map',
+                                           DELAY_BUCKETS)
+newest_tweet_age_seconds = registry.gauge('tweetquake_newest_tweet_age_seconds',
+                                          'Age of the newest tweet when the tweets layer was last published')
+
+
+def register_queue_depth(name, queue):
+    '''
+    adds a gauge with the size of the queue, read only when the metrics are scraped
+    '''
+    return registry.gauge('tweetquake_{}_queue_depth'.format(name), 'Items waiting in the {} queue'.format(name),
+                          queue.qsize)
+
+
+def render_metrics():
+    return registry.render()
+
+
+def add_label(sample, label_name, label_value):
+    '''
+    @param sample: sample line of the text format, e.g. 'name{le="0.5"} 3'
+    @return: the line with the label added before the others
+    '''
+    label = format_labels((label_name,), (label_value,))
+    # the value is the last field, label values can have spaces
+    name, _, rest = sample.rpartition(' ')
+    if name.endswith('}'):
+        return '{}{},{} {}'.format(name[:name.index('{')], label[:-1], name[name.index('{') + 1:], rest)
+    return '{}{} {}'.format(name, label, rest)
+
+
+def merge_rendered_metrics(rendered, label_name='stage'):
+    '''
+    merges the metrics rendered by different processes in a single text, the samples of
+    every process are told apart by a label, e.g. stage="filter-0"
+    @param rendered: list of (label value, text rendered by render_metrics)
+    '''
+    # metric name -> its HELP and TYPE lines and the samples of all the processes
+    families = {}
+    for label_value, text in rendered:
+        family = None
+        for line in text.splitlines():
+            if line.startswith('# HELP '):
+                family = families.setdefault(line.split(' ', 3)[2], [line, None, []])
+            elif line.startswith('# TYPE '):
+                family[1] = line
+            elif line and family is not None:
+                family[2].append(add_label(line, label_name, label_value))
+    lines = []
+    for help_line, type_line, samples in families.values():
+        lines.append(help_line)
+        lines.append(type_line)
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+
+# ids of the tweets in the tweets layer: a rewrite (e.g. after the expired tweets are dropped)
+# observes the publish delay only of the tweets that were not in the layer yet
+__published_tweets = set()
+
+
+def __tweet_key(tweet):
+    tweet_id = tweet.get_tweet_id()
+    return tweet_id if tweet_id is not None else id(tweet)
+
+
+def record_layer_write(filename, object_list, replace):
+    '''
+    GeoJSON write listener (see geojson_creation.add_write_listener): counts the writes
+    of every layer and, for the tweets layer, the delay from their post to their first publication.
+    Tweets times are the naive UTC datetimes of tweepy
+    '''
+    global __published_tweets
+    layer_writes.inc(1, (filename,))
+    if filename != 'tweets':
+        return
+    keys = [__tweet_key(tweet) for tweet in object_list]
+    if replace:
+        new_tweets = [tweet for tweet, key in zip(object_list, keys) if key not in __published_tweets]
+        __published_tweets = set(keys)
+    else:
+        new_tweets = object_list
+        __published_tweets.update(keys)
+    if not object_list:
+        return
+    now = datetime.utcnow()
+    for tweet in new_tweets:
+        time_posted = tweet.get_time_posted()
+        if time_posted is not None:
+            publish_delay_seconds.observe(max(0.0, (now - time_posted).total_seconds()))
+    times_posted = [tweet.get_time_posted() for tweet in object_list if tweet.get_time_posted() is not None]
+    if times_posted:
+        newest_tweet_age_seconds.set(max(0.0, (now - max(times_posted)).total_seconds()))
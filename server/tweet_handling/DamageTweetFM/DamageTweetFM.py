@@ -6,6 +6,7 @@ from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics import classification_report
 from sklearn.model_selection import train_test_split
 
+from server.tweet_handling.model_artifacts import load_model_artifact, model_artifact_exists, write_model_artifact
 from server.tweet_handling.tweet_filtering import FilteringMethod
 from _pickle import load, dump
 
@@ -16,17 +17,25 @@ class DamageTweetFM(FilteringMethod):
     using sentiment analysis
     """
 
-    def __init__(self, get_existing=True):
+    def __init__(self, get_existing=True, use_artifact=True):
         """
         checks if a SVM and a corresponding vectorizer exists.
         if so it loads their states
         otherwise it initializes two new one
+        @param use_artifact: if the memory mapped model artifact exists it is used
+        instead of unpickling the vectorizer and the classifier
         """
         self.classifier_path = 'server/tweet_handling/DamageTweetFM' \
                                '/DamageTweetFM_state/classifier.pkl '
         self.vectorizer_path = 'server/tweet_handling/DamageTweetFM' \
                                '/DamageTweetFM_state/vectorizer.pkl '
-        if get_existing and \
+        self.artifact_path = 'server/tweet_handling/DamageTweetFM/DamageTweetFM_state/artifact'
+        self.model = None
+        if get_existing and use_artifact and model_artifact_exists(self.artifact_path):
+            self.model = load_model_artifact(self.artifact_path)
+            self.classifier = None
+            self.vectorizer = None
+        elif get_existing and \
                 os.path.isfile(self.classifier_path) and \
                 os.path.isfile(self.vectorizer_path):
 
@@ -53,11 +62,14 @@ class DamageTweetFM(FilteringMethod):
         '''
         train_vectors = self.vectorizer.fit_transform(train_data['Content'])
         self.classifier.fit(train_vectors, train_data['Label'])
+        self.model = None
         if save_to_file:
+            os.makedirs(os.path.dirname(self.classifier_path), exist_ok=True)
             with open(self.classifier_path, 'wb') as fid:
                 dump(self.classifier, fid)
             with open(self.vectorizer_path, 'wb') as fid:
                 dump(self.vectorizer, fid)
+            write_model_artifact(self.vectorizer, self.classifier, self.artifact_path)
 
     def predict(self, data: pd.DataFrame):
         '''
@@ -65,10 +77,24 @@ class DamageTweetFM(FilteringMethod):
         @param data: pandas csv with labels 'Content' (tweet text), 'Label'
         @return: array of labels
         '''
-        test_vectors = self.vectorizer.transform(data['Content'])
+        return self.predict_texts(data['Content'])
+
+    def predict_texts(self, texts):
+        '''
+
+        @param texts: list (or any iterable) of tweet texts
+        @return: array of labels
+        '''
+        if self.model is not None:
+            return self.model.predict_texts(texts)
+        test_vectors = self.vectorizer.transform(texts)
         labels = self.classifier.predict(test_vectors)
         return labels
 
+    def warm_up(self):
+        if self.model is not None:
+            self.model.warm_up()
+
 
 if __name__ == "__main__":
     '''
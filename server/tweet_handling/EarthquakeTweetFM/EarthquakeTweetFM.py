@@ -1,14 +1,23 @@
+import argparse
 import os
+import time
+
 import advertools as adv
+import numpy as np
 import pandas as pd
 from sklearn import svm
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics import classification_report
+from sklearn.metrics import accuracy_score, classification_report
 from sklearn.model_selection import train_test_split
 
+from server.tweet_handling.model_artifacts import load_model_artifact, model_artifact_exists, write_model_artifact
 from server.tweet_handling.tweet_filtering import FilteringMethod
 from _pickle import load, dump
 
+STATE_DIRECTORY = 'server/tweet_handling/EarthquakeTweetFM/EarthquakeTweetFM_state/'
+# 'svc' is the RBF kernel SVM, 'linear' a linear SVM whose prediction is a single sparse dot product
+CLASSIFIER_TYPES = ['svc', 'linear']
+
 
 class EarthquakeTweetFM(FilteringMethod):
     """
@@ -16,17 +25,28 @@ class EarthquakeTweetFM(FilteringMethod):
     using sentiment analysis
     """
 
-    def __init__(self, get_existing=True):
+    def __init__(self, get_existing=True, classifier_type='svc', use_artifact=True):
         """
         checks if a SVM and a corresponding vectorizer exists.
         if so it loads their states
         otherwise it initializes two new one
+        @param classifier_type: one of CLASSIFIER_TYPES, every type has its own saved state
+        @param use_artifact: if the memory mapped model artifact exists it is used
+        instead of unpickling the vectorizer and the classifier
         """
-        self.classifier_path = 'server/tweet_handling/EarthquakeTweetFM' \
-                               '/EarthquakeTweetFM_state/classifier.pkl '
-        self.vectorizer_path = 'server/tweet_handling/EarthquakeTweetFM' \
-                               '/EarthquakeTweetFM_state/vectorizer.pkl '
-        if get_existing and \
+        if classifier_type not in CLASSIFIER_TYPES:
+            raise ValueError('classifier_type must be one of {}'.format(CLASSIFIER_TYPES))
+        self.classifier_type = classifier_type
+        prefix = '' if classifier_type == 'svc' else classifier_type + '_'
+        self.classifier_path = STATE_DIRECTORY + prefix + 'classifier.pkl '
+        self.vectorizer_path = STATE_DIRECTORY + prefix + 'vectorizer.pkl '
+        self.artifact_path = STATE_DIRECTORY + prefix + 'artifact'
+        self.model = None
+        if get_existing and use_artifact and model_artifact_exists(self.artifact_path):
+            self.model = load_model_artifact(self.artifact_path)
+            self.classifier = None
+            self.vectorizer = None
+        elif get_existing and \
                 os.path.isfile(self.classifier_path) and \
                 os.path.isfile(self.vectorizer_path):
 
@@ -38,7 +58,10 @@ class EarthquakeTweetFM(FilteringMethod):
         else:
             stop_words = sorted(adv.stopwords['italian'])
             stop_words.append('terremoto')
-            self.classifier = svm.SVC(kernel='rbf', C=5.0, gamma='scale')
+            if classifier_type == 'linear':
+                self.classifier = svm.LinearSVC(C=1.0)
+            else:
+                self.classifier = svm.SVC(kernel='rbf', C=5.0, gamma='scale')
             self.vectorizer = TfidfVectorizer(min_df=0.00001,
                                               max_df=0.9,
                                               stop_words=stop_words,
@@ -53,11 +76,14 @@ class EarthquakeTweetFM(FilteringMethod):
         '''
         train_vectors = self.vectorizer.fit_transform(train_data['Content'])
         self.classifier.fit(train_vectors, train_data['Label'])
+        self.model = None
         if save_to_file:
+            os.makedirs(STATE_DIRECTORY, exist_ok=True)
             with open(self.classifier_path, 'wb') as fid:
                 dump(self.classifier, fid)
             with open(self.vectorizer_path, 'wb') as fid:
                 dump(self.vectorizer, fid)
+            write_model_artifact(self.vectorizer, self.classifier, self.artifact_path)
 
     def predict(self, data: pd.DataFrame):
         '''
@@ -65,30 +91,84 @@ class EarthquakeTweetFM(FilteringMethod):
         @param data: pandas csv with labels 'Content' (tweet text), 'Label'
         @return: array of labels
         '''
-        test_vectors = self.vectorizer.transform(data['Content'])
+        return self.predict_texts(data['Content'])
+
+    def predict_texts(self, texts):
+        '''
+
+        @param texts: list (or any iterable) of tweet texts
+        @return: array of labels
+        '''
+        if self.model is not None:
+            return self.model.predict_texts(texts)
+        test_vectors = self.vectorizer.transform(texts)
         labels = self.classifier.predict(test_vectors)
         return labels
 
+    def warm_up(self):
+        if self.model is not None:
+            self.model.warm_up()
+
+
+def measure_latency(filtering_method: FilteringMethod, texts, repetitions=200):
+    '''
+    @return: median seconds needed to classify a single tweet
+    and mean seconds per tweet when all the texts are classified in one batch
+    '''
+    single = []
+    for i in range(repetitions):
+        df = pd.DataFrame([texts[i % len(texts)]], columns=['Content'])
+        start = time.perf_counter()
+        filtering_method.predict(df)
+        single.append(time.perf_counter() - start)
+    df = pd.DataFrame(texts, columns=['Content'])
+    start = time.perf_counter()
+    filtering_method.predict(df)
+    batch = (time.perf_counter() - start) / len(texts)
+    return float(np.median(single)), batch
+
+
+def print_comparison(detectors, test_data: pd.DataFrame):
+    '''
+    prints accuracy and per tweet latency of the given detectors on the same test data
+    '''
+    print('{:<8} {:>9} {:>10} {:>10} {:>16} {:>16}'.format('model', 'accuracy', 'pos f1', 'neg f1',
+                                                          'single (ms)', 'batched (ms)'))
+    for detector in detectors:
+        predictions = detector.predict(test_data)
+        report = classification_report(test_data['Label'], predictions, output_dict=True)
+        single, batch = measure_latency(detector, list(test_data['Content']))
+        print('{:<8} {:>9.4f} {:>10.4f} {:>10.4f} {:>16.4f} {:>16.4f}'.format(
+            detector.classifier_type, accuracy_score(test_data['Label'], predictions),
+            report['pos']['f1-score'], report['neg']['f1-score'], single * 1000, batch * 1000))
+
 
 if __name__ == "__main__":
     '''
-    execute this to train a new classifier
+    execute this to train a new classifier,
+    with --classifier both the SVC and the linear model are trained on the same split and compared
     '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--classifier', choices=CLASSIFIER_TYPES + ['both'], default='svc')
+    args = parser.parse_args()
     data = pd.read_csv("server/tweet_handling/EarthquakeTweetFM/EarthquakeTweetFM_dataset.csv")
 
     train_data, test_data = train_test_split(data, test_size=0.1)
 
-    detector = EarthquakeTweetFM(get_existing=False)
-    detector.train(train_data=train_data, save_to_file=True)
-    predictions = detector.predict(test_data)
-    report = classification_report(test_data['Label'], predictions, output_dict=True)
-    print('positive: ', report['pos'])
-    print('negative: ', report['neg'])
+    classifier_types = CLASSIFIER_TYPES if args.classifier == 'both' else [args.classifier]
+    detectors = []
+    for classifier_type in classifier_types:
+        detector = EarthquakeTweetFM(get_existing=False, classifier_type=classifier_type)
+        detector.train(train_data=train_data, save_to_file=True)
+        detectors.append(detector)
+    print_comparison(detectors, test_data)
+
     texts = ['ha fatto il terremoto', 'terremoto in politica',
              'Scossa: è crollato un ponte davanti ai miei occhi #terremoto']
     df = pd.DataFrame(texts, columns=['Content'])
-    prediction = detector.predict(df)
-    print()
-    print(prediction)
+    for detector in detectors:
+        prediction = detector.predict(df)
+        print()
+        print(detector.classifier_type, prediction)
 
     # print(detector.vectorizer.get_feature_names())
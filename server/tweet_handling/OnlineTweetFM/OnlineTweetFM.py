@@ -0,0 +1,189 @@
+import os
+import tempfile
+import threading
+import time
+
+import advertools as adv
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.linear_model import SGDClassifier
+from sklearn.metrics import classification_report
+from sklearn.model_selection import train_test_split
+
+from server.tweet_handling.tweet_filtering import FilteringMethod
+from _pickle import load, dump
+
+STATE_DIRECTORY = 'server/tweet_handling/OnlineTweetFM/OnlineTweetFM_state/'
+CHECKPOINT_PATH = STATE_DIRECTORY + 'checkpoint.pkl'
+# labelled tweets the classifier is trained on when there is no checkpoint
+DATASET_PATH = 'server/tweet_handling/EarthquakeTweetFM/EarthquakeTweetFM_dataset.csv'
+CLASSES = np.array(['neg', 'pos'])
+# 2^20 weights: 8 MB of float64, whatever the number of words seen
+N_FEATURES = 1 << 20
+
+
+class OnlineTweetFM(FilteringMethod):
+    """
+    used to check if a tweet talks about an earthquake happening now or not.
+    Words are hashed into a fixed number of features, so there is no vocabulary
+    to fit and memory does not grow with new words or hashtags;
+    the linear classifier is trained with SGD and can be updated with partial_fit
+    while the pipeline runs, e.g. with the labels corrected by a person.
+    Its state can be checkpointed to disk.
+    """
+
+    def __init__(self, get_existing=True, classifier_type='online', checkpoint_path=CHECKPOINT_PATH,
+                 n_features=N_FEATURES, checkpoint_every=100):
+        """
+        loads the checkpoint if it exists. Otherwise, with get_existing, a classifier is trained on the labelled
+        dataset and checkpointed (e.g. on a fresh deploy), so the pipeline never predicts with an unfitted one;
+        without get_existing a new classifier is initialized, to be trained with train
+        @param classifier_type: accepted to be created like EarthquakeTweetFM, it is always 'online'
+        @param checkpoint_every: the state is saved every time this number of corrections is learned,
+        0 to save it only with save_checkpoint
+        """
+        self.classifier_type = 'online'
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.__lock = threading.Lock()
+        self.__corrections = 0
+        self.__corrections_since_checkpoint = 0
+        stop_words = sorted(adv.stopwords['italian'])
+        stop_words.append('terremoto')
+        if get_existing and os.path.isfile(checkpoint_path):
+            with open(checkpoint_path, 'rb') as fid:
+                state = load(fid)
+            n_features = state['n_features']
+            self.classifier = state['classifier']
+            self.__corrections = state['corrections']
+        else:
+            self.classifier = SGDClassifier(loss='hinge', alpha=0.00001, average=True)
+        self.vectorizer = HashingVectorizer(n_features=n_features,
+                                            stop_words=stop_words,
+                                            ngram_range=(1, 2),
+                                            alternate_sign=False,
+                                            norm='l2')
+        if get_existing and not self.is_fitted():
+            print('no checkpoint in {}, training on {}'.format(checkpoint_path, DATASET_PATH))
+            self.train(pd.read_csv(DATASET_PATH), save_to_file=True)
+
+    def get_corrections(self):
+        '''
+        @return: number of labelled tweets learned with partial_fit
+        '''
+        return self.__corrections
+
+    def is_fitted(self):
+        return hasattr(self.classifier, 'coef_')
+
+    def train(self, train_data: pd.DataFrame, save_to_file=False, epochs=5, batch_size=256):
+        '''
+        trains a new classifier, with some passes of partial_fit over the shuffled data
+        @param train_data: pandas csv with labels 'Content' (tweet), 'Label'
+        @param save_to_file: bool
+        '''
+        vectors = self.vectorizer.transform(train_data['Content'])
+        labels = np.asarray(train_data['Label'])
+        random_state = np.random.RandomState(0)
+        classifier = SGDClassifier(loss='hinge', alpha=0.00001, average=True)
+        for epoch in range(epochs):
+            order = random_state.permutation(len(labels))
+            for first in range(0, len(order), batch_size):
+                batch = order[first:first + batch_size]
+                classifier.partial_fit(vectors[batch], labels[batch], classes=CLASSES)
+        with self.__lock:
+            self.classifier = classifier
+            self.__corrections = 0
+        if save_to_file:
+            self.save_checkpoint()
+
+    def partial_fit(self, texts, labels):
+        '''
+        updates the classifier with labelled tweets, it can be called while other threads predict
+        @param texts: list of tweet texts
+        @param labels: list of 'pos' / 'neg' labels
+        @return: True
+        '''
+        texts = list(texts)
+        if not texts:
+            return True
+        vectors = self.vectorizer.transform(texts)
+        with self.__lock:
+            self.classifier.partial_fit(vectors, np.asarray(labels), classes=CLASSES)
+            self.__corrections += len(texts)
+            self.__corrections_since_checkpoint += len(texts)
+            checkpoint = self.checkpoint_every and self.__corrections_since_checkpoint >= self.checkpoint_every
+        if checkpoint:
+            self.save_checkpoint()
+        return True
+
+    def save_checkpoint(self, path=None):
+        '''
+        saves the classifier; the file is replaced atomically, so a crash never leaves half a checkpoint
+        '''
+        path = path or self.checkpoint_path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self.__lock:
+            state = {'classifier': self.classifier, 'corrections': self.__corrections,
+                     'n_features': self.vectorizer.n_features}
+            # unique temporary file, processes saving at the same time do not write in the same one
+            descriptor, temporary_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                                          dir=directory or '.')
+            with os.fdopen(descriptor, 'wb') as fid:
+                dump(state, fid)
+            os.replace(temporary_path, path)
+            self.__corrections_since_checkpoint = 0
+
+    def predict(self, data: pd.DataFrame):
+        '''
+
+        @param data: pandas csv with labels 'Content' (tweet text), 'Label'
+        @return: array of labels
+        '''
+        return self.predict_texts(data['Content'])
+
+    def predict_texts(self, texts):
+        '''
+
+        @param texts: list (or any iterable) of tweet texts
+        @return: array of labels
+        '''
+        test_vectors = self.vectorizer.transform(texts)
+        with self.__lock:
+            labels = self.classifier.predict(test_vectors)
+        return labels
+
+    def warm_up(self):
+        if self.is_fitted():
+            self.predict_texts(['terremoto'])
+
+
+if __name__ == "__main__":
+    '''
+    execute this to train a new classifier and save its checkpoint,
+    then the test tweets are learned one by one as corrections to measure the update speed
+    '''
+    data = pd.read_csv("server/tweet_handling/EarthquakeTweetFM/EarthquakeTweetFM_dataset.csv")
+
+    train_data, test_data = train_test_split(data, test_size=0.1)
+
+    detector = OnlineTweetFM(get_existing=False)
+    detector.train(train_data=train_data, save_to_file=True)
+    predictions = detector.predict(test_data)
+    report = classification_report(test_data['Label'], predictions, output_dict=True)
+    print('positive: ', report['pos'])
+    print('negative: ', report['neg'])
+
+    texts = list(test_data['Content'])
+    # the measure of the corrections must not overwrite the checkpoint
+    detector.checkpoint_every = 0
+    start = time.perf_counter()
+    detector.predict_texts(texts)
+    print('batched prediction: {:.4f} ms per tweet'.format((time.perf_counter() - start) * 1000 / len(texts)))
+    start = time.perf_counter()
+    for text, label in zip(texts, test_data['Label']):
+        detector.partial_fit([text], [label])
+    print('single correction: {:.4f} ms'.format((time.perf_counter() - start) * 1000 / len(texts)))
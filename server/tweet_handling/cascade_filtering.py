@@ -0,0 +1,136 @@
+import re
+from typing import List
+
+import pandas as pd
+
+from server.tweet_handling.EarthquakeTweetFM.EarthquakeTweetFM import EarthquakeTweetFM
+from server.tweet_handling.OnlineTweetFM.OnlineTweetFM import OnlineTweetFM
+from server.tweet_handling.tweet_filtering import FilteringMethod
+
+# patterns of tweets that surely do not report an earthquake felt in Italy:
+# news about earthquakes abroad written in Spanish and metaphorical uses of 'terremoto'.
+# Words used by Italian reports too ('sismo', 'registra', 'terremoto politico') are not here:
+# check_negative_patterns must find no positive tweet matching a pattern
+NEGATIVE_PATTERNS = [
+    r'\bterremoto\s+(de|en)\b',
+    r'\bmagnitud\b',
+    r'\bsacude\b',
+    r'\btemblor\b',
+    r'\bterremoto\s+(in\s+politica|nel\s+(governo|pd|m5s|partito|parlamento)|giudiziario|finanziario|'
+    r'mediatico|elettorale|emotivo|sentimentale)\b',
+]
+# labelled datasets of tweets reporting earthquakes: the positives of the first, all the tweets of the second
+EARTHQUAKE_DATASET = 'server/tweet_handling/EarthquakeTweetFM/EarthquakeTweetFM_dataset.csv'
+DAMAGE_DATASET = 'server/tweet_handling/DamageTweetFM/DamageTweetFM_dataset.csv'
+
+
+class KeywordFM(FilteringMethod):
+    """
+    cheap filtering method: a tweet is negative if it matches one of the
+    negative patterns, positive otherwise.
+    All the patterns are compiled in a single regular expression.
+    """
+
+    def __init__(self, negative_patterns: List[str] = None):
+        super().__init__()
+        if negative_patterns is None:
+            negative_patterns = NEGATIVE_PATTERNS
+        self.negative_patterns = negative_patterns
+        self.__regex = re.compile('|'.join('(?:{})'.format(pattern) for pattern in negative_patterns),
+                                  re.IGNORECASE)
+
+    def predict(self, data: pd.DataFrame):
+        return self.predict_texts(data['Content'])
+
+    def predict_texts(self, texts):
+        search = self.__regex.search
+        return ['neg' if search(text) else 'pos' for text in texts]
+
+
+class CascadeFM(FilteringMethod):
+    """
+    chains filtering methods, from the cheapest to the most expensive:
+    every method classifies only the tweets that all the previous ones
+    labelled as positive, a tweet is positive only if every method says so.
+    It counts how many tweets reached each method.
+    """
+
+    def __init__(self, filtering_methods: List[FilteringMethod]):
+        super().__init__()
+        self.filtering_methods = filtering_methods
+        self.__tweets_per_method = [0] * len(filtering_methods)
+
+    def get_tweets_per_method(self):
+        '''
+        @return: list with the number of tweets classified by each method
+        '''
+        return self.__tweets_per_method
+
+    def predict(self, data: pd.DataFrame):
+        return self.predict_texts(data['Content'])
+
+    def predict_texts(self, texts):
+        texts = list(texts)
+        labels = ['neg'] * len(texts)
+        survivors = list(range(len(texts)))
+        for i, filtering_method in enumerate(self.filtering_methods):
+            if not survivors:
+                break
+            self.__tweets_per_method[i] += len(survivors)
+            method_labels = filtering_method.predict_texts([texts[j] for j in survivors])
+            survivors = [j for j, label in zip(survivors, method_labels) if label == 'pos']
+        for j in survivors:
+            labels[j] = 'pos'
+        return labels
+
+    def partial_fit(self, texts, labels):
+        # every method that can learn online gets the corrections
+        learned = [filtering_method.partial_fit(texts, labels) for filtering_method in self.filtering_methods]
+        return any(learned)
+
+    def warm_up(self):
+        for filtering_method in self.filtering_methods:
+            filtering_method.warm_up()
+
+    def __str__(self):
+        return 'cascade: ' + ', '.join('{} -> {}'.format(type(method).__name__, tweets)
+                                       for method, tweets in zip(self.filtering_methods, self.__tweets_per_method))
+
+
+def create_cascade_fm(classifier_type='svc'):
+    '''
+    @return: the keyword prefilter followed by EarthquakeTweetFM, or OnlineTweetFM if classifier_type is 'online'
+    '''
+    if classifier_type == 'online':
+        return CascadeFM([KeywordFM(), OnlineTweetFM()])
+    return CascadeFM([KeywordFM(), EarthquakeTweetFM(classifier_type=classifier_type)])
+
+
+def check_negative_patterns(negative_patterns: List[str] = None):
+    '''
+    counts the tweets of the labelled datasets matched by every negative pattern
+    @return: dictionary pattern -> (earthquake reports matched, negative tweets matched),
+    a pattern that matches earthquake reports drops true positives before the classifier sees them
+    '''
+    if negative_patterns is None:
+        negative_patterns = NEGATIVE_PATTERNS
+    earthquake_data = pd.read_csv(EARTHQUAKE_DATASET)
+    reports = pd.concat([earthquake_data[earthquake_data['Label'] == 'pos']['Content'],
+                         pd.read_csv(DAMAGE_DATASET)['Content']])
+    negatives = earthquake_data[earthquake_data['Label'] == 'neg']['Content']
+    counts = {}
+    for pattern in negative_patterns:
+        regex = re.compile(pattern, re.IGNORECASE)
+        counts[pattern] = (int(sum(1 for text in reports if regex.search(text))),
+                           int(sum(1 for text in negatives if regex.search(text))))
+    return counts
+
+
+if __name__ == '__main__':
+    '''
+        checks that the negative patterns match no earthquake report of the labelled datasets
+    '''
+    patterns_counts = check_negative_patterns()
+    for negative_pattern, (reports_matched, negatives_matched) in patterns_counts.items():
+        print('{} reports, {} negatives: {}'.format(reports_matched, negatives_matched, negative_pattern))
+    assert all(reports_matched == 0 for reports_matched, _ in patterns_counts.values())
@@ -0,0 +1,314 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+MODEL_ARTIFACT_FORMAT_VERSION = 1
+# parameters of the vectorizer needed to tokenize the texts as it did
+ANALYZER_PARAMETERS = ['lowercase', 'strip_accents', 'stop_words', 'token_pattern', 'ngram_range', 'analyzer']
+TRANSFORM_PARAMETERS = ['binary', 'norm', 'use_idf', 'sublinear_tf']
+
+
+def term_hash(term: str):
+    return int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def __vectorizer_metadata(vectorizer: TfidfVectorizer):
+    parameters = vectorizer.get_params()
+    for callable_parameter in ['preprocessor', 'tokenizer']:
+        if parameters.get(callable_parameter) is not None:
+            raise ValueError('vectorizers with a custom {} cannot be exported'.format(callable_parameter))
+    if not isinstance(parameters['analyzer'], str):
+        raise ValueError('vectorizers with a custom analyzer cannot be exported')
+    metadata = {name: parameters[name] for name in ANALYZER_PARAMETERS + TRANSFORM_PARAMETERS}
+    if metadata['stop_words'] is not None and not isinstance(metadata['stop_words'], str):
+        metadata['stop_words'] = sorted(metadata['stop_words'])
+    metadata['ngram_range'] = list(metadata['ngram_range'])
+    metadata['features'] = len(vectorizer.vocabulary_)
+    return metadata
+
+
+def __classifier_arrays(classifier):
+    '''
+    @return: (metadata, arrays) of a binary linear classifier (coef_) or RBF SVC
+    '''
+    if len(classifier.classes_) != 2:
+        raise ValueError('only binary classifiers can be exported')
+    metadata = {'classes': [str(label) for label in classifier.classes_],
+                'intercept': float(np.ravel(classifier.intercept_)[0])}
+    kernel = getattr(classifier, 'kernel', 'linear')
+    if kernel == 'linear':
+        coef = classifier.coef_
+        coef = coef.toarray() if sparse.issparse(coef) else np.asarray(coef)
+        metadata['kind'] = 'linear'
+        return metadata, {'coef': coef.ravel().astype(np.float64)}
+    if kernel != 'rbf':
+        raise ValueError('{} kernel classifiers cannot be exported'.format(kernel))
+    support_vectors = sparse.csr_matrix(classifier.support_vectors_, dtype=np.float64)
+    dual_coef = classifier.dual_coef_
+    dual_coef = dual_coef.toarray() if sparse.issparse(dual_coef) else np.asarray(dual_coef)
+    metadata['kind'] = 'rbf'
+    metadata['gamma'] = float(classifier._gamma)
+    return metadata, {'sv_data': support_vectors.data,
+                      'sv_indices': support_vectors.indices.astype(np.int32),
+                      'sv_indptr': support_vectors.indptr.astype(np.int32),
+                      'sv_squared_norms': np.asarray(support_vectors.multiply(support_vectors).sum(axis=1)).ravel(),
+                      'dual_coef': dual_coef.ravel().astype(np.float64)}
+
+
+def write_model_artifact(vectorizer: TfidfVectorizer, classifier, directory):
+    '''
+    saves a fitted vectorizer and classifier as a directory of .npy buffers:
+    the vocabulary is a sorted array of 64 bit term hashes with their columns,
+    so no Python dictionary has to be rebuilt when it is loaded.
+    Files are written in a temporary directory that is renamed at the end,
+    so a process never maps a half written artifact
+    '''
+    metadata = {'version': MODEL_ARTIFACT_FORMAT_VERSION, 'vectorizer': __vectorizer_metadata(vectorizer)}
+    classifier_metadata, arrays = __classifier_arrays(classifier)
+    metadata['classifier'] = classifier_metadata
+
+    terms = list(vectorizer.vocabulary_.keys())
+    hashes = np.array([term_hash(term) for term in terms], dtype=np.uint64)
+    if len(np.unique(hashes)) != len(hashes):
+        raise ValueError('two terms of the vocabulary have the same hash')
+    columns = np.array([vectorizer.vocabulary_[term] for term in terms], dtype=np.int32)
+    order = np.argsort(hashes)
+    arrays['term_hashes'] = hashes[order]
+    arrays['term_columns'] = columns[order]
+    arrays['idf'] = np.asarray(vectorizer.idf_, dtype=np.float64) if vectorizer.use_idf \
+        else np.ones(len(terms), dtype=np.float64)
+
+    temporary_directory = directory.rstrip('/') + '.tmp'
+    if os.path.isdir(temporary_directory):
+        shutil.rmtree(temporary_directory)
+    os.makedirs(temporary_directory)
+    for name, array in arrays.items():
+        np.save(os.path.join(temporary_directory, name + '.npy'), np.ascontiguousarray(array))
+    with open(os.path.join(temporary_directory, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f)
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    os.rename(temporary_directory, directory)
+
+
+def model_artifact_exists(directory):
+    return os.path.isfile(os.path.join(directory, 'metadata.json'))
+
+
+class MappedTextClassifier:
+    """
+    TF-IDF vectorizer and binary classifier (linear or RBF SVM) working on
+    the NumPy buffers of a model artifact, usually memory maps (see load_model_artifact):
+    processes mapping the same artifact share its pages instead of unpickling their own copy.
+    Predictions are the same of the original vectorizer and classifier.
+    """
+
+    def __init__(self, metadata, arrays):
+        self.__metadata = metadata
+        self.__arrays = arrays
+        vectorizer = metadata['vectorizer']
+        analyzer_parameters = {name: vectorizer[name] for name in ANALYZER_PARAMETERS}
+        analyzer_parameters['ngram_range'] = tuple(analyzer_parameters['ngram_range'])
+        self.__analyzer = TfidfVectorizer(**analyzer_parameters).build_analyzer()
+        self.__features = vectorizer['features']
+        classifier = metadata['classifier']
+        self.__classes = np.array(classifier['classes'])
+        self.__intercept = classifier['intercept']
+        self.__kind = classifier['kind']
+        if self.__kind == 'rbf':
+            self.__support_vectors = sparse.csr_matrix(
+                (arrays['sv_data'], arrays['sv_indices'], arrays['sv_indptr']),
+                shape=(len(arrays['sv_indptr']) - 1, self.__features), copy=False)
+
+    def get_metadata(self):
+        return self.__metadata
+
+    def get_classes(self):
+        return self.__classes
+
+    def get_features_number(self):
+        return self.__features
+
+    def get_nbytes(self):
+        '''
+        @return: bytes of the buffers of the artifact
+        '''
+        return sum(array.nbytes for array in self.__arrays.values())
+
+    def transform(self, texts):
+        '''
+        @return: CSR matrix of the TF-IDF vectors of the texts
+        '''
+        vectorizer = self.__metadata['vectorizer']
+        analyzer = self.__analyzer
+        hashes = []
+        rows = []
+        number_of_texts = 0
+        for row, text in enumerate(texts):
+            tokens = analyzer(text)
+            hashes.extend(term_hash(token) for token in tokens)
+            rows.extend([row] * len(tokens))
+            number_of_texts = row + 1
+        term_hashes = self.__arrays['term_hashes']
+        hashes = np.array(hashes, dtype=np.uint64)
+        rows = np.array(rows, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(term_hashes, hashes), len(term_hashes) - 1)
+        known = term_hashes[positions] == hashes
+        columns = self.__arrays['term_columns'][positions[known]].astype(np.int64)
+        rows = rows[known]
+
+        keys, counts = np.unique(rows * self.__features + columns, return_counts=True)
+        rows = keys // self.__features
+        columns = keys % self.__features
+        values = counts.astype(np.float64)
+        if vectorizer['binary']:
+            values[:] = 1.0
+        elif vectorizer['sublinear_tf']:
+            values = np.log(values) + 1
+        if vectorizer['use_idf']:
+            values *= self.__arrays['idf'][columns]
+        if vectorizer['norm'] == 'l2':
+            norms = np.sqrt(np.bincount(rows, values * values, minlength=number_of_texts))
+            values /= norms[rows]
+        elif vectorizer['norm'] == 'l1':
+            norms = np.bincount(rows, np.abs(values), minlength=number_of_texts)
+            values /= norms[rows]
+        return sparse.csr_matrix((values, (rows, columns)), shape=(number_of_texts, self.__features))
+
+    def decision_function(self, vectors):
+        if self.__kind == 'linear':
+            return vectors @ self.__arrays['coef'] + self.__intercept
+        squared_norms = np.asarray(vectors.multiply(vectors).sum(axis=1))
+        dot_products = (vectors @ self.__support_vectors.T).toarray()
+        kernel = np.exp(-self.__metadata['classifier']['gamma'] *
+                        np.maximum(squared_norms + self.__arrays['sv_squared_norms'] - 2 * dot_products, 0))
+        return kernel @ self.__arrays['dual_coef'] + self.__intercept
+
+    def predict(self, vectors):
+        return self.__classes[(self.decision_function(vectors) > 0).astype(np.int64)]
+
+    def predict_texts(self, texts):
+        '''
+        @return: array of labels
+        '''
+        texts = list(texts)
+        if not texts:
+            return self.__classes[:0]
+        return self.predict(self.transform(texts))
+
+    def warm_up(self):
+        '''
+        reads every page of the buffers and classifies a text, so the first
+        tweets do not pay for page faults and for compiling the tokenizer.
+        Pages already read by another process are found in the page cache
+        @return: seconds spent
+        '''
+        start = time.perf_counter()
+        for array in self.__arrays.values():
+            np.add.reduce(array, axis=None)
+        self.predict_texts(['terremoto'])
+        return time.perf_counter() - start
+
+
+def load_model_artifact(directory, mmap=True):
+    '''
+    @param mmap: if True the buffers are memory mapped, nothing is parsed or copied
+    @return: the MappedTextClassifier of an artifact saved by write_model_artifact
+    '''
+    with open(os.path.join(directory, 'metadata.json')) as f:
+        metadata = json.load(f)
+    if metadata['version'] != MODEL_ARTIFACT_FORMAT_VERSION:
+        raise ValueError('model artifact format version {} is not supported'.format(metadata['version']))
+    arrays = {}
+    for filename in os.listdir(directory):
+        if filename.endswith('.npy'):
+            arrays[filename[:-len('.npy')]] = np.load(os.path.join(directory, filename),
+                                                      mmap_mode='r' if mmap else None)
+    return MappedTextClassifier(metadata, arrays)
+
+
+def get_memory_usage():
+    '''
+    @return: (rss, pss, private) kB of the current process, from /proc/self/smaps_rollup.
+    PSS divides the shared pages among the processes mapping them
+    '''
+    usage = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 3 and fields[2] == 'kB':
+                usage[fields[0].rstrip(':')] = int(fields[1])
+    return usage.get('Rss', 0), usage.get('Pss', 0), usage.get('Private_Clean', 0) + usage.get('Private_Dirty', 0)
+
+
+def measure_model_process(factory, factory_kwargs, barrier, results):
+    '''
+    loads a filtering method in a new process, then measures it
+    while all the other processes keep their own one loaded
+    '''
+    start = time.perf_counter()
+    filtering_method = factory(**factory_kwargs)
+    loaded = time.perf_counter()
+    filtering_method.warm_up()
+    filtering_method.predict_texts(['ha fatto il terremoto'])
+    ready = time.perf_counter()
+    barrier.wait()
+    results.put((loaded - start, ready - start) + get_memory_usage())
+    barrier.wait()
+
+
+def measure_cold_start(factory, factory_kwargs, processes=4):
+    '''
+    @return: list with (load s, first prediction s, rss kB, pss kB, private kB) of every process
+    '''
+    import multiprocessing
+    context = multiprocessing.get_context('spawn')
+    barrier = context.Barrier(processes)
+    results = context.Queue()
+    workers = [context.Process(target=measure_model_process, args=(factory, factory_kwargs, barrier, results))
+               for i in range(processes)]
+    for worker in workers:
+        worker.start()
+    measures = [results.get() for i in range(processes)]
+    for worker in workers:
+        worker.join()
+    return measures
+
+
+if __name__ == '__main__':
+    '''
+        exports the pickled states of the filtering methods as model artifacts
+        and compares their cold start and memory usage, e.g.
+        python -m server.tweet_handling.model_artifacts --processes 4
+    '''
+    import argparse
+    from server.tweet_handling.DamageTweetFM.DamageTweetFM import DamageTweetFM
+    from server.tweet_handling.EarthquakeTweetFM.EarthquakeTweetFM import EarthquakeTweetFM, CLASSIFIER_TYPES
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processes', type=int, default=4)
+    args = parser.parse_args()
+
+    methods = [(EarthquakeTweetFM, {'classifier_type': classifier_type}) for classifier_type in CLASSIFIER_TYPES]
+    methods.append((DamageTweetFM, {}))
+    print('{:<28} {:<8} {:>9} {:>12} {:>10} {:>10} {:>12}'.format(
+        'model', 'format', 'load (s)', 'ready (s)', 'RSS (MB)', 'PSS (MB)', 'private (MB)'))
+    for factory, factory_kwargs in methods:
+        name = factory.__name__ + ' ' + factory_kwargs.get('classifier_type', '')
+        pickled = factory(use_artifact=False, **factory_kwargs)
+        if pickled.classifier is None or not hasattr(pickled.classifier, 'classes_'):
+            print('{:<28} not trained'.format(name))
+            continue
+        write_model_artifact(pickled.vectorizer, pickled.classifier, pickled.artifact_path)
+        for model_format, use_artifact in [('pickle', False), ('mmap', True)]:
+            measures = np.array(measure_cold_start(factory, dict(factory_kwargs, use_artifact=use_artifact),
+                                                   args.processes))
+            load, ready, rss, pss, private = measures.mean(axis=0)
+            print('{:<28} {:<8} {:>9.3f} {:>12.3f} {:>10.1f} {:>10.1f} {:>12.1f}'.format(
+                name, model_format, load, ready, rss / 1024, pss / 1024, private / 1024))
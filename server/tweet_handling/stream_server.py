@@ -0,0 +1,164 @@
+import argparse
+import asyncio
+import json
+import threading
+import time
+
+from server.tweet_handling.tweet_replay import read_jsonl_corpus, read_labelled_csv_corpus, get_created_at, \
+    EARTHQUAKE_DATASET
+
+
+class StandInStreamServer:
+    """
+    Local stand-in of the Twitter streaming API: every GET gets an HTTP response
+    with chunked transfer encoding, a tweet JSON on every line, sent with the same
+    inter-arrival times of their created_at divided by speed (0 or None is the maximum speed),
+    and an empty keep alive line when nothing is sent for keep_alive seconds.
+    Writes wait for the client to read (drain), so a slow client slows the server down
+    as Twitter would; disconnect_after closes the connection after that number of tweets,
+    to test the reconnections.
+    """
+
+    def __init__(self, corpus, host='127.0.0.1', port=0, speed=1.0, keep_alive=30.0, disconnect_after=None,
+                 repeat=False):
+        '''
+        @param corpus: list of tweet dictionaries (see tweet_replay)
+        @param port: 0 to use a free port, see get_port
+        @param repeat: if True the corpus is sent again when it ends, otherwise the response ends
+        '''
+        self.__corpus = sorted(corpus, key=get_created_at)
+        self.__lines = [json.dumps(tweet, ensure_ascii=False).encode('utf-8') + b'\r\n' for tweet in self.__corpus]
+        self.__host = host
+        self.__port = port
+        self.__speed = speed or None
+        self.__keep_alive = keep_alive
+        self.__disconnect_after = disconnect_after
+        self.__repeat = repeat
+        self.__server = None
+        self.__loop = None
+        self.__started = threading.Event()
+        # position of the next tweet, shared by the connections so a reconnection resumes the stream
+        self.__next = 0
+        self.__sent = 0
+        self.__connections = 0
+        self.__drain_seconds = 0.0
+
+    def get_port(self):
+        return self.__port
+
+    def get_url(self):
+        return 'http://{}:{}/1.1/statuses/filter.json'.format(self.__host, self.__port)
+
+    def get_sent(self):
+        return self.__sent
+
+    def get_connections(self):
+        return self.__connections
+
+    def get_drain_seconds(self):
+        '''
+        @return: time spent waiting for the clients to read, the backpressure seen by the server
+        '''
+        return self.__drain_seconds
+
+    @staticmethod
+    def __chunk(data: bytes):
+        return '{:x}\r\n'.format(len(data)).encode('ascii') + data + b'\r\n'
+
+    async def __write(self, writer, data):
+        writer.write(self.__chunk(data))
+        start = time.perf_counter()
+        await writer.drain()
+        self.__drain_seconds += time.perf_counter() - start
+
+    async def __handle(self, reader, writer):
+        self.__connections += 1
+        try:
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                         b'Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n')
+            sent = 0
+            start = time.perf_counter()
+            first = get_created_at(self.__corpus[self.__next]) if self.__corpus else None
+            last_write = start
+            while self.__next < len(self.__lines):
+                if self.__disconnect_after is not None and sent >= self.__disconnect_after:
+                    # drops the connection as Twitter does, without the final chunk
+                    return
+                if self.__speed is not None:
+                    delay = (get_created_at(self.__corpus[self.__next]) - first).total_seconds() / self.__speed
+                    while start + delay > time.perf_counter():
+                        if time.perf_counter() - last_write >= self.__keep_alive:
+                            await self.__write(writer, b'\r\n')
+                            last_write = time.perf_counter()
+                        await asyncio.sleep(min(start + delay - time.perf_counter(), self.__keep_alive))
+                await self.__write(writer, self.__lines[self.__next])
+                last_write = time.perf_counter()
+                self.__next += 1
+                self.__sent += 1
+                sent += 1
+                if self.__repeat and self.__next == len(self.__lines):
+                    self.__next = 0
+                    start = time.perf_counter()
+                    first = get_created_at(self.__corpus[0])
+            writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        self.__loop = asyncio.get_running_loop()
+        self.__server = await asyncio.start_server(self.__handle, self.__host, self.__port)
+        self.__port = self.__server.sockets[0].getsockname()[1]
+        self.__started.set()
+        return self.__port
+
+    async def serve_forever(self):
+        if self.__server is None:
+            await self.start()
+        async with self.__server:
+            await self.__server.serve_forever()
+
+    def start_in_thread(self):
+        '''
+        serves in a daemon thread with its own event loop
+        @return: the port
+        '''
+        threading.Thread(target=lambda: asyncio.run(self.serve_forever()), daemon=True).start()
+        self.__started.wait()
+        return self.__port
+
+    def stop(self):
+        if self.__loop is not None and self.__server is not None:
+            self.__loop.call_soon_threadsafe(self.__server.close)
+
+
+if __name__ == '__main__':
+    '''
+        serves a corpus as the Twitter stream, e.g.
+        python -m server.tweet_handling.stream_server --rate 50 --port 8081
+        then TWEET_STREAM_URL=http://127.0.0.1:8081/ python earthquake.py
+    '''
+    parser = argparse.ArgumentParser(description='local stand-in of the Twitter streaming API')
+    parser.add_argument('--jsonl', help='file with a tweet JSON on every line')
+    parser.add_argument('--csv', nargs='+', default=[EARTHQUAKE_DATASET],
+                        help='labelled datasets used when --jsonl is not given')
+    parser.add_argument('--rate', type=float, default=2.0, help='tweets per second of the synthetic corpus')
+    parser.add_argument('--speed', type=float, default=1.0, help='1 is real time, 0 the maximum speed')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--repeat', action='store_true', help='sends the corpus again when it ends')
+    args = parser.parse_args()
+
+    if args.jsonl:
+        stream_corpus = read_jsonl_corpus(args.jsonl)
+    else:
+        stream_corpus = read_labelled_csv_corpus(args.csv, tweets_per_second=args.rate)
+    server = StandInStreamServer(stream_corpus, args.host, args.port, args.speed, repeat=args.repeat)
+    print('serving {} tweets on {}'.format(len(stream_corpus), server.get_url()))
+    asyncio.run(server.serve_forever())
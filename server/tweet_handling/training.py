@@ -0,0 +1,245 @@
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import pickle
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn import svm
+from sklearn.base import clone
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics import accuracy_score, f1_score
+from sklearn.model_selection import StratifiedKFold
+
+from server.tweet_handling.DamageTweetFM.DamageTweetFM import DamageTweetFM
+from server.tweet_handling.EarthquakeTweetFM.EarthquakeTweetFM import EarthquakeTweetFM
+
+FEATURE_CACHE_DIRECTORY = 'server/tweet_handling/feature_cache/'
+# filtering method -> (class, dataset)
+FILTERING_METHODS = {
+    'earthquake': (EarthquakeTweetFM, 'server/tweet_handling/EarthquakeTweetFM/EarthquakeTweetFM_dataset.csv'),
+    'damage': (DamageTweetFM, 'server/tweet_handling/DamageTweetFM/DamageTweetFM_dataset.csv'),
+}
+# vectorizer parameters tried on top of the ones of the filtering method
+VECTORIZER_GRID = {'ngram_range': [(1, 1), (1, 2)]}
+CLASSIFIER_GRIDS = {
+    'svc': (svm.SVC(kernel='rbf', gamma='scale'), {'C': [1.0, 5.0, 10.0], 'gamma': ['scale', 0.5]}),
+    'linear': (svm.LinearSVC(), {'C': [0.1, 1.0, 10.0]}),
+}
+
+
+def file_hash(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def parameters_hash(parameters: dict):
+    text = json.dumps(parameters, sort_keys=True, default=str)
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def expand_grid(grid: dict):
+    '''
+    @return: list of dictionaries, one for every combination of the values of the grid
+    '''
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def get_fold_path(cache_key, fold):
+    return os.path.join(FEATURE_CACHE_DIRECTORY, '{}_fold{}.npz'.format(cache_key, fold))
+
+
+def build_fold_features(dataset_path, vectorizer_parameters, cache_key, fold, train_index, test_index):
+    '''
+    fits the vectorizer on the training part of the fold and saves both matrices,
+    unless they are already in the cache.
+    The vectorizer is fitted on the training part only, so the idf does not see the test tweets
+    '''
+    path = get_fold_path(cache_key, fold)
+    if os.path.isfile(path):
+        return path
+    data = pd.read_csv(dataset_path)
+    vectorizer = TfidfVectorizer(**vectorizer_parameters)
+    train_vectors = vectorizer.fit_transform(data['Content'].iloc[train_index])
+    test_vectors = vectorizer.transform(data['Content'].iloc[test_index])
+    os.makedirs(FEATURE_CACHE_DIRECTORY, exist_ok=True)
+    temporary_path = path + '.tmp.npz'
+    np.savez(temporary_path, train_data=train_vectors.data, train_indices=train_vectors.indices,
+             train_indptr=train_vectors.indptr, train_shape=train_vectors.shape,
+             test_data=test_vectors.data, test_indices=test_vectors.indices,
+             test_indptr=test_vectors.indptr, test_shape=test_vectors.shape,
+             train_labels=np.asarray(data['Label'].iloc[train_index], dtype=str),
+             test_labels=np.asarray(data['Label'].iloc[test_index], dtype=str),
+             test_texts=np.asarray(data['Content'].iloc[test_index], dtype=str),
+             vectorizer=np.frombuffer(pickle.dumps(vectorizer), dtype=np.uint8))
+    os.replace(temporary_path, path)
+    return path
+
+
+def load_fold_features(path):
+    '''
+    @return: train vectors, train labels, test vectors, test labels, test texts, fitted vectorizer
+    '''
+    with np.load(path) as fold:
+        train_vectors = sparse.csr_matrix((fold['train_data'], fold['train_indices'], fold['train_indptr']),
+                                          shape=tuple(fold['train_shape']))
+        test_vectors = sparse.csr_matrix((fold['test_data'], fold['test_indices'], fold['test_indptr']),
+                                         shape=tuple(fold['test_shape']))
+        vectorizer = pickle.loads(fold['vectorizer'].tobytes())
+        return train_vectors, fold['train_labels'], test_vectors, fold['test_labels'], \
+               list(fold['test_texts']), vectorizer
+
+
+def evaluate_candidate(fold_path, classifier_type, classifier_parameters):
+    '''
+    trains a classifier on a cached fold
+    @return: dictionary with accuracy, positive F1 and size of the pickled model (bytes)
+    '''
+    train_vectors, train_labels, test_vectors, test_labels, test_texts, vectorizer = load_fold_features(fold_path)
+    classifier = clone(CLASSIFIER_GRIDS[classifier_type][0]).set_params(**classifier_parameters)
+    classifier.fit(train_vectors, train_labels)
+    predictions = classifier.predict(test_vectors)
+    return {'accuracy': accuracy_score(test_labels, predictions),
+            'f1': f1_score(test_labels, predictions, pos_label='pos'),
+            'size': len(pickle.dumps(classifier)) + len(pickle.dumps(vectorizer))}
+
+
+def measure_latency(fold_path, classifier_type, classifier_parameters, repeats=3):
+    '''
+    trains a classifier on a cached fold and times it on the test tweets of the fold.
+    Called in this process after the search, so the timing does not compete for the CPU with the pool
+    @return: inference latency per tweet (seconds, texts vectorized and classified in one batch, best of repeats)
+    '''
+    train_vectors, train_labels, _, _, test_texts, vectorizer = load_fold_features(fold_path)
+    classifier = clone(CLASSIFIER_GRIDS[classifier_type][0]).set_params(**classifier_parameters)
+    classifier.fit(train_vectors, train_labels)
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        classifier.predict(vectorizer.transform(test_texts))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(test_texts)
+
+
+def search(fm_name, classifier_types=('svc', 'linear'), folds=5, processes=None, seed=0):
+    '''
+    cross validated grid search over the vectorizer and classifier parameters,
+    the candidates of every fold are trained in parallel by a process pool.
+    Feature matrices are cached on disk, keyed by the hash of the dataset, of the vectorizer
+    parameters and of the split, so a new search only trains the classifiers.
+    Then the latency of every candidate is measured serially, on the first fold
+    @return: list of results, one for each candidate, sorted by accuracy
+    '''
+    fm_class, dataset_path = FILTERING_METHODS[fm_name]
+    base_parameters = fm_class(get_existing=False).vectorizer.get_params()
+    data = pd.read_csv(dataset_path)
+    splits = list(StratifiedKFold(n_splits=folds, shuffle=True, random_state=seed).split(data['Content'],
+                                                                                         data['Label']))
+    dataset_key = file_hash(dataset_path)
+
+    with multiprocessing.Pool(processes) as pool:
+        feature_tasks = []
+        vectorizer_candidates = []
+        for vectorizer_changes in expand_grid(VECTORIZER_GRID):
+            vectorizer_parameters = dict(base_parameters, **vectorizer_changes)
+            cache_key = '{}_{}'.format(dataset_key, parameters_hash(dict(vectorizer_parameters, folds=folds,
+                                                                         seed=seed)))
+            vectorizer_candidates.append((vectorizer_changes, cache_key))
+            for fold, (train_index, test_index) in enumerate(splits):
+                feature_tasks.append((dataset_path, vectorizer_parameters, cache_key, fold, train_index, test_index))
+        pool.starmap(build_fold_features, feature_tasks)
+
+        candidates = []
+        evaluation_tasks = []
+        for vectorizer_changes, cache_key in vectorizer_candidates:
+            for classifier_type in classifier_types:
+                for classifier_parameters in expand_grid(CLASSIFIER_GRIDS[classifier_type][1]):
+                    candidates.append((vectorizer_changes, cache_key, classifier_type, classifier_parameters))
+                    for fold in range(folds):
+                        evaluation_tasks.append((get_fold_path(cache_key, fold), classifier_type,
+                                                 classifier_parameters))
+        evaluations = pool.starmap(evaluate_candidate, evaluation_tasks)
+
+    results = []
+    for i, (vectorizer_changes, cache_key, classifier_type, classifier_parameters) in enumerate(candidates):
+        fold_evaluations = evaluations[i * folds:(i + 1) * folds]
+        result = {'vectorizer': vectorizer_changes, 'classifier_type': classifier_type,
+                  'classifier': classifier_parameters}
+        for measure in ['accuracy', 'f1', 'size']:
+            result[measure] = float(np.mean([evaluation[measure] for evaluation in fold_evaluations]))
+        result['accuracy_std'] = float(np.std([evaluation['accuracy'] for evaluation in fold_evaluations]))
+        results.append((result, cache_key))
+    # after the pool has finished, so every candidate is timed on an idle CPU in the same conditions
+    for result, cache_key in results:
+        result['latency'] = measure_latency(get_fold_path(cache_key, 0), result['classifier_type'],
+                                            result['classifier'])
+    return sort_results([result for result, _ in results])
+
+
+def sort_results(results, measure='accuracy'):
+    '''
+    @param measure: 'accuracy' or 'f1' (the best first, ties broken by the other one), or 'latency' (the fastest first)
+    '''
+    if measure == 'latency':
+        return sorted(results, key=lambda result: result['latency'])
+    other = 'f1' if measure == 'accuracy' else 'accuracy'
+    return sorted(results, key=lambda result: (-result[measure], -result[other]))
+
+
+def print_report(results):
+    print('{:<8} {:<32} {:<28} {:>16} {:>8} {:>10} {:>13}'.format(
+        'model', 'classifier', 'vectorizer', 'accuracy', 'pos f1', 'size (kB)', 'latency (ms)'))
+    for result in results:
+        print('{:<8} {:<32} {:<28} {:>9.4f} ±{:.3f} {:>8.4f} {:>10.1f} {:>13.4f}'.format(
+            result['classifier_type'], json.dumps(result['classifier']), json.dumps(result['vectorizer']),
+            result['accuracy'], result['accuracy_std'], result['f1'], result['size'] / 1024,
+            result['latency'] * 1000))
+
+
+def train_and_save(fm_name, result):
+    '''
+    trains the filtering method on the whole dataset with the parameters of a search result
+    and saves its state (pickles and model artifact)
+    '''
+    fm_class, dataset_path = FILTERING_METHODS[fm_name]
+    kwargs = {'classifier_type': result['classifier_type']} if fm_class is EarthquakeTweetFM else {}
+    filtering_method = fm_class(get_existing=False, **kwargs)
+    filtering_method.vectorizer.set_params(**result['vectorizer'])
+    filtering_method.classifier = clone(CLASSIFIER_GRIDS[result['classifier_type']][0]).set_params(
+        **result['classifier'])
+    filtering_method.train(pd.read_csv(dataset_path), save_to_file=True)
+    return filtering_method
+
+
+if __name__ == '__main__':
+    '''
+        cross validated training of the filtering methods, e.g.
+        python -m server.tweet_handling.training earthquake --classifier svc linear --save
+    '''
+    parser = argparse.ArgumentParser(description='hyperparameter search of the filtering methods')
+    parser.add_argument('filtering_method', choices=sorted(FILTERING_METHODS))
+    parser.add_argument('--classifier', nargs='+', choices=sorted(CLASSIFIER_GRIDS), default=['svc', 'linear'])
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--processes', type=int, help='worker processes, the number of cores by default')
+    parser.add_argument('--sort', choices=['accuracy', 'f1', 'latency'], default='accuracy',
+                        help='order of the report, the first model is the one saved')
+    parser.add_argument('--save', action='store_true', help='trains the best model on all the data and saves it')
+    args = parser.parse_args()
+
+    search_results = sort_results(search(args.filtering_method, args.classifier, args.folds, args.processes),
+                                  args.sort)
+    print_report(search_results)
+    if args.save:
+        best = search_results[0]
+        train_and_save(args.filtering_method, best)
+        print('saved', best['classifier_type'], best['classifier'], best['vectorizer'])
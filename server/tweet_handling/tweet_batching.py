@@ -0,0 +1,78 @@
+import time
+from collections import Counter
+from queue import Queue, Empty
+
+
+class TweetBatcher:
+    """
+    Builds batches of tweets from a queue for the classifier.
+    A batch is closed when it reaches max_batch_size tweets or when
+    max_wait seconds passed since its first tweet arrived, so a single
+    tweet is not delayed for long and a burst does not produce a huge batch.
+    The sizes of the formed batches are counted.
+    """
+
+    def __init__(self, queue: Queue, max_batch_size=256, max_wait=0.05):
+        '''
+        @param queue: queue the tweets are taken from
+        @param max_batch_size: maximum number of tweets in a batch
+        @param max_wait: maximum seconds to wait for more tweets after the first one
+        '''
+        self.__queue = queue
+        self.__max_batch_size = max_batch_size
+        self.__max_wait = max_wait
+        self.__batch_sizes = Counter()
+
+    def get_max_batch_size(self):
+        return self.__max_batch_size
+
+    def get_max_wait(self):
+        return self.__max_wait
+
+    def set_max_batch_size(self, max_batch_size: int):
+        if max_batch_size > 0:
+            self.__max_batch_size = max_batch_size
+
+    def set_max_wait(self, max_wait: float):
+        if max_wait >= 0:
+            self.__max_wait = max_wait
+
+    def next_batch(self):
+        '''
+        blocks until at least a tweet is available
+        @return: list of tweets
+        '''
+        batch = [self.__queue.get()]
+        deadline = time.monotonic() + self.__max_wait
+        while len(batch) < self.__max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self.__queue.get(timeout=remaining))
+                else:
+                    batch.append(self.__queue.get_nowait())
+            except Empty:
+                break
+        self.__batch_sizes[len(batch)] += 1
+        return batch
+
+    def get_batch_sizes(self):
+        '''
+        @return: Counter batch size -> number of batches formed with that size
+        '''
+        return self.__batch_sizes
+
+    def get_batches_number(self):
+        return sum(self.__batch_sizes.values())
+
+    def get_mean_batch_size(self):
+        batches = self.get_batches_number()
+        if batches == 0:
+            return 0.0
+        return sum(size * number for size, number in self.__batch_sizes.items()) / batches
+
+    def __str__(self):
+        return 'batches: {}, mean size: {:.1f}, max size: {}, full batches: {}'.format(
+            self.get_batches_number(), self.get_mean_batch_size(),
+            max(self.__batch_sizes) if self.__batch_sizes else 0,
+            self.__batch_sizes[self.__max_batch_size])
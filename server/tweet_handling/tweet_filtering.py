@@ -1,8 +1,19 @@
+import hashlib
+import multiprocessing
+import os
+import re
+import sys
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from typing import List
+
 import pandas as pd
 from osgeo import ogr
 from tweepy import Status
 
+URL_PATTERN = re.compile(r'https?://\S+')
+EPOCH = datetime(1970, 1, 1)
+
 
 def get_tweet_text(tweet: Status):
     if hasattr(tweet, "retweeted_status"):  # Check if Retweet
@@ -18,20 +29,17 @@ def get_tweet_text(tweet: Status):
     return text
 
 
-def get_tweet_geom(tweet: Status):
+def get_tweet_coordinates(tweet: Status):
+    '''
+    @return: (lon, lat) of the tweet place, (None, None) if it has no place
+    '''
     if tweet.place is not None:
         # we have to take the coords in the bounding_box
         box = tweet.place.bounding_box.coordinates
         # we take the first one in bbox, it could be improved in the future
-        geom = box[0][0]
-        x = geom[0]
-        y = geom[1]
-        geom = ogr.Geometry(ogr.wkbPoint)
-        geom.AddPoint(x, y)
-    else:
-        geom = None
-
-    return geom
+        x, y = box[0][0][0], box[0][0][1]
+        return float(x), float(y)
+    return None, None
 
 
 def get_tweet_place(tweet: Status):
@@ -43,28 +51,105 @@ def get_tweet_place(tweet: Status):
     return place
 
 
+def datetime_to_timestamp(time_posted: datetime):
+    '''
+    @param time_posted: naive UTC datetime, as the ones of tweepy
+    '''
+    if time_posted is None:
+        return None
+    return (time_posted - EPOCH).total_seconds()
+
+
+def intern_string(string):
+    return None if string is None else sys.intern(string)
+
+
 class TweetUsefulInfos(object):
-    def __init__(self, tweet_status: Status):
-        self.__text = get_tweet_text(tweet_status)
-        self.__author = tweet_status.author.name
-        self.__geometry = get_tweet_geom(tweet_status)
-        self.__place = get_tweet_place(tweet_status)
-        self.__time_posted = tweet_status.created_at
+    """
+    Compact record of a tweet: coordinates are two floats and the time is
+    the epoch in seconds, the author and the place are interned strings
+    shared by all their tweets. The OGR point is created only when
+    get_geometry is called, e.g. when the tweet is written in a layer.
+    Records are pickled as a plain tuple, so they cross process boundaries cheaply.
+    """
+    __slots__ = ('tweet_id', 'text', 'author', 'place', 'lon', 'lat', 'timestamp', 'damage',
+                 'location_confidence')
+
+    def __init__(self, tweet_status: Status = None):
+        if tweet_status is None:
+            # filled by __setstate__ or by the caller
+            return
+        self.tweet_id = getattr(tweet_status, 'id', None)
+        self.text = get_tweet_text(tweet_status)
+        self.author = intern_string(tweet_status.author.name)
+        self.lon, self.lat = get_tweet_coordinates(tweet_status)
+        self.place = intern_string(get_tweet_place(tweet_status))
+        self.timestamp = datetime_to_timestamp(tweet_status.created_at)
+        self.damage = None
+        # 1 for the tweets with a place, the confidence of the geoparser for the ones located from the text
+        self.location_confidence = 1.0 if self.lon is not None else None
+
+    def __getstate__(self):
+        return (self.tweet_id, self.text, self.author, self.place, self.lon, self.lat, self.timestamp,
+                self.damage, self.location_confidence)
+
+    def __setstate__(self, state):
+        self.tweet_id, self.text, author, place, self.lon, self.lat, self.timestamp, \
+            self.damage, self.location_confidence = state
+        self.author = intern_string(author)
+        self.place = intern_string(place)
+
+    def get_tweet_id(self):
+        return self.tweet_id
 
     def get_text(self):
-        return self.__text
+        return self.text
 
     def get_author(self):
-        return self.__author
+        return self.author
+
+    def has_location(self):
+        return self.lon is not None
 
     def get_geometry(self):
-        return self.__geometry
+        '''
+        @return: a new OGR point, None if the tweet has no location
+        '''
+        if self.lon is None:
+            return None
+        geom = ogr.Geometry(ogr.wkbPoint)
+        geom.AddPoint(self.lon, self.lat)
+        return geom
 
     def get_place(self):
-        return self.__place
+        return self.place
 
     def get_time_posted(self):
-        return self.__time_posted
+        '''
+        @return: naive UTC datetime, as the ones of tweepy
+        '''
+        if self.timestamp is None:
+            return None
+        return EPOCH + timedelta(seconds=self.timestamp)
+
+    def get_damage(self):
+        return self.damage
+
+    def get_location_confidence(self):
+        return self.location_confidence
+
+    def set_geoparsed_location(self, x, y, place_name, confidence):
+        '''
+        locates the tweet in the place named in its text
+        '''
+        self.lon = float(x)
+        self.lat = float(y)
+        if self.place is None:
+            self.place = intern_string(place_name)
+        self.location_confidence = confidence
+
+    def set_damage(self, damage):
+        self.damage = damage
 
     def __str__(self):
         return 'Tweet text: {}\n posted at {}\n by {}\n the {}\n'.format(self.get_text(), self.get_place(),
@@ -79,27 +164,242 @@ class FilteringMethod:
     def predict(self, data: pd.DataFrame):
         pass
 
+    def predict_texts(self, texts: List[str]):
+        '''
+        @param texts: list of tweet texts
+        @return: array of labels.
+        Subclasses should override it to avoid building a DataFrame
+        '''
+        return self.predict(pd.DataFrame(texts, columns=['Content']))
+
+    def partial_fit(self, texts: List[str], labels: List[str]):
+        '''
+        updates the method with labelled tweets while it is used
+        @return: False if the method cannot learn online
+        '''
+        return False
+
+    def warm_up(self):
+        '''
+        prepares the method to classify the first tweets without delays
+        (e.g. reading a memory mapped model). Nothing to do by default
+        '''
+        pass
+
+
+def normalize_tweet_text(text: str):
+    '''
+    @return: the text lowercased, without links and with collapsed white spaces,
+    so that copies of the same tweet get the same text
+    '''
+    text = URL_PATTERN.sub(' ', text.lower())
+    return ' '.join(text.split())
+
+
+class LabelCache:
+    """
+    Bounded LRU cache text -> label.
+    Keys are hashes of the normalized texts, so memory does not
+    depend on the length of the tweets.
+    It counts hits and misses to know how much classifier work it saves.
+    """
+
+    def __init__(self, max_size=4096):
+        self.__max_size = max_size
+        self.__labels = OrderedDict()
+        self.__hits = 0
+        self.__misses = 0
+
+    @staticmethod
+    def get_key(text: str):
+        return hashlib.blake2b(normalize_tweet_text(text).encode('utf-8'), digest_size=16).digest()
+
+    def get(self, key):
+        '''
+        @return: the cached label or None
+        '''
+        label = self.__labels.get(key)
+        if label is None:
+            self.__misses += 1
+        else:
+            self.__hits += 1
+            self.__labels.move_to_end(key)
+        return label
+
+    def put(self, key, label):
+        self.__labels[key] = label
+        self.__labels.move_to_end(key)
+        if len(self.__labels) > self.__max_size:
+            self.__labels.popitem(last=False)
+
+    def clear(self):
+        self.__labels.clear()
+
+    def get_max_size(self):
+        return self.__max_size
+
+    def get_hits(self):
+        return self.__hits
+
+    def get_misses(self):
+        return self.__misses
+
+    def get_hit_ratio(self):
+        lookups = self.__hits + self.__misses
+        if lookups == 0:
+            return 0.0
+        return self.__hits / lookups
+
+    def __len__(self):
+        return len(self.__labels)
+
+    def __str__(self):
+        return 'label cache: {} hits, {} misses ({:.1%} hit ratio), {} labels stored'.format(
+            self.__hits, self.__misses, self.get_hit_ratio(), len(self.__labels))
+
 
 class TweetFilter(object):
-    def __init__(self, filtering_method: FilteringMethod):
+    def __init__(self, filtering_method: FilteringMethod, cache_size=4096, damage_method: FilteringMethod = None):
+        '''
+        @param filtering_method: method used to classify the tweets
+        @param cache_size: number of labels kept in the LRU cache, 0 to disable it
+        @param damage_method: if set, it labels the positive tweets with set_damage
+        '''
         self.filtering_method = filtering_method
+        self.damage_method = damage_method
+        self.label_cache = LabelCache(cache_size) if cache_size else None
+
+    def predict_labels(self, texts: List[str]):
+        '''
+        @param texts: list of tweet texts
+        @return: list of labels, in the same order of the texts
+        '''
+        return self.filtering_method.predict_texts(texts)
+
+    def start_predicting_labels(self, texts: List[str]):
+        '''
+        @return: callable returning the labels of the texts.
+        Here they are predicted before returning, a ParallelTweetFilter predicts them while the caller goes on
+        '''
+        labels = self.predict_labels(texts)
+        return lambda: labels
+
+    def __start_labels(self, tweet_texts: List[str]):
+        if self.label_cache is None:
+            return self.start_predicting_labels(tweet_texts)
+        # only the texts not in the cache are classified, each distinct text once
+        keys = [LabelCache.get_key(text) for text in tweet_texts]
+        labels = [self.label_cache.get(key) for key in keys]
+        texts_to_predict = {}
+        for i, label in enumerate(labels):
+            if label is None:
+                texts_to_predict.setdefault(keys[i], tweet_texts[i])
+        if not texts_to_predict:
+            return lambda: labels
+        get_predicted = self.start_predicting_labels(list(texts_to_predict.values()))
+
+        def get_labels():
+            new_labels = dict(zip(texts_to_predict.keys(), get_predicted()))
+            for key, label in new_labels.items():
+                self.label_cache.put(key, label)
+            for i, label in enumerate(labels):
+                if label is None:
+                    labels[i] = new_labels[keys[i]]
+            return labels
+
+        return get_labels
+
+    def __start_by_label(self, tweets: List[TweetUsefulInfos], label: str):
+        get_labels = self.__start_labels([tweet.get_text() for tweet in tweets])
+        return lambda: [tweet for tweet, tweet_label in zip(tweets, get_labels()) if tweet_label == label]
 
-    def __get_by_label(self, tweets: List[TweetUsefulInfos], label: str):
-        tweet_texts = []
-        for tweet in tweets:
-            tweet_texts.append(tweet.get_text())
-        labels = self.filtering_method.predict(pd.DataFrame(tweet_texts, columns=['Content']))
-        filtered_tweets = []
-        for i in range(len(labels)):
-            if labels[i] == label:
-                filtered_tweets.append(tweets[i])
-        return filtered_tweets
+    def start_filtering(self, tweets: List[TweetUsefulInfos]):
+        '''
+        starts classifying the tweets, so the next batch can be collected while they are classified
+        @return: callable returning the positive tweets, as get_all_positives
+        '''
+        get_positives = self.__start_by_label(tweets, 'pos')
+
+        def get_all_positives():
+            positive_tweets = get_positives()
+            if self.damage_method is not None and positive_tweets:
+                # the damage classifier only sees the tweets already known to be about an earthquake
+                damages = self.damage_method.predict_texts([tweet.get_text() for tweet in positive_tweets])
+                for tweet, damage in zip(positive_tweets, damages):
+                    tweet.set_damage(damage)
+            return positive_tweets
+
+        return get_all_positives
 
     def get_all_positives(self, tweets: List[TweetUsefulInfos]):
-        positive_tweets = self.__get_by_label(tweets=tweets, label='pos')
-        return positive_tweets
+        return self.start_filtering(tweets)()
 
     def get_all_negatives(self, tweets: List[TweetUsefulInfos]):
-        negative_tweets = self.__get_by_label(tweets=tweets, label='neg')
-        return negative_tweets
+        return self.__start_by_label(tweets, 'neg')()
+
+
+# filtering method of the current worker process of a ParallelTweetFilter
+worker_filtering_method = None
+
+
+def init_classification_worker(filtering_method_factory, factory_kwargs):
+    '''
+    executed once in every worker process: the model is loaded only here
+    '''
+    global worker_filtering_method
+    worker_filtering_method = filtering_method_factory(**factory_kwargs)
+    worker_filtering_method.warm_up()
+
+
+def classify_in_worker(texts: List[str]):
+    return list(worker_filtering_method.predict_texts(texts))
+
+
+class ParallelTweetFilter(TweetFilter):
+    """
+    TweetFilter that classifies in a pool of worker processes,
+    each one with its own copy of the filtering method, so that
+    classification is not bound to a single core by the GIL.
+    A batch is split into consecutive chunks, one for each worker,
+    and the labels are joined back in the original order.
+    Workers are spawned, not forked, since the pipeline threads are already running;
+    with start_filtering a batch is classified while the caller collects the next one.
+    """
+
+    def __init__(self, filtering_method_factory, workers=None, factory_kwargs=None, min_chunk_size=16,
+                 cache_size=4096, damage_method: FilteringMethod = None):
+        '''
+        @param filtering_method_factory: picklable callable creating the FilteringMethod
+        (e.g. the EarthquakeTweetFM class), called once in each worker
+        @param workers: number of processes, the number of cores if None
+        @param factory_kwargs: keyword arguments of the factory
+        @param min_chunk_size: batches are not split in chunks smaller than this
+        @param cache_size, damage_method: see TweetFilter
+        '''
+        super().__init__(None, cache_size=cache_size, damage_method=damage_method)
+        self.__workers = workers or os.cpu_count() or 1
+        self.__min_chunk_size = min_chunk_size
+        # forking a process with running threads could copy locks held by them in the workers
+        self.__pool = multiprocessing.get_context('spawn').Pool(
+            self.__workers, initializer=init_classification_worker,
+            initargs=(filtering_method_factory, factory_kwargs or {}))
+
+    def get_workers(self):
+        return self.__workers
+
+    def predict_labels(self, texts: List[str]):
+        return self.start_predicting_labels(texts)()
+
+    def start_predicting_labels(self, texts: List[str]):
+        texts = list(texts)
+        if not texts:
+            return lambda: []
+        chunk_size = max(self.__min_chunk_size, -(-len(texts) // self.__workers))
+        chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+        # the chunks are classified in background, get returns them in the order they were submitted
+        result = self.__pool.map_async(classify_in_worker, chunks)
+        return lambda: [label for chunk_labels in result.get() for label in chunk_labels]
 
+    def close(self):
+        self.__pool.close()
+        self.__pool.join()
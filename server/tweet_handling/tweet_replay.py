@@ -0,0 +1,164 @@
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+from queue import Queue
+
+import numpy as np
+import pandas as pd
+from tweepy import Status
+
+from server.monitoring import pipeline_metrics
+from server.tweet_handling.tweet_filtering import TweetUsefulInfos
+
+TWITTER_DATE_FORMAT = '%a %b %d %H:%M:%S +0000 %Y'
+EARTHQUAKE_DATASET = 'server/tweet_handling/EarthquakeTweetFM/EarthquakeTweetFM_dataset.csv'
+# synthetic tweets are placed around L'Aquila
+DEFAULT_EPICENTRE = (13.40, 42.35)
+
+
+def read_jsonl_corpus(path):
+    '''
+    @param path: file with a tweet JSON (as sent by the streaming API) on every line
+    @return: list of tweet dictionaries
+    '''
+    corpus = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                corpus.append(json.loads(line))
+    return corpus
+
+
+def synthetic_place(lon, lat, size=0.01):
+    '''
+    @return: dictionary of a Twitter place whose bounding box starts at (lon, lat)
+    '''
+    return {'full_name': 'replay {:.2f}, {:.2f}'.format(lon, lat),
+            'bounding_box': {'type': 'Polygon',
+                             'coordinates': [[[lon, lat], [lon, lat + size],
+                                              [lon + size, lat + size], [lon + size, lat]]]}}
+
+
+def read_labelled_csv_corpus(paths=(EARTHQUAKE_DATASET,), labels=None, start=None, tweets_per_second=1.0,
+                             epicentre=DEFAULT_EPICENTRE, spread=0.3, geotagged_ratio=0.5, seed=0):
+    '''
+    builds a timestamped corpus from the labelled datasets (Content, Label columns).
+    Tweets arrive as a Poisson process with the given rate, a part of them
+    is geotagged with a place drawn around the epicentre
+    @param labels: labels of the rows to keep, None for all of them
+    @param start: created_at of the first tweet, now if None
+    @param spread: standard deviation (degrees) of the positions around the epicentre
+    @return: list of tweet dictionaries
+    '''
+    data = pd.concat([pd.read_csv(path) for path in paths], ignore_index=True)
+    if labels is not None:
+        data = data[data['Label'].isin(labels)]
+    random_state = np.random.RandomState(seed)
+    if start is None:
+        start = datetime.utcnow()
+    offsets = np.cumsum(random_state.exponential(1.0 / tweets_per_second, len(data)))
+    geotagged = random_state.uniform(size=len(data)) < geotagged_ratio
+    positions = random_state.normal(epicentre, spread, (len(data), 2))
+    corpus = []
+    for i, text in enumerate(data['Content']):
+        created_at = start + timedelta(seconds=float(offsets[i]))
+        tweet = {'id': i + 1,
+                 'text': str(text),
+                 'created_at': created_at.strftime(TWITTER_DATE_FORMAT),
+                 'user': {'id': i + 1, 'name': 'replay user {}'.format(i + 1)},
+                 'place': synthetic_place(*positions[i]) if geotagged[i] else None}
+        corpus.append(tweet)
+    return corpus
+
+
+def get_created_at(tweet: dict):
+    return datetime.strptime(tweet['created_at'], TWITTER_DATE_FORMAT)
+
+
+class TweetReplayer:
+    """
+    Puts the tweets of a corpus in a queue as TweetUsefulInfos, with the same
+    inter-arrival times of their created_at divided by speed (speed=None replays
+    them as fast as possible), as the stream listener would do without the network.
+    The time every tweet was put in the queue is kept to measure latencies.
+    """
+
+    def __init__(self, corpus, queue: Queue, speed=1.0):
+        '''
+        @param corpus: list of tweet dictionaries (see read_jsonl_corpus and read_labelled_csv_corpus)
+        @param speed: replay speed, 1 is real time, None or 0 is the maximum speed
+        '''
+        self.__corpus = sorted(corpus, key=get_created_at)
+        self.__queue = queue
+        self.__speed = speed or None
+        self.__replayed = []
+        self.__put_times = {}
+        self.__start_time = None
+        self.__end_time = None
+        self.__finished = threading.Event()
+
+    def get_speed(self):
+        return self.__speed
+
+    def get_corpus_size(self):
+        return len(self.__corpus)
+
+    def get_replayed(self):
+        return self.__replayed
+
+    def get_start_time(self):
+        return self.__start_time
+
+    def get_end_time(self):
+        return self.__end_time
+
+    def get_put_time(self, tweet: TweetUsefulInfos):
+        '''
+        @return: time.perf_counter() when the tweet was put in the queue, None if it was not replayed here
+        '''
+        return self.__put_times.get(id(tweet))
+
+    def get_corpus_time(self, wall_time):
+        '''
+        @return: created_at of the tweets that were being replayed at the given time.perf_counter()
+        '''
+        first = get_created_at(self.__corpus[0])
+        if self.__speed is None:
+            return first
+        return first + timedelta(seconds=(wall_time - self.__start_time) * self.__speed)
+
+    def is_finished(self):
+        return self.__finished.is_set()
+
+    def wait(self, timeout=None):
+        return self.__finished.wait(timeout)
+
+    def get_throughput(self):
+        '''
+        @return: tweets put in the queue per second
+        '''
+        if self.__end_time is None or self.__end_time <= self.__start_time:
+            return 0.0
+        return len(self.__replayed) / (self.__end_time - self.__start_time)
+
+    def run(self):
+        # the statuses are parsed before starting, as the stream listener receives them already parsed
+        statuses = [Status.parse(None, tweet) for tweet in self.__corpus]
+        first = statuses[0].created_at if statuses else None
+        self.__start_time = time.perf_counter()
+        for status in statuses:
+            if self.__speed is not None:
+                delay = (status.created_at - first).total_seconds() / self.__speed
+                remaining = self.__start_time + delay - time.perf_counter()
+                if remaining > 0:
+                    time.sleep(remaining)
+            tweet = TweetUsefulInfos(status)
+            # the tweet list keeps the objects alive, so their ids are not reused
+            self.__replayed.append(tweet)
+            self.__put_times[id(tweet)] = time.perf_counter()
+            self.__queue.put(tweet)
+            pipeline_metrics.tweets_received.inc()
+        self.__end_time = time.perf_counter()
+        self.__finished.set()
@@ -1,5 +1,14 @@
+import asyncio
+import json
+import threading
+import time
+from queue import Queue, Full
+from urllib.parse import urlsplit
+
 import tweepy
-from queue import Queue
+from tweepy import Status
+
+from server.monitoring import pipeline_metrics
 from server.tweet_handling.tweet_filtering import TweetUsefulInfos
 
 
@@ -26,6 +35,7 @@ class Stream2Queue(tweepy.StreamListener):
         @return:
         '''
         self.tweets.put(TweetUsefulInfos(status))
+        pipeline_metrics.tweets_received.inc()
         print(status.text)
 
 
@@ -48,6 +58,13 @@ def __get_API():
     return tweepy.API(auth)
 
 
+def get_twitter_auth():
+    '''
+    @return: OAuth handler of the keys in keys.txt
+    '''
+    return __get_API().auth
+
+
 def put_tweets_in_queue_rt(queue: Queue, words_to_track=None, languages=None, user=None):
     if languages is None:
         languages = ['it']
@@ -58,3 +75,291 @@ def put_tweets_in_queue_rt(queue: Queue, words_to_track=None, languages=None, us
     screen = Stream2Queue(queue)
     stream = tweepy.streaming.Stream(api.auth, screen)
     stream.filter(track=words_to_track, languages=languages, follow=user)
+
+
+class TweetSource:
+    """
+    Source of tweets for TweetIngestion. statuses() returns an async iterator
+    of tweet dictionaries (the JSON of the streaming API) or tweepy statuses;
+    it ends, or raises ConnectionError, when the connection is lost, and the ingestion
+    calls it again to reconnect. The iterator must not read ahead: while the ingestion
+    does not ask for the next tweet, nothing is read from the connection.
+    """
+
+    def get_name(self):
+        return type(self).__name__
+
+    def statuses(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class HTTPStreamSource(TweetSource):
+    """
+    Reads a stream in the format of the Twitter streaming API from a plain HTTP url:
+    a JSON tweet on every line of a (usually chunked) response, with empty keep alive lines.
+    It is used with the stand-in server of stream_server, to test and load the pipeline without Twitter.
+    """
+
+    def __init__(self, url, timeout=90.0):
+        '''
+        @param timeout: seconds without data (keep alive lines included) after which the connection is dropped
+        '''
+        parts = urlsplit(url)
+        if parts.scheme != 'http':
+            raise ValueError('only http urls are supported: {}'.format(url))
+        self.__url = url
+        self.__host = parts.hostname
+        self.__port = parts.port or 80
+        self.__path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        self.__timeout = timeout
+
+    def get_url(self):
+        return self.__url
+
+    def get_name(self):
+        return self.__url
+
+    async def __read_lines(self, reader, chunked):
+        if not chunked:
+            while True:
+                line = await asyncio.wait_for(reader.readline(), self.__timeout)
+                if not line:
+                    return
+                yield line
+        pending = b''
+        while True:
+            size_line = await asyncio.wait_for(reader.readline(), self.__timeout)
+            if not size_line:
+                raise ConnectionError('stream closed in the middle of a chunk')
+            size = int(size_line.split(b';')[0].strip() or b'0', 16)
+            if size == 0:
+                return
+            chunk = await asyncio.wait_for(reader.readexactly(size + 2), self.__timeout)
+            lines = (pending + chunk[:-2]).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line
+
+    async def statuses(self):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.__host, self.__port), self.__timeout)
+        try:
+            writer.write('GET {} HTTP/1.1\r\nHost: {}\r\nAccept: application/json\r\n\r\n'.format(
+                self.__path, self.__host).encode('ascii'))
+            await writer.drain()
+            status_line = await asyncio.wait_for(reader.readline(), self.__timeout)
+            if b' 200 ' not in status_line:
+                raise ConnectionError('stream refused: {}'.format(status_line.decode('latin-1').strip()))
+            chunked = False
+            while True:
+                header = await asyncio.wait_for(reader.readline(), self.__timeout)
+                if header in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = header.decode('latin-1').partition(':')
+                if name.strip().lower() == 'transfer-encoding' and 'chunked' in value.lower():
+                    chunked = True
+            async for line in self.__read_lines(reader, chunked):
+                line = line.strip()
+                # empty lines are keep alive
+                if not line:
+                    continue
+                try:
+                    status = json.loads(line)
+                except ValueError as e:
+                    # a corrupted line is dropped, the stream goes on
+                    print('stream record dropped:', repr(e))
+                    pipeline_metrics.stream_records_dropped.inc(1, ('invalid',))
+                    continue
+                yield status
+        finally:
+            writer.close()
+
+
+class TwitterStreamSource(TweetSource):
+    """
+    Twitter filter stream. tweepy reads the stream in its own thread and hands every status
+    to the event loop through a bounded queue: when the queue is full the tweepy thread waits,
+    so the socket is not read and the backpressure reaches Twitter.
+    """
+
+    def __init__(self, words_to_track=None, languages=None, user=None, queue_size=1000, auth=None):
+        '''
+        @param auth: tweepy OAuth handler, the one of get_twitter_auth if None
+        '''
+        self.__auth = auth
+        self.__words_to_track = words_to_track or ['a']
+        self.__languages = languages or ['it']
+        self.__user = user
+        self.__queue_size = queue_size
+        self.__stream = None
+
+    async def statuses(self):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(self.__queue_size)
+        end = object()
+
+        class Listener(tweepy.StreamListener):
+            def on_status(self, status):
+                asyncio.run_coroutine_threadsafe(queue.put(status), loop).result()
+
+            def on_error(self, status_code):
+                print('twitter stream error', status_code)
+                # disconnects, the ingestion reconnects with a growing delay (420 is rate limiting)
+                return False
+
+        def run_stream():
+            try:
+                self.__stream.filter(track=self.__words_to_track, languages=self.__languages, follow=self.__user)
+            except Exception as e:
+                print('twitter stream stopped:', e)
+            finally:
+                asyncio.run_coroutine_threadsafe(queue.put(end), loop)
+
+        self.__stream = tweepy.streaming.Stream(self.__auth or get_twitter_auth(), Listener())
+        threading.Thread(target=run_stream, daemon=True).start()
+        try:
+            while True:
+                status = await queue.get()
+                if status is end:
+                    return
+                yield status
+        finally:
+            self.close()
+
+    def close(self):
+        if self.__stream is not None:
+            self.__stream.disconnect()
+
+
+def is_tweet(record: dict):
+    '''
+    @param record: JSON object of the streaming API
+    @return: True if it is a tweet, False if it is a notice (delete, limit, disconnect, warning...)
+    '''
+    return 'user' in record and 'created_at' in record and ('text' in record or 'full_text' in record)
+
+
+class TweetIngestion:
+    """
+    asyncio ingestion stage: a reader task takes the tweets of the source and puts them
+    in a bounded buffer, a parser task turns them into TweetUsefulInfos and puts them in the
+    queue of the filter, which should be bounded too. When the filter falls behind its queue
+    fills, the parser waits for it, the buffer fills and the reader stops reading the source:
+    memory stays bounded and the time spent waiting is counted in the metrics.
+    A lost connection is opened again, after a delay that doubles up to max_reconnect_delay.
+    Notices of the stream (delete, limit, disconnect...) and records that cannot be parsed
+    are dropped and counted, they never stop the ingestion.
+    """
+
+    def __init__(self, source: TweetSource, queue: Queue, buffer_size=1024, reconnect_delay=1.0,
+                 max_reconnect_delay=60.0, reconnect=True):
+        '''
+        @param reconnect: False to stop when the source ends, e.g. with a finite corpus
+        '''
+        self.__source = source
+        self.__queue = queue
+        self.__buffer_size = buffer_size
+        self.__reconnect_delay = reconnect_delay
+        self.__max_reconnect_delay = max_reconnect_delay
+        self.__reconnect = reconnect
+        self.__buffer = None
+        self.__loop = None
+        self.__tasks = []
+        self.__ingested = 0
+        self.__reconnections = 0
+
+    def get_source(self):
+        return self.__source
+
+    def get_ingested(self):
+        return self.__ingested
+
+    def get_reconnections(self):
+        return self.__reconnections
+
+    def get_buffered(self):
+        return 0 if self.__buffer is None else self.__buffer.qsize()
+
+    async def __read(self):
+        delay = self.__reconnect_delay
+        while True:
+            try:
+                async for status in self.__source.statuses():
+                    # the connection works, the next reconnection waits the initial delay
+                    delay = self.__reconnect_delay
+                    await self.__buffer.put(status)
+                print('stream ended:', self.__source.get_name())
+            # EOFError: asyncio.IncompleteReadError, the connection closed in the middle of a chunk
+            except (ConnectionError, OSError, EOFError, asyncio.TimeoutError, ValueError) as e:
+                print('stream lost:', self.__source.get_name(), repr(e))
+            if not self.__reconnect:
+                break
+            self.__reconnections += 1
+            pipeline_metrics.stream_reconnections.inc()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.__max_reconnect_delay)
+        await self.__buffer.put(None)
+
+    async def __parse(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            status = await self.__buffer.get()
+            if status is None:
+                return
+            if isinstance(status, dict) and not is_tweet(status):
+                # delete, limit, disconnect, warning... notices of the streaming API
+                pipeline_metrics.stream_records_dropped.inc(1, ('notice',))
+                continue
+            try:
+                if isinstance(status, dict):
+                    status = Status.parse(None, status)
+                tweet = TweetUsefulInfos(status)
+            except Exception as e:
+                # a malformed record must not stop the ingestion
+                print('stream record dropped:', repr(e))
+                pipeline_metrics.stream_records_dropped.inc(1, ('invalid',))
+                continue
+            try:
+                self.__queue.put_nowait(tweet)
+            except Full:
+                # the filter is behind: wait in a thread, without blocking the loop
+                start = time.perf_counter()
+                await loop.run_in_executor(None, self.__queue.put, tweet)
+                pipeline_metrics.ingestion_blocked_seconds.inc(time.perf_counter() - start)
+            self.__ingested += 1
+            pipeline_metrics.tweets_received.inc()
+
+    async def run(self):
+        '''
+        ingests until the source ends (with reconnect=False) or stop is called
+        '''
+        self.__loop = asyncio.get_running_loop()
+        self.__buffer = asyncio.Queue(self.__buffer_size)
+        pipeline_metrics.register_queue_depth('ingestion', self.__buffer)
+        self.__tasks = [asyncio.ensure_future(self.__read()), asyncio.ensure_future(self.__parse())]
+        try:
+            await asyncio.gather(*self.__tasks)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.__source.close()
+
+    def stop(self):
+        '''
+        stops the ingestion, it can be called from any thread
+        '''
+        if self.__loop is not None:
+            for task in self.__tasks:
+                self.__loop.call_soon_threadsafe(task.cancel)
+
+
+def put_tweets_in_queue_async(queue: Queue, source: TweetSource, **kwargs):
+    '''
+    runs a TweetIngestion in a new event loop, blocking the calling thread
+    @param kwargs: arguments of TweetIngestion
+    '''
+    ingestion = TweetIngestion(source, queue, **kwargs)
+    asyncio.run(ingestion.run())
+    return ingestion